@@ -0,0 +1,55 @@
+"""
+Build the prebuilt index bundle that the drivers load at startup (see `fiaregs.bundle`).
+
+    python scripts/build_bundle.py
+    python scripts/build_bundle.py --pre-expand --embedding-model all-MiniLM-L6-v2
+
+Rebuild after changing the regulation documents; the drivers ignore (with a
+warning) a bundle whose source documents have changed.
+"""
+import os
+import argparse
+import logging
+import sys
+import time
+
+import fiaregs.search.embeddings as emb
+from fiaregs.config import DATA_DIR, DOC_DIR, REGS, EMBEDDING_MODEL_NAME
+from fiaregs import drivers
+from fiaregs.bundle import build_bundle
+
+
+# Suppress a runtime warning re: tokenizer parallelism and multiple threads.
+os.environ["TOKENIZERS_PARALLELISM"] = "false"
+
+# === Basic logger setup ===================================================
+logging.basicConfig(
+    stream=sys.stdout,
+    format='%(asctime)s %(message)s',
+    datefmt='%m/%d/%Y %H:%M:%S'
+)
+logging.getLogger(__name__).setLevel(logging.DEBUG)
+log = logging.getLogger(__name__)
+# ===================================================================
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pre-expand', action='store_true')
+    parser.add_argument('--embedding-model', default=EMBEDDING_MODEL_NAME)
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    # The model is only used if the embeddings are not cached yet
+    model = emb.get_model(args.embedding_model)
+    run_dir = drivers.get_run_dir(DATA_DIR, args.pre_expand, args.embedding_model)
+    bundle_dir = build_bundle(
+        DATA_DIR, DOC_DIR, REGS, run_dir, model, args.pre_expand, args.embedding_model
+    )
+
+    size_mb = sum(path.stat().st_size for path in bundle_dir.iterdir())/1e6
+    log.info(f'Built {bundle_dir} ({size_mb:.1f} MB) in {time.perf_counter() - start_time:.1f} s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""
+Benchmark the import time of fiaregs modules.
+
+Each module is imported in a fresh process with `python -X importtime`, and the
+report lists its total import time, the slowest packages it pulls in (summed
+over their submodules) and any heavy packages it loads.  Heavy packages
+(torch, sentence_transformers, NLTK, the LLM API clients...) should only be
+imported when first used, so with `--check` the script exits with an error if
+importing a fiaregs module loads one:
+
+    python scripts/import_benchmark.py
+    python scripts/import_benchmark.py --check --runs 3
+"""
+from collections import defaultdict
+import argparse
+import subprocess
+import sys
+
+import numpy as np
+
+
+MODULES = [
+    'fiaregs.drivers',
+    'fiaregs.utils',
+    'fiaregs.search.utils.doctree',
+    'fiaregs.search.embeddings',
+    'fiaregs.search.keyword_search',
+    'fiaregs.search.semantic_search',
+    'fiaregs.context',
+    'fiaregs.bundle',
+    'fiaregs.react_chat',
+    'fiaregs.memory',
+    'fiaregs.llm_cache',
+    'fiaregs.eval_runner',
+    'fiaregs.service',
+]
+
+# Packages that no fiaregs module may import when it is imported
+HEAVY_PACKAGES = [
+    'torch',
+    'sentence_transformers',
+    'transformers',
+    'nltk',
+    'rank_bm25',
+    'tiktoken',
+    'openai',
+    'anthropic',
+    'datasets',
+    'openpyxl',
+    'ragas',
+]
+
+TOP_PACKAGES = 5
+
+
+def import_times(module: str) -> tuple[float, dict[str, float]]:
+    """Import a module in a fresh process.
+
+    Returns its cumulative import time and the self time of every package it
+    imported (in seconds)."""
+    output = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True,
+        text=True,
+        check=True
+    ).stderr
+
+    total = 0.0
+    packages = defaultdict(float)
+    for line in output.splitlines():
+        if not line.startswith('import time:') or '[us]' in line:
+            continue
+        self_us, cumulative_us, name = line.removeprefix('import time:').split('|')
+        name = name.strip()
+        packages[name.split('.')[0]] += int(self_us)/1e6
+        if name==module:
+            total = int(cumulative_us)/1e6
+    return total, dict(packages)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('modules', nargs='*', default=MODULES)
+    parser.add_argument('--runs', type=int, default=1, help='Fresh processes per module (the median is reported)')
+    parser.add_argument('--check', action='store_true', help='Fail if a module imports a heavy package')
+    args = parser.parse_args()
+
+    failures = []
+    print(f'{"module":<32}{"import (s)":>12}  slowest packages')
+    for module in args.modules:
+        runs = [import_times(module) for _ in range(args.runs)]
+        total = float(np.median([total for total,_ in runs]))
+        packages = runs[-1][1]
+        slowest = sorted(
+            (package for package in packages if package!='fiaregs'),
+            key=lambda package: packages[package],
+            reverse=True
+        )[:TOP_PACKAGES]
+        print(
+            f'{module:<32}{total:>12.3f}  ' +
+            ', '.join(f'{package} {packages[package]:.3f}' for package in slowest)
+        )
+
+        heavy = [package for package in HEAVY_PACKAGES if package in packages]
+        if len(heavy)>0:
+            print(f'{"":<32}{"":>12}  heavy: {", ".join(heavy)}')
+            failures.append(module)
+
+    if args.check and len(failures)>0:
+        sys.exit(f'Heavy packages imported by {", ".join(failures)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,257 @@
+"""Load test the drivers with an offline mock LLM.
+
+Requests are issued open-loop at a target rate (QPS) against one of the CLI
+code paths (`driver_llm_with_search`, `driver_llm_with_agentic_search`) or the
+UI code paths (the functions returned by `drivers.setup`).  The LLM is replaced
+by `fiaregs.mock_llm`, so only the retrieval stack is exercised for real.
+Reports p50, p95 and p99 latency per stage.
+
+Example:
+
+    python scripts/load_test.py --path ui-summarize --qps 2 --duration 60
+"""
+import os
+from typing import Callable
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import json
+import logging
+import sys
+import threading
+import time
+
+import numpy as np
+
+from fiaregs.config import (
+    DATA_DIR,
+    DOC_DIR,
+    REGS,
+    EMBEDDING_MODEL_NAME,
+    CROSS_ENCODER_NAME,
+    PRE_EXPAND,
+    POST_EXPAND,
+    USE_DEFINITIONS,
+    TOP_K
+)
+from fiaregs import drivers
+from fiaregs import batching
+from fiaregs.mock_llm import start_mock_chat, make_latency
+
+
+# Suppress a runtime warning re: tokenizer parallelism and multiple threads.
+os.environ["TOKENIZERS_PARALLELISM"] = "false"
+
+# === Basic logger setup ===================================================
+logging.basicConfig(
+    stream=sys.stdout,
+    format='%(asctime)s %(message)s',
+    datefmt='%m/%d/%Y %H:%M:%S'
+)
+logging.getLogger(__name__).setLevel(logging.DEBUG)
+log = logging.getLogger(__name__)
+
+
+# === Configuration ========================================================
+
+# The documents, models and retrieval parameters are in `fiaregs.config`
+
+PATHS = ['cli', 'cli-agentic', 'ui-search', 'ui-summarize', 'ui-agentic']
+PERCENTILES = [50, 95, 99]
+
+
+# === Stage timing =========================================================
+
+_current = threading.local()
+
+
+def timed_stage(stage: str, func: Callable) -> Callable:
+    """Wrap a function so that its elapsed time is added to the current request's stages."""
+
+    def wrapper(*args, **kwargs):
+        start_time = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stages = getattr(_current, 'stages', None)
+            if stages is not None:
+                stages[stage] = stages.get(stage, 0.0) + time.perf_counter() - start_time
+
+    return wrapper
+
+
+def make_request_function(
+        path: str,
+        llm_model: Callable,
+        batch_config: batching.BatchConfig | None = None
+    ) -> Callable[[str], None]:
+    """Build the code path under test as a function of a question."""
+    kwargs = {'batch_config': batch_config}
+    args = (
+        llm_model,
+        DATA_DIR,
+        DOC_DIR,
+        REGS,
+        PRE_EXPAND,
+        POST_EXPAND,
+        EMBEDDING_MODEL_NAME,
+        CROSS_ENCODER_NAME,
+        TOP_K,
+        USE_DEFINITIONS
+    )
+
+    if path=='cli':
+        return drivers.driver_llm_with_search(*args, **kwargs)
+    if path=='cli-agentic':
+        return drivers.driver_llm_with_agentic_search(*args, **kwargs)
+
+    # The UI chains the quick search into the LLM functions (see reg_search_ui.py)
+    search, agentic_search, generate_response = drivers.setup(*args, **kwargs)
+    search = timed_stage('search', search)
+    generate_response = timed_stage('generate', generate_response)
+    # The agentic search is a generator; time it until exhausted
+    run_agentic_search = timed_stage('agentic', lambda *inputs: list(agentic_search(*inputs)))
+
+    def ui_request(question: str) -> None:
+        regulations, definitions = search(question)
+        if path=='ui-summarize':
+            generate_response(question, regulations, definitions)
+        elif path=='ui-agentic':
+            run_agentic_search(question, regulations, definitions)
+
+    return ui_request
+
+
+def percentiles(values: list[float]) -> dict[str, float]:
+    """Get latency percentiles in seconds."""
+    return {f'p{p}': float(np.percentile(values, p)) for p in PERCENTILES}
+
+
+def run_load(
+        request: Callable[[str], None],
+        questions: list[str],
+        qps: float,
+        duration_sec: float,
+        workers: int
+    ) -> tuple[list[dict[str, float]], int, float]:
+    """Issue requests open-loop at `qps` for `duration_sec` seconds.
+
+    Returns the stage timings of every request, the number of errors and the
+    wall-clock duration of the run.  Besides the wrapped stages, each request
+    has 'queue' and 'total' (both measured from the scheduled start time) and
+    'non_llm', the time not spent in the (mock) LLM."""
+    n_requests = max(int(qps*duration_sec), 1)
+    records = []
+    errors = 0
+    lock = threading.Lock()
+
+    def run_one(question: str, scheduled: float) -> None:
+        nonlocal errors
+        _current.stages = {'queue': time.perf_counter() - scheduled}
+        try:
+            request(question)
+        except Exception as e:
+            log.warning(f'Request failed: {e}')
+            with lock:
+                errors += 1
+            return
+        finally:
+            stages = _current.stages
+            _current.stages = None
+        stages['total'] = time.perf_counter() - scheduled
+        stages['non_llm'] = stages['total'] - stages['queue'] - stages.get('llm', 0.0)
+        with lock:
+            records.append(stages)
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for i in range(n_requests):
+            scheduled = start_time + i/qps
+            time.sleep(max(scheduled - time.perf_counter(), 0.0))
+            executor.submit(run_one, questions[i % len(questions)], scheduled)
+
+    return records, errors, time.perf_counter() - start_time
+
+
+def summarize(records: list[dict[str, float]]) -> dict[str, dict[str, float]]:
+    """Get latency percentiles for every stage."""
+    stage_names = list(dict.fromkeys(name for record in records for name in record))
+    return {
+        name: percentiles([record[name] for record in records if name in record])
+        for name in stage_names
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--path', choices=PATHS, default='ui-summarize', help='Code path to drive')
+    parser.add_argument('--qps', type=float, default=1.0, help='Target requests per second')
+    parser.add_argument('--duration', type=float, default=30.0, help='Length of the run in seconds')
+    parser.add_argument('--workers', type=int, default=8, help='Concurrent requests')
+    parser.add_argument('--llm-latency', type=float, default=1.0, help='Mean mock LLM latency in seconds')
+    parser.add_argument('--llm-spread', type=float, default=0.5, help='Spread of the mock LLM latency')
+    parser.add_argument(
+        '--llm-distribution', choices=['constant', 'uniform', 'lognormal'], default='lognormal'
+    )
+    parser.add_argument('--tool-rounds', type=int, default=1, help='Mock agent tool-calling rounds')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument(
+        '--batch-size', type=int, default=None,
+        help='Micro-batch query encoding and reranking, up to this many items per batch'
+    )
+    parser.add_argument(
+        '--batch-wait-ms', type=float, default=batching.MAX_BATCH_WAIT_MS,
+        help='Longest wait to fill a micro-batch'
+    )
+    parser.add_argument('--output', type=Path, default=None, help='Write the report as JSON')
+    args = parser.parse_args()
+
+    llm_model = timed_stage(
+        'llm',
+        start_mock_chat(
+            make_latency(args.llm_distribution, args.llm_latency, args.llm_spread, args.seed),
+            tool_rounds=args.tool_rounds
+        )
+    )
+
+    log.info(f'Setting up {args.path}')
+    setup_start = time.perf_counter()
+    batch_config = (
+        None if args.batch_size is None else batching.BatchConfig(args.batch_size, args.batch_wait_ms)
+    )
+    request = make_request_function(args.path, llm_model, batch_config)
+    setup_time = time.perf_counter() - setup_start
+
+    with open(DATA_DIR / 'eval_set.json', 'r') as f:
+        questions = [example['question'] for example in json.load(f)['eval_set']]
+
+    log.info(f'Running {args.path} at {args.qps} QPS for {args.duration} s')
+    records, errors, elapsed = run_load(request, questions, args.qps, args.duration, args.workers)
+
+    report = {
+        'path': args.path,
+        'target_qps': args.qps,
+        'achieved_qps': len(records)/elapsed,
+        'requests': len(records),
+        'errors': errors,
+        'setup_sec': setup_time,
+        'stages': summarize(records) if len(records)>0 else {},
+        'batching': batching.all_stats()
+    }
+
+    print(f'\n{args.path}: {report["requests"]} requests, {errors} errors, '
+          f'{report["achieved_qps"]:.2f} QPS achieved (target {args.qps}), setup {setup_time:.1f} s')
+    print(f'{"stage":<12}' + ''.join(f'{f"p{p} (s)":>12}' for p in PERCENTILES))
+    for stage,stats in report['stages'].items():
+        print(f'{stage:<12}' + ''.join(f'{stats[f"p{p}"]:>12.3f}' for p in PERCENTILES))
+    for name,stats in report['batching'].items():
+        print(f'{name} batches: {stats["batches"]}, mean size {stats["mean_batch_size"]:.2f}, '
+              f'max size {stats["max_batch_size"]}')
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,168 @@
+"""
+Report the memory footprint of a search worker's loaded components.
+
+Loads the documents, definition index, embedding model, embeddings and
+cross-encoder as the drivers do (from the documents, or from the prebuilt
+bundle with `--bundle`), then reports:
+
+- the resident set size (RSS) added by each loading phase;
+- the accounted size of every loaded component: the DocTrees, definitions,
+  definition BM25 index, embedding tensor, flat texts, flat chunk ids and the
+  models' parameters (see `fiaregs.footprint`).  Memory shared between
+  components is counted with the first one listed.  The bundle's text arena
+  is memory-mapped, so it counts as page cache rather than here;
+- the RSS that no component accounts for (interpreter, libraries, allocator).
+
+    python scripts/memory_report.py
+    python scripts/memory_report.py --bundle --no-rerank --output memory.json
+"""
+import os
+from pathlib import Path
+import argparse
+import json
+import logging
+import sys
+
+from fiaregs.config import (
+    DATA_DIR,
+    DOC_DIR,
+    REGS,
+    EMBEDDING_MODEL_NAME,
+    CROSS_ENCODER_NAME,
+    TOP_K
+)
+from fiaregs import drivers
+from fiaregs import registry
+from fiaregs.bundle import open_bundle
+from fiaregs.footprint import deep_sizeof, rss_bytes, format_bytes
+
+
+# Suppress a runtime warning re: tokenizer parallelism and multiple threads.
+os.environ["TOKENIZERS_PARALLELISM"] = "false"
+
+# === Basic logger setup ===================================================
+logging.basicConfig(
+    stream=sys.stdout,
+    format='%(asctime)s %(message)s',
+    datefmt='%m/%d/%Y %H:%M:%S'
+)
+logging.getLogger(__name__).setLevel(logging.DEBUG)
+log = logging.getLogger(__name__)
+# ===================================================================
+
+QUERY = 'What happens if a car is under the minimum weight?'
+
+# Names of the parts of registry components that are tuples, by registry key
+# prefix.  Listed in accounting order: shared memory counts with the first part.
+PARTS = {
+    'data': ['doc_trees', 'definition_ids', 'definitions_flat'],
+    'definition_bm25': ['definition_bm25'],
+    'embedding_model': ['embedding_model'],
+    'cross_encoder': ['cross_encoder'],
+    'embeddings': ['embeddings', 'flat_texts', 'flat_ids'],
+}
+
+
+def get_parts() -> dict[str, object]:
+    """Loaded components from the registry, split into named parts."""
+    components = registry.components()
+    parts = {}
+    for prefix,names in PARTS.items():
+        for key,value in components.items():
+            if key[0]!=prefix:
+                continue
+            values = value if len(names)>1 else (value,)
+            for name,part in zip(names, values):
+                parts[name if name not in parts else f'{name} {key[1:]}'] = part
+    return parts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--bundle', action='store_true', help='Load from the prebuilt index bundle')
+    parser.add_argument('--no-rerank', action='store_true', help='Do not load the cross-encoder')
+    parser.add_argument('--pre-expand', action='store_true')
+    parser.add_argument('--embedding-model', default=EMBEDDING_MODEL_NAME)
+    parser.add_argument('--cross-encoder', default=CROSS_ENCODER_NAME)
+    parser.add_argument('--output', type=Path, default=None, help='Write the report as JSON')
+    args = parser.parse_args()
+
+    phases = {}
+    last_rss = rss_bytes()
+
+    def lap(name: str):
+        nonlocal last_rss
+        rss = rss_bytes()
+        phases[name] = rss - last_rss
+        last_rss = rss
+
+    bundle = None
+    if args.bundle:
+        bundle = open_bundle(DATA_DIR, DOC_DIR, REGS, args.pre_expand, args.embedding_model)
+        if bundle is None:
+            raise SystemExit('No bundle for these settings; run scripts/build_bundle.py first')
+
+    _, (doc_trees, definition_ids, definitions_flat) = drivers.acquire_data(DOC_DIR, REGS, bundle)
+    lap('data')
+    search_definitions = drivers.make_definition_search(definition_ids, definitions_flat, bundle)
+    lap('definition_index')
+    search_regulations = drivers.make_regulation_search(
+        doc_trees,
+        drivers.get_run_dir(DATA_DIR, args.pre_expand, args.embedding_model),
+        args.embedding_model,
+        None if args.no_rerank else args.cross_encoder,
+        args.pre_expand,
+        True,
+        TOP_K,
+        bundle=bundle
+    )
+    lap('models_and_embeddings')
+    # Searching touches the memory-mapped embeddings and warms up the models
+    search_regulations(QUERY)
+    search_definitions(QUERY)
+    lap('first_search')
+
+    seen = set()
+    components = {name: deep_sizeof(part, seen) for name,part in get_parts().items()}
+    rss = rss_bytes()
+    accounted = sum(components.values())
+
+    report = {
+        'config': {
+            'bundle': args.bundle,
+            'rerank': not args.no_rerank,
+            'pre_expand': args.pre_expand,
+            'embedding_model': args.embedding_model,
+            'cross_encoder': None if args.no_rerank else args.cross_encoder,
+        },
+        'rss_bytes': rss,
+        'phase_rss_bytes': phases,
+        'component_bytes': components,
+        'accounted_bytes': accounted,
+        'unaccounted_bytes': rss - accounted,
+    }
+    parts = get_parts()
+    if 'flat_ids' in parts:
+        # What the ids and texts would take as lists of tuples and strings, for comparison
+        report['flat_ids_as_tuples_bytes'] = deep_sizeof(list(parts['flat_ids']))
+        report['flat_texts_as_strings_bytes'] = deep_sizeof(list(parts['flat_texts']))
+
+    print(f'\n{"phase":<28}{"RSS added":>12}')
+    for name,n in phases.items():
+        print(f'{name:<28}{format_bytes(n):>12}')
+    print(f'\n{"component":<28}{"bytes":>12}{"share":>8}')
+    for name,n in sorted(components.items(), key=lambda item: item[1], reverse=True):
+        print(f'{name:<28}{format_bytes(n):>12}{n/rss:>8.1%}')
+    print(f'{"unaccounted":<28}{format_bytes(rss - accounted):>12}{(rss - accounted)/rss:>8.1%}')
+    print(f'{"total RSS":<28}{format_bytes(rss):>12}')
+    if 'flat_ids_as_tuples_bytes' in report:
+        print(f'\nflat_ids would take {format_bytes(report["flat_ids_as_tuples_bytes"])} as a list of tuples')
+        print(f'flat_texts would take {format_bytes(report["flat_texts_as_strings_bytes"])} as a list of strings')
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__=='__main__':
+    main()
@@ -1,16 +1,47 @@
 """
 FIA Regulation Search for Formula One
+
+Ask questions interactively, or answer a batch of questions:
+
+    python scripts/reg_search_cli.py --batch questions.txt --output answers.jsonl
+    cat questions.jsonl | python scripts/reg_search_cli.py --batch - --driver agentic
+
+Batch questions are one per line, either plain text or JSON objects with a
+`question` and an optional `id`.  One JSON line is written per answer as soon
+as it completes (so not in input order), with the retrieved chunk ids and the
+stage timings of the request.  Logs go to stderr.
 """
+from typing import Callable, Iterable, Iterator, TextIO
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
 import os
 from pathlib import Path
+import argparse
+import json
 import logging
 import sys
+import threading
+import time
 
 from aicore.llm.client import get_llm_client
-from aicore.llm import openaiapi as openai
-from aicore.llm.tracker import UsageTracker
 
+from fiaregs.config import (
+    DATA_DIR,
+    DOC_DIR,
+    REGS,
+    EMBEDDING_MODEL_NAME,
+    CROSS_ENCODER_NAME,
+    LLM_MODEL_NAME,
+    LLM_API_KEY,
+    PRE_EXPAND,
+    POST_EXPAND,
+    USE_DEFINITIONS,
+    TOP_K
+)
 from fiaregs import drivers
+from fiaregs.eval_runner import is_api_error, with_retries
+from fiaregs.llm_cache import start_cached_chat
+from fiaregs.trace import JsonlExporter, add_exporter, trace_request
 
 
 # Suppress a runtime warning re: tokenizer parallelism and multiple threads.
@@ -26,77 +57,185 @@ logging.getLogger(__name__).setLevel(logging.DEBUG)
 log = logging.getLogger(__name__)
 # ===================================================================
 
-DOC_DIR = Path('data/docs')
-DATA_DIR = Path('data')
-
 RERANK = True
-PRE_EXPAND = False
-POST_EXPAND = True
-
-REGS = {
-    '2023 FIA Formula One Sporting Regulations': 'fia_2023_formula_1_sporting_regulations_-_issue_6_-_2023-08-31.yaml',
-    '2023 FIA International Sporting Code': '2023_international_sporting_code_fr-en_clean_9.01.2023.yaml',
-    '2023 FIA International Sporting Code, Appendix L, Chapter II': 'appendix_l_iii_2023_publie_le_20_juin_2023.yaml',
-    '2023 FIA International Sporting Code, Appendix L, Chapter IV': 'appendix_l_iv_2023_publie_le_20_juin_2023.yaml',
-    '2023 FIA Formula One Financial Regulations': 'fia_formula_1_financial_regulations_-_issue_16_-_2023-08-31.yaml',
-    '2023 FIA Formula One Technical Regulations': 'fia_2023_formula_1_technical_regulations_-_issue_7_-_2023-08-31.yaml'
-}
 
 MAX_LLM_CALLS_PER_INTERACTION = 5
 
 DEF_DIVIDER = '\n\n'
 
-
-def run_demo():
-
-    model_name = 'all-mpnet-base-v2'
-    cross_encoder_name = 'cross-encoder/ms-marco-MiniLM-L-12-v2'
-    # cross_encoder_name = None
-    # OpenAI
-    llm_model_name = 'gpt-4-0125-preview'
-    # llm_model_name = 'gpt-3.5-turbo-0125'
-    llm_api_key = 'OPENAI_API_KEY'
-    # Perplexity
-    # llm_model_name = 'mistral-7b-instruct'
-    # llm_api_key = 'PERPLEXITY_API_KEY'
-
-    use_definitions = True
-    top_k = 10
-
-    api_client = get_llm_client(llm_api_key)
-    llm_model = openai.start_chat(llm_model_name, api_client)
+# LLM responses are recorded to and replayed from LLM_CACHE: 'passthrough' (no
+# cache), 'record' (reuse stored responses, store new ones) or 'replay' (only
+# stored responses, no API calls)
+LLM_CACHE_MODE = 'passthrough'
+LLM_CACHE = DATA_DIR / 'llm_cache.jsonl'
+
+DRIVERS = ['llm-only', 'search', 'agentic']
+
+# Batch mode
+BATCH_WORKERS = 4
+MAX_RETRIES = 3
+RETRY_BACKOFF_SEC = 2.0
+
+
+def read_questions(lines: Iterable[str]) -> Iterator[dict]:
+    """Parse question lines (plain text or JSON objects), skipping blank lines."""
+    for line_number,line in enumerate(lines, 1):
+        line = line.strip()
+        if len(line)==0:
+            continue
+        try:
+            item = json.loads(line) if line.startswith('{') else {'question': line}
+        except json.JSONDecodeError as e:
+            log.warning(f'Skipping line {line_number}: invalid JSON ({e})')
+            continue
+        if not isinstance(item.get('question'), str):
+            log.warning(f'Skipping line {line_number}: no `question`')
+            continue
+        yield {'line': line_number, 'id': item.get('id'), 'question': item['question']}
+
+
+def answer_question(search: Callable[[str], str], item: dict) -> dict:
+    """Answer one question and get its output record."""
+    with trace_request() as request_trace:
+        try:
+            answer, error = search(item['question']), None
+        except Exception as e:
+            answer, error = None, f'{type(e).__name__}: {e}'
+    request_trace = request_trace.to_dict()
+    return {
+        **item,
+        'request_id': request_trace['request_id'],
+        'answer': answer,
+        'error': error,
+        # In retrieval order, once each (retries and agentic searches retrieve again)
+        'chunk_ids': list(dict.fromkeys(request_trace['values'].get('chunk_ids', []))),
+        'timings': request_trace['timings'],
+        'counts': request_trace['counts']
+    }
+
+
+def run_batch(
+        search: Callable[[str], str],
+        questions: Iterable[dict],
+        output: TextIO,
+        workers: int = BATCH_WORKERS
+    ) -> dict[str, int]:
+    """Answer questions on `workers` threads, writing a JSON line per answer as it completes.
+
+    Questions are read as workers become free, so a long (or endless) input is
+    never held in memory."""
+    search = with_retries(search, MAX_RETRIES, RETRY_BACKOFF_SEC, is_failure=is_api_error)
+    slots = threading.BoundedSemaphore(workers)
+    lock = threading.Lock()
+    totals = {'answered': 0, 'failed': 0}
+
+    def run_one(item: dict) -> None:
+        try:
+            record = answer_question(search, item)
+            with lock:
+                output.write(json.dumps(record) + '\n')
+                output.flush()
+                totals['answered' if record['error'] is None else 'failed'] += 1
+            log.info(f'Line {item["line"]}: {record["timings"]["total"]:.1f} s')
+        except Exception:
+            log.exception(f'Line {item["line"]}: writing the answer failed')
+        finally:
+            slots.release()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for item in questions:
+            slots.acquire()
+            executor.submit(run_one, item)
+
+    return totals
+
+
+def run_demo(
+        driver: str = 'search',
+        batch: TextIO | None = None,
+        output: TextIO = sys.stdout,
+        workers: int = BATCH_WORKERS
+    ):
+
+    # The models and retrieval parameters (interactive and batch) are set in `fiaregs.config`
+
+    api_client = None if LLM_CACHE_MODE=='replay' else get_llm_client(LLM_API_KEY)
+    llm_model = start_cached_chat(LLM_MODEL_NAME, api_client, None, LLM_CACHE, LLM_CACHE_MODE)
 
     # TODO pretty print messages to terminal
 
-    # search = drivers.driver_llm_only(llm_model)
-    search = drivers.driver_llm_with_search(
-        llm_model,
-        DATA_DIR,
-        DOC_DIR,
-        REGS,
-        PRE_EXPAND,
-        POST_EXPAND,
-        model_name,
-        cross_encoder_name,
-        top_k,
-        include_definitions=True
-    )
-    # search = drivers.driver_llm_with_agentic_search(
-    #     llm_model,
-    #     DATA_DIR,
-    #     DOC_DIR,
-    #     REGS,
-    #     PRE_EXPAND,
-    #     POST_EXPAND,
-    #     model_name,
-    #     cross_encoder_name,
-    #     top_k,
-    #     include_definitions=use_definitions
-    # )
+    if driver=='llm-only':
+        search = drivers.driver_llm_only(llm_model)
+    elif driver=='search':
+        search = drivers.driver_llm_with_search(
+            llm_model,
+            DATA_DIR,
+            DOC_DIR,
+            REGS,
+            PRE_EXPAND,
+            POST_EXPAND,
+            EMBEDDING_MODEL_NAME,
+            CROSS_ENCODER_NAME,
+            TOP_K,
+            include_definitions=USE_DEFINITIONS
+        )
+    else:
+        search = drivers.driver_llm_with_agentic_search(
+            llm_model,
+            DATA_DIR,
+            DOC_DIR,
+            REGS,
+            PRE_EXPAND,
+            POST_EXPAND,
+            EMBEDDING_MODEL_NAME,
+            CROSS_ENCODER_NAME,
+            TOP_K,
+            include_definitions=USE_DEFINITIONS
+        )
+
+    if batch is not None:
+        start_time = time.perf_counter()
+        totals = run_batch(search, read_questions(batch), output, workers)
+        log.info(
+            f'Answered {totals["answered"]} questions ({totals["failed"]} failed) '
+            f'in {time.perf_counter() - start_time:.1f} s'
+        )
+        return
 
     while (query := input('Question: ')) != 'quit':
         print(search(query))
 
 
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--driver', choices=DRIVERS, default='search')
+    parser.add_argument('--batch', metavar='PATH', help='File of questions to answer (- for stdin)')
+    parser.add_argument('--output', metavar='PATH', help='JSONL file for batch answers (default stdout)')
+    parser.add_argument('--workers', type=int, default=BATCH_WORKERS, help='Questions answered at once')
+    parser.add_argument('--spans', metavar='PATH', help='Append tracing spans to this JSONL file')
+    args = parser.parse_args()
+
+    if args.spans is not None:
+        add_exporter(JsonlExporter(Path(args.spans)))
+
+    if args.batch is None:
+        run_demo(args.driver)
+        return
+
+    # Keep stdout for the answers: logs and the chat functions' printed messages go to stderr
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, logging.StreamHandler):
+            handler.setStream(sys.stderr)
+    batch = sys.stdin if args.batch=='-' else open(args.batch)
+    output = sys.stdout if args.output is None else open(args.output, 'w')
+    try:
+        with redirect_stdout(sys.stderr):
+            run_demo(args.driver, batch, output, args.workers)
+    finally:
+        for file in (batch, output):
+            if file not in (sys.stdin, sys.stdout):
+                file.close()
+
+
 if __name__ == '__main__':
-    run_demo()
+    main()
@@ -20,16 +20,17 @@
   for a beginning-of-string exact match against the phrases.
 """
 import os
-from pathlib import Path
 
 import logging
 import sys
 
 import gradio as gr
 
+from fiaregs.config import DATA_DIR, DOC_DIR, REGS
 from fiaregs.drivers import setup
+from fiaregs.llm_cache import start_cached_chat
+from fiaregs import metrics
 from aicore.llm.client import get_llm_client
-from aicore.llm import openaiapi as openai
 
 # Suppress a runtime warning re: tokenizer parallelism and multiple threads.
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
@@ -44,26 +45,23 @@ logging.getLogger('search').setLevel(logging.DEBUG)
 log = logging.getLogger('search')
 # ===================================================================
 
-DOC_DIR = Path('data/docs')
-DATA_DIR = Path('data')
-
 RERANK = True
 PRE_EXPAND = False
 POST_EXPAND = True
 
-REGS = {
-    '2023 FIA Formula One Sporting Regulations': 'fia_2023_formula_1_sporting_regulations_-_issue_6_-_2023-08-31.yaml',
-    '2023 FIA International Sporting Code': '2023_international_sporting_code_fr-en_clean_9.01.2023.yaml',
-    '2023 FIA International Sporting Code, Appendix L, Chapter II': 'appendix_l_iii_2023_publie_le_20_juin_2023.yaml',
-    '2023 FIA International Sporting Code, Appendix L, Chapter IV': 'appendix_l_iv_2023_publie_le_20_juin_2023.yaml',
-    '2023 FIA Formula One Financial Regulations': 'fia_formula_1_financial_regulations_-_issue_16_-_2023-08-31.yaml',
-    '2023 FIA Formula One Technical Regulations': 'fia_2023_formula_1_technical_regulations_-_issue_7_-_2023-08-31.yaml'
-}
-
 MAX_LLM_CALLS_PER_INTERACTION = 5
 
 DEF_DIVIDER = '\n\n'
 
+# LLM responses are recorded to and replayed from LLM_CACHE: 'passthrough' (no
+# cache), 'record' (reuse stored responses, store new ones) or 'replay' (only
+# stored responses, no API calls)
+LLM_CACHE_MODE = 'passthrough'
+LLM_CACHE = DATA_DIR / 'llm_cache.jsonl'
+
+# Metrics are served at http://127.0.0.1:METRICS_PORT/metrics (None to disable)
+METRICS_PORT = 9100
+
 
 def run_demo():
 
@@ -74,8 +72,8 @@ def run_demo():
     use_definitions = True
     top_k = 10
 
-    api_client = get_llm_client(llm_api_key)
-    llm_model = openai.start_chat(llm_model_name, api_client)
+    api_client = None if LLM_CACHE_MODE=='replay' else get_llm_client(llm_api_key)
+    llm_model = start_cached_chat(llm_model_name, api_client, None, LLM_CACHE, LLM_CACHE_MODE)
 
     search, agentic_search, generate_response = setup(
         llm_model,
@@ -131,6 +129,9 @@ def run_demo():
             outputs=llm_response
         )
 
+    if METRICS_PORT is not None:
+        metrics.start_http_server(METRICS_PORT)
+
     demo.queue()
     demo.launch()
 
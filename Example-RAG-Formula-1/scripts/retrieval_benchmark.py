@@ -0,0 +1,183 @@
+"""Benchmark retrieval against the gold contexts in the evaluation set.
+
+No LLM is called: every question in `data/eval_set.json` is run through the
+regulation search and the definition search, and the results are compared to
+the question's gold `contexts`.  Reports recall@k, MRR, context coverage (of
+the packed context the LLM would see), per-stage latency and throughput.
+
+Use thresholds to gate changes to retrieval settings:
+
+    python scripts/retrieval_benchmark.py --top-k 10 --min-recall 0.6 --min-mrr 0.4
+"""
+import os
+from pathlib import Path
+import argparse
+import json
+import logging
+import sys
+import time
+
+import numpy as np
+
+from fiaregs.config import (
+    DATA_DIR,
+    DOC_DIR,
+    REGS,
+    EMBEDDING_MODEL_NAME,
+    CROSS_ENCODER_NAME
+)
+from fiaregs import drivers
+from fiaregs.context import pack_context, result_paragraphs
+from fiaregs import retrieval_metrics as metrics
+
+
+# Suppress a runtime warning re: tokenizer parallelism and multiple threads.
+os.environ["TOKENIZERS_PARALLELISM"] = "false"
+
+# === Basic logger setup ===================================================
+logging.basicConfig(
+    stream=sys.stdout,
+    format='%(asctime)s %(message)s',
+    datefmt='%m/%d/%Y %H:%M:%S'
+)
+logging.getLogger(__name__).setLevel(logging.DEBUG)
+log = logging.getLogger(__name__)
+
+
+# === Configuration ========================================================
+
+EVAL_SET = DATA_DIR / 'eval_set.json'
+
+RECALL_KS = [1, 3, 5, 10]
+PERCENTILES = [50, 95, 99]
+
+
+def timed(func, *args):
+    """Call a function, returning its output and elapsed time in seconds."""
+    start_time = time.perf_counter()
+    output = func(*args)
+    return output, time.perf_counter() - start_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--top-k', type=int, default=10)
+    parser.add_argument('--no-rerank', action='store_true', help='Disable cross-encoder reranking')
+    parser.add_argument('--pre-expand', action='store_true')
+    parser.add_argument('--no-post-expand', action='store_true')
+    parser.add_argument('--embedding-model', default=EMBEDDING_MODEL_NAME)
+    parser.add_argument('--cross-encoder', default=CROSS_ENCODER_NAME)
+    parser.add_argument('--max-context-tokens', type=int, default=drivers.MAX_CONTEXT_TOKENS)
+    parser.add_argument('--min-recall', type=float, default=None, help=f'Fail if recall@{RECALL_KS[-1]} is lower')
+    parser.add_argument('--min-mrr', type=float, default=None, help='Fail if MRR is lower')
+    parser.add_argument('--min-coverage', type=float, default=None, help='Fail if context coverage is lower')
+    parser.add_argument('--output', type=Path, default=None, help='Write the report as JSON')
+    args = parser.parse_args()
+
+    # Setup (not included in the timings)
+    setup_start = time.perf_counter()
+    doc_trees, definition_ids, definitions_flat = drivers.load_data(DOC_DIR, REGS)
+    search_definitions = drivers.make_definition_search(definition_ids, definitions_flat)
+    search_regulations = drivers.make_regulation_search(
+        doc_trees,
+        drivers.get_run_dir(DATA_DIR, args.pre_expand, args.embedding_model),
+        args.embedding_model,
+        None if args.no_rerank else args.cross_encoder,
+        args.pre_expand,
+        not args.no_post_expand,
+        args.top_k
+    )
+    setup_time = time.perf_counter() - setup_start
+
+    with open(EVAL_SET, 'r') as f:
+        eval_set = json.load(f)['eval_set']
+
+    scores = {f'recall@{k}': [] for k in RECALL_KS}
+    scores.update({'mrr': [], 'coverage': [], 'definition_recall': []})
+    timings = {'regulation_search': [], 'definition_search': [], 'packing': [], 'total': []}
+    context_tokens = []
+
+    run_start = time.perf_counter()
+    for example in eval_set:
+        question, golds = example['question'], example['contexts']
+
+        regulation_results, regulation_time = timed(search_regulations, question)
+        definition_results, definition_time = timed(search_definitions, question)
+        packed, packing_time = timed(
+            pack_context, regulation_results, definition_results, doc_trees, args.max_context_tokens
+        )
+
+        # Each result is judged on the text the LLM sees for it, including the
+        # supersection and subsection paragraphs
+        retrieved = [
+            '\n'.join(text for _,text,_ in result_paragraphs(result, doc_trees) if text is not None)
+            for result in regulation_results
+        ]
+        for k in RECALL_KS:
+            scores[f'recall@{k}'].append(metrics.recall_at_k(golds, retrieved, k))
+        scores['mrr'].append(metrics.reciprocal_rank(golds, retrieved))
+        scores['coverage'].append(
+            metrics.coverage(golds, packed.regulations + '\n' + packed.definitions)
+        )
+        scores['definition_recall'].append(
+            metrics.recall_at_k(golds, definition_results, len(definition_results))
+        )
+
+        timings['regulation_search'].append(regulation_time)
+        timings['definition_search'].append(definition_time)
+        timings['packing'].append(packing_time)
+        timings['total'].append(regulation_time + definition_time + packing_time)
+        context_tokens.append(packed.tokens)
+    run_time = time.perf_counter() - run_start
+
+    report = {
+        'config': {
+            'top_k': args.top_k,
+            'rerank': not args.no_rerank,
+            'pre_expand': args.pre_expand,
+            'post_expand': not args.no_post_expand,
+            'embedding_model': args.embedding_model,
+            'cross_encoder': None if args.no_rerank else args.cross_encoder,
+            'max_context_tokens': args.max_context_tokens,
+        },
+        'questions': len(eval_set),
+        'setup_sec': setup_time,
+        'questions_per_sec': len(eval_set)/run_time,
+        'mean_context_tokens': float(np.mean(context_tokens)),
+        'scores': {name: float(np.mean(values)) for name,values in scores.items()},
+        'latency_sec': {
+            stage: {f'p{p}': float(np.percentile(values, p)) for p in PERCENTILES}
+            for stage,values in timings.items()
+        },
+    }
+
+    print(f'\n{report["questions"]} questions, {report["questions_per_sec"]:.2f} questions/s, '
+          f'setup {setup_time:.1f} s, {report["mean_context_tokens"]:.0f} context tokens on average')
+    for name,value in report['scores'].items():
+        print(f'{name:<20}{value:>8.3f}')
+    print(f'{"stage":<20}' + ''.join(f'{f"p{p} (s)":>10}' for p in PERCENTILES))
+    for stage,stats in report['latency_sec'].items():
+        print(f'{stage:<20}' + ''.join(f'{stats[f"p{p}"]:>10.3f}' for p in PERCENTILES))
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    # Regression gate
+    gates = [
+        (f'recall@{RECALL_KS[-1]}', args.min_recall),
+        ('mrr', args.min_mrr),
+        ('coverage', args.min_coverage),
+    ]
+    failed = [
+        f'{name} {report["scores"][name]:.3f} < {threshold}'
+        for name,threshold in gates
+        if threshold is not None and report['scores'][name]<threshold
+    ]
+    if len(failed)>0:
+        log.error(f'Retrieval benchmark failed: {", ".join(failed)}')
+        sys.exit(1)
+
+
+if __name__=='__main__':
+    main()
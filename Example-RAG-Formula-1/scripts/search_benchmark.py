@@ -0,0 +1,558 @@
+"""
+Benchmark the search stack on synthetic corpora of increasing size.
+
+The corpora are generated DocTrees shaped like the FIA regulations (articles
+with an introductory paragraph, numbered subsections and lettered items, about
+50 words per paragraph, split over several regulation files), so no documents
+or models are needed.  Embeddings are random unit vectors, or rows of a
+precomputed `.npy` file with `--embeddings`.  For each size this times:
+
+- `flatten_doctree`: flattening every DocTree into chunk texts (a `TextArena`)
+  and ids.
+- `cosine_search`: one query against all chunk embeddings.
+- `keyword_index_build` and `keyword_search`: BM25 over all chunks.
+- `rerank`: the top results with post-expansion, scored by a stub scorer so
+  only the reranking around the cross-encoder is measured.
+- `cosine_search_batch`, `keyword_search_batch` and `rerank_batch`: the same
+  with columnar results (`ResultBatch`) rather than `SearchResult` lists.
+- `result_to_string`: formatting the top results with their context.
+- `load_data`, `load_embeddings` and `load_keyword_index`: loading an index
+  bundle of the corpus (see `fiaregs.bundle`) from disk.
+
+Before timing, the columnar structures are checked against the list-based
+ones they replaced, on a small corpus: `TextArena` and `ChunkIds` must give the
+texts and ids of the original `utils.get_embeddings` flattening (with and
+without pre-expansion), and `ResultBatch` searches the ranking, scores, texts
+and thresholded results of the original `cosine_search` and `rerank`.  Any
+difference fails the run; `--check` runs only the check.
+
+Results are written as JSON, with the median, p95 and minimum of each timing.
+With `--baseline`, any benchmark more than `--max-slowdown` times slower than
+in the baseline fails the run:
+
+    python scripts/search_benchmark.py --sizes 10000 100000 --output bench.json
+    python scripts/search_benchmark.py --sizes 10000 100000 --baseline bench.json
+
+Building the keyword index dominates at 1M chunks (tens of minutes); leave it
+out with `--benchmarks` to time the rest.
+"""
+from pathlib import Path
+from typing import Callable
+import argparse
+import copy
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import fiaregs.search.embeddings as emb
+from fiaregs.bundle import Bundle, write_pickle, read_pickle
+from fiaregs.search.keyword_search import build_index, keyword_search, keyword_search_batch
+from fiaregs.search.semantic_search import cosine_search, cosine_search_batch, rerank, rerank_batch
+from fiaregs.search.utils import doctree
+from fiaregs.search.utils.arena import TextArena
+from fiaregs.search.utils.data_utils import ChunkIds, SearchResult, result_to_string
+
+
+# === Basic logger setup ===================================================
+logging.basicConfig(
+    stream=sys.stdout,
+    format='%(asctime)s %(message)s',
+    datefmt='%m/%d/%Y %H:%M:%S'
+)
+logging.getLogger(__name__).setLevel(logging.DEBUG)
+log = logging.getLogger(__name__)
+
+
+# === Configuration ========================================================
+
+SIZES = [10_000, 100_000, 1_000_000]
+BENCHMARKS = [
+    'flatten_doctree',
+    'cosine_search',
+    'cosine_search_batch',
+    'keyword_index_build',
+    'keyword_search',
+    'keyword_search_batch',
+    'rerank',
+    'rerank_batch',
+    'result_to_string',
+    'load_data',
+    'load_embeddings',
+    'load_keyword_index',
+]
+# Run once per size, as they take long and are not on the request path
+RUN_ONCE = ['keyword_index_build']
+
+EMBEDDING_DIM = 768
+TOP_K = 10
+REPEATS = 5
+SEED = 0
+N_FILES = 6
+QUERY = 'What happens if a car is under the minimum weight?'
+OUTPUT = Path('data/search_benchmark.json')
+PERCENTILES = [50, 95]
+CHECK_CHUNKS = 2_000
+CHECK_DIM = 64
+
+# Frequent words first, then a long tail of made-up words, drawn with Zipf's law
+COMMON_WORDS = (
+    'the of to and a in be shall or by for with any is on that as which must not '
+    'this from are at an if all its their each may other than such under after'
+).split()
+DOMAIN_WORDS = (
+    'car driver team race stewards penalty lap pit lane safety tyre fuel power unit '
+    'competitor session track flag time weight regulation article event grid start '
+    'qualifying championship fia document official speed engine brake wing chassis '
+    'deadline cost cap financial report marshal circuit clerk course sporting technical '
+    'minimum maximum season points classification protest appeal licence entry'
+).split()
+N_RARE_WORDS = 20_000
+SYLLABLES = 'ba ce di fo gu ka le mi no pu ra se ti vo zu tra ble ment tion'.split()
+
+
+# === Synthetic corpus =====================================================
+
+def make_vocabulary(rng: np.random.Generator) -> tuple[np.ndarray, np.ndarray]:
+    """Words and their probabilities."""
+    rare = {
+        ''.join(rng.choice(SYLLABLES, size=rng.integers(2, 5)))
+        for _ in range(N_RARE_WORDS)
+    }
+    words = COMMON_WORDS + DOMAIN_WORDS + sorted(rare - set(COMMON_WORDS + DOMAIN_WORDS))
+    weights = 1.0/(np.arange(len(words)) + 2.7)
+    return np.array(words), weights/weights.sum()
+
+
+def make_paragraphs(
+        n: int,
+        words: np.ndarray,
+        probabilities: np.ndarray,
+        rng: np.random.Generator
+    ) -> list[str]:
+    """Paragraphs of about 50 words (5 to 300)."""
+    lengths = np.clip(rng.lognormal(np.log(50), 0.5, size=n).astype(int), 5, 300)
+    drawn = words[rng.choice(len(words), size=int(lengths.sum()), p=probabilities)].tolist()
+    paragraphs = []
+    start = 0
+    for length in lengths:
+        paragraphs.append(' '.join(drawn[start:start + length]).capitalize() + '.')
+        start += length
+    return paragraphs
+
+
+def make_doctree(paragraphs: list[str], rng: np.random.Generator) -> doctree.DocTree:
+    """A DocTree shaped like a regulation, holding `paragraphs` in order.
+
+    Articles have an introductory paragraph and a list of numbered subsections;
+    some subsections have a list of lettered items."""
+    paragraphs = iter(paragraphs)
+    remaining = True
+
+    def take(n: int) -> list[str]:
+        nonlocal remaining
+        taken = [paragraph for _,paragraph in zip(range(n), paragraphs)]
+        remaining = len(taken)==n
+        return taken
+
+    doc_tree = []
+    article = 0
+    while remaining:
+        article += 1
+        contents = take(1)
+        if len(contents)==0:
+            break
+        doc_tree.append(doctree.Section(f'ARTICLE {article}: {contents[0].split(".")[0][:40].upper()}', contents))
+
+        subsections = []
+        for subsection in range(1, rng.integers(2, 12)):
+            contents = take(int(rng.integers(1, 5)))
+            if len(contents)==0:
+                break
+            subsections.append(doctree.Section(f'{article}.{subsection}', contents))
+            if rng.random()<0.3:
+                items = []
+                for item in 'abcdef'[:rng.integers(1, 7)]:
+                    contents = take(int(rng.integers(1, 3)))
+                    if len(contents)==0:
+                        break
+                    items.append(doctree.Section(f'{item})', contents))
+                if len(items)>0:
+                    subsections.append(items)
+        if len(subsections)>0:
+            doc_tree.append(subsections)
+
+    return doc_tree
+
+
+def make_corpus(n_chunks: int, rng: np.random.Generator) -> dict[str, doctree.DocTree]:
+    """DocTrees with `n_chunks` paragraphs in total, by regulation name."""
+    words, probabilities = make_vocabulary(rng)
+    paragraphs = make_paragraphs(n_chunks, words, probabilities, rng)
+    bounds = np.linspace(0, n_chunks, N_FILES + 1).astype(int)
+    return {
+        f'synthetic regulation {i + 1}': make_doctree(paragraphs[start:end], rng)
+        for i,(start,end) in enumerate(zip(bounds[:-1], bounds[1:]))
+    }
+
+
+def flatten(doc_trees: dict[str, doctree.DocTree]) -> tuple[TextArena, ChunkIds]:
+    """Flat texts and ids of the chunks, as `utils.get_embeddings` without pre-expansion."""
+    flat_texts, flat_ids = TextArena.from_doctrees(doc_trees, False)
+    return flat_texts, ChunkIds.from_tuples(flat_ids)
+
+
+def make_embeddings(
+        n_chunks: int,
+        dim: int,
+        rng: np.random.Generator,
+        embeddings_path: Path | None = None
+    ) -> np.ndarray:
+    """Unit-norm float32 embeddings, random or the first rows of a `.npy` file."""
+    if embeddings_path is not None:
+        embeddings = np.load(embeddings_path, mmap_mode='r')
+        if len(embeddings)<n_chunks:
+            raise SystemExit(f'{embeddings_path} has {len(embeddings)} rows, {n_chunks} are needed')
+        return np.ascontiguousarray(embeddings[:n_chunks], dtype=np.float32)
+
+    embeddings = np.empty((n_chunks, dim), dtype=np.float32)
+    for start in range(0, n_chunks, 100_000):
+        block = rng.standard_normal((min(100_000, n_chunks - start), dim), dtype=np.float32)
+        embeddings[start:start + len(block)] = block/np.linalg.norm(block, axis=1, keepdims=True)
+    return embeddings
+
+
+class StubScorer:
+    """Stands in for the cross-encoder: scores a pair by the length of its text."""
+
+    def predict(self, pairs: list[tuple[str, str]]) -> np.ndarray:
+        return np.array([len(text) for _,text in pairs], dtype=np.float32)
+
+
+# === Equivalence check ====================================================
+# The list-based flattening, search and reranking that the columnar structures
+# replaced, as they were
+
+def flatten_lists(doc_trees: dict[str, doctree.DocTree], pre_expand: bool) -> tuple[list[str], list[tuple]]:
+    """Flat texts and ids as lists, as the original `utils.get_embeddings`."""
+    flat_texts = []
+    flat_ids = []
+    for reg,doc_tree in doc_trees.items():
+        for ind,item in doctree.flatten_doctree(doc_tree):
+            items = doctree.expand(item, doc_tree, ind[:-1]) if pre_expand else [item]
+            flat_texts += items
+            flat_ids += [(reg,)+ind]*len(items)
+    return flat_texts, flat_ids
+
+
+def cosine_search_lists(query_emb, embeddings, ids: list[tuple], chunks: list[str], top_k: int) -> list[SearchResult]:
+    """The original `cosine_search`: a `SearchResult` per hit of `emb.query`."""
+    return [
+        SearchResult(
+            float(hit['score']),
+            ids[hit['corpus_id']][0],
+            ids[hit['corpus_id']][1:-1],
+            ids[hit['corpus_id']][-1],
+            hit['corpus_id'],
+            chunks[hit['corpus_id']]
+        )
+        for hit in emb.query(embeddings, query_emb, top_k)[0]
+    ]
+
+
+def rerank_lists(
+        inputs: list[SearchResult],
+        doc_trees: dict[str, doctree.DocTree],
+        query: str,
+        scorer: StubScorer,
+        post_expand: bool
+    ) -> list[SearchResult]:
+    """The original `rerank`: the best candidate of each result, one at a time."""
+    candidates = [
+        doctree.expand(result.text, doc_trees[result.file], result.tree_index) if post_expand else [result.text]
+        for result in inputs
+    ]
+    pairs = [(query, text) for texts in candidates for text in texts]
+    scores = scorer.predict(pairs) if len(pairs)>0 else []
+    start = 0
+    for result,texts in zip(inputs, candidates):
+        result_scores = scores[start:start + len(texts)]
+        start += len(texts)
+        best = max(range(len(texts)), key=lambda i: result_scores[i])
+        result.reranked_score = float(result_scores[best])
+        result.text = texts[best]
+    return sorted(inputs, key=lambda result: result.reranked_score, reverse=True)
+
+
+def result_rows(results: list[SearchResult]) -> list[tuple]:
+    """Everything but the scores, which are compared with a tolerance."""
+    return [
+        (result.file, result.tree_index, result.paragraph_index, result.chunk_id, result.text)
+        for result in results
+    ]
+
+
+def same_results(results: list[SearchResult], expected: list[SearchResult]) -> bool:
+    return (
+        result_rows(results)==result_rows(expected)
+        and np.allclose([r.similarity_score for r in results], [r.similarity_score for r in expected])
+        and np.allclose([r.reranked_score for r in results], [r.reranked_score for r in expected])
+    )
+
+
+def check_equivalence(n_chunks: int, dim: int) -> list[str]:
+    """Differences between the columnar and the list-based search on a synthetic corpus."""
+    import torch
+
+    rng = np.random.default_rng(SEED)
+    doc_trees = make_corpus(n_chunks, rng)
+    failed = []
+
+    for pre_expand in (False, True):
+        texts, ids = flatten_lists(doc_trees, pre_expand)
+        arena, arena_ids = TextArena.from_doctrees(doc_trees, pre_expand)
+        chunk_ids = ChunkIds.from_tuples(arena_ids)
+        if list(arena)!=texts or list(arena[10:20])!=texts[10:20]:
+            failed.append(f'TextArena texts (pre_expand={pre_expand})')
+        if list(chunk_ids)!=ids or list(chunk_ids[10:20])!=ids[10:20]:
+            failed.append(f'ChunkIds ids (pre_expand={pre_expand})')
+
+    texts, ids = flatten_lists(doc_trees, False)
+    arena, chunk_ids = flatten(doc_trees)
+    embeddings = torch.from_numpy(make_embeddings(len(texts), dim, rng))
+    query_emb = torch.from_numpy(make_embeddings(1, dim, rng)[0])
+    scorer = StubScorer()
+
+    expected = cosine_search_lists(query_emb, embeddings, ids, texts, TOP_K)
+    batch = cosine_search_batch(query_emb, embeddings, chunk_ids, arena, TOP_K)
+    if not same_results(batch.to_results(), expected):
+        failed.append('cosine_search_batch ranking')
+
+    threshold = float(np.median([result.similarity_score for result in expected]))
+    if not same_results(
+            batch.where(similarity_above=threshold).to_results(),
+            [result for result in expected if result.similarity_score>threshold]):
+        failed.append('ResultBatch.where(similarity_above)')
+
+    for post_expand in (False, True):
+        expected_reranked = rerank_lists(copy.deepcopy(expected), doc_trees, QUERY, scorer, post_expand)
+        reranked = rerank_batch(batch, doc_trees, QUERY, scorer, post_expand)
+        if not same_results(reranked.to_results(), expected_reranked):
+            failed.append(f'rerank_batch (post_expand={post_expand})')
+
+        threshold = float(np.median([result.reranked_score for result in expected_reranked]))
+        if not same_results(
+                reranked.where(reranked_above=threshold).to_results(),
+                [result for result in expected_reranked if result.reranked_score>threshold]):
+            failed.append(f'ResultBatch.where(reranked_above) (post_expand={post_expand})')
+
+    return failed
+
+
+# === Benchmarks ===========================================================
+
+def measure(func: Callable, repeats: int) -> list[float]:
+    """Elapsed seconds of `repeats` calls, after one warm-up call if repeating."""
+    if repeats>1:
+        func()
+    times = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start_time)
+    return times
+
+
+def summarize(times: list[float]) -> dict[str, float]:
+    stats = {f'p{p}_sec': float(np.percentile(times, p)) for p in PERCENTILES}
+    stats['min_sec'] = float(np.min(times))
+    stats['runs'] = len(times)
+    return stats
+
+
+def run_size(
+        n_chunks: int,
+        benchmarks: list[str],
+        repeats: int,
+        dim: int,
+        embeddings_path: Path | None,
+        work_dir: Path
+    ) -> dict[str, dict[str, float]]:
+    """Generate a corpus of `n_chunks` chunks and time the benchmarks on it."""
+    import torch
+
+    rng = np.random.default_rng(SEED)
+    start_time = time.perf_counter()
+    doc_trees = make_corpus(n_chunks, rng)
+    flat_texts, flat_ids = flatten(doc_trees)
+    embeddings_array = make_embeddings(n_chunks, dim, rng, embeddings_path)
+    embeddings = torch.from_numpy(embeddings_array)
+    query_emb = torch.from_numpy(make_embeddings(1, embeddings_array.shape[1], rng)[0])
+    log.info(f'Generated {n_chunks} chunks in {time.perf_counter() - start_time:.1f} s')
+
+    results = {}
+
+    def run(name: str, func: Callable) -> None:
+        if name not in benchmarks:
+            return
+        times = measure(func, 1 if name in RUN_ONCE else repeats)
+        results[name] = summarize(times)
+        log.info(f'{n_chunks} chunks, {name}: median {results[name]["p50_sec"]*1000:.2f} ms')
+
+    run('flatten_doctree', lambda: flatten(doc_trees))
+    run('cosine_search', lambda: cosine_search(query_emb, embeddings, flat_ids, flat_texts, TOP_K))
+    run('cosine_search_batch', lambda: cosine_search_batch(query_emb, embeddings, flat_ids, flat_texts, TOP_K))
+
+    keyword_index = None
+    needs_keyword_index = {'keyword_search', 'keyword_search_batch', 'load_keyword_index'} & set(benchmarks)
+    if 'keyword_index_build' in benchmarks or needs_keyword_index:
+        start_time = time.perf_counter()
+        keyword_index = build_index(flat_texts)
+        if 'keyword_index_build' in benchmarks:
+            results['keyword_index_build'] = summarize([time.perf_counter() - start_time])
+            log.info(f'{n_chunks} chunks, keyword_index_build: {results["keyword_index_build"]["p50_sec"]:.1f} s')
+    run('keyword_search', lambda: keyword_search(keyword_index, QUERY, flat_ids, flat_texts, TOP_K))
+    run('keyword_search_batch', lambda: keyword_search_batch(keyword_index, QUERY, flat_ids, flat_texts, TOP_K))
+
+    # rerank and result_to_string work on the top results of a search
+    top_results = cosine_search(query_emb, embeddings, flat_ids, flat_texts, TOP_K)
+    scorer = StubScorer()
+    # rerank changes the texts and scores of its inputs, so it gets a fresh copy each time
+    run('rerank', lambda: rerank(copy.deepcopy(top_results), doc_trees, QUERY, scorer, True))
+    top_batch = cosine_search_batch(query_emb, embeddings, flat_ids, flat_texts, TOP_K)
+    run('rerank_batch', lambda: rerank_batch(top_batch, doc_trees, QUERY, scorer, True))
+    run('result_to_string', lambda: [result_to_string(result, doc_trees) for result in top_results])
+
+    if {'load_data', 'load_embeddings', 'load_keyword_index'} & set(benchmarks):
+        bundle_dir = work_dir / f'bundle_{n_chunks}'
+        bundle_dir.mkdir()
+        write_pickle((doc_trees, [], []), bundle_dir / 'data.pkl')
+        write_pickle(flat_ids, bundle_dir / 'chunks.pkl')
+        flat_texts.save(bundle_dir)
+        np.save(bundle_dir / 'embeddings.npy', embeddings_array)
+        if keyword_index is not None:
+            write_pickle(keyword_index, bundle_dir / 'keyword_bm25.pkl')
+        bundle = Bundle(bundle_dir, {})
+        run('load_data', bundle.load_data)
+        run('load_embeddings', bundle.load_embeddings)
+        run('load_keyword_index', lambda: read_pickle(bundle_dir / 'keyword_bm25.pkl'))
+
+    return results
+
+
+def get_environment() -> dict:
+    """Where the benchmark ran, to compare like with like."""
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    import torch
+    return {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'torch': torch.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def compare(report: dict, baseline: dict, max_slowdown: float) -> list[str]:
+    """Benchmarks that are over `max_slowdown` times slower (by median) than in the baseline."""
+    failed = []
+    for size,results in report['results'].items():
+        for name,stats in results.items():
+            base = baseline['results'].get(size, {}).get(name)
+            if base is None or base['p50_sec']<=0:
+                continue
+            slowdown = stats['p50_sec']/base['p50_sec']
+            if slowdown>max_slowdown:
+                failed.append(f'{name} at {size} chunks {slowdown:.2f}x slower')
+    return failed
+
+
+def print_table(report: dict) -> None:
+    """Print the median time of each benchmark per size."""
+    sizes = list(report['results'])
+    names = list(dict.fromkeys(name for results in report['results'].values() for name in results))
+    print(f'{"benchmark (median ms)":<24}' + ''.join(f'{size:>14}' for size in sizes))
+    for name in names:
+        row = ''
+        for size in sizes:
+            stats = report['results'][size].get(name)
+            row += f'{"-":>14}' if stats is None else f'{stats["p50_sec"]*1000:>14.2f}'
+        print(f'{name:<24}' + row)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='Numbers of chunks')
+    parser.add_argument('--benchmarks', nargs='+', choices=BENCHMARKS, default=BENCHMARKS)
+    parser.add_argument('--repeats', type=int, default=REPEATS, help='Timed runs of each benchmark')
+    parser.add_argument('--dim', type=int, default=EMBEDDING_DIM, help='Dimension of random embeddings')
+    parser.add_argument('--embeddings', type=Path, default=None, help='Precomputed embeddings (.npy)')
+    parser.add_argument('--output', type=Path, default=OUTPUT, help='Write the report as JSON')
+    parser.add_argument('--baseline', type=Path, default=None, help='Report to compare against')
+    parser.add_argument('--max-slowdown', type=float, default=1.5, help='Fail if slower than the baseline by this factor')
+    parser.add_argument('--check', action='store_true', help='Only check the columnar search against the list-based one')
+    args = parser.parse_args()
+
+    # Equivalence gate: timings of wrong results mean nothing
+    failed = check_equivalence(CHECK_CHUNKS, CHECK_DIM)
+    if len(failed)>0:
+        log.error(f'Columnar search differs from the list-based search: {", ".join(failed)}')
+        sys.exit(1)
+    log.info(f'Columnar search matches the list-based search on {CHECK_CHUNKS} chunks')
+    if args.check:
+        return
+
+    # Read before the output is written, in case it is the same file
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+
+    report = {
+        'environment': get_environment(),
+        'config': {
+            'benchmarks': args.benchmarks,
+            'repeats': args.repeats,
+            'dim': args.dim,
+            'embeddings': None if args.embeddings is None else str(args.embeddings),
+            'top_k': TOP_K,
+            'seed': SEED,
+        },
+        'results': {},
+    }
+    with tempfile.TemporaryDirectory() as work_dir:
+        for n_chunks in args.sizes:
+            results = run_size(n_chunks, args.benchmarks, args.repeats, args.dim, args.embeddings, Path(work_dir))
+            # JSON keys are strings, so use strings throughout for comparisons with the baseline
+            report['results'][str(n_chunks)] = results
+
+    print_table(report)
+
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    log.info(f'Wrote {args.output}')
+
+    # Regression gate
+    if baseline is not None:
+        failed = compare(report, baseline, args.max_slowdown)
+        if len(failed)>0:
+            log.error(f'Search benchmark failed: {", ".join(failed)}')
+            sys.exit(1)
+
+
+if __name__=='__main__':
+    main()
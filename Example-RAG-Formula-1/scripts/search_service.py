@@ -0,0 +1,107 @@
+"""
+HTTP service for FIA regulation search (see `fiaregs.service` for the endpoints).
+
+    python scripts/search_service.py --port 8000 --workers 4 --max-queue 16
+
+    curl localhost:8000/ready
+    curl -X POST localhost:8000/summarize -d '{"query": "What is a Safety Car?"}'
+"""
+import os
+from pathlib import Path
+import argparse
+import logging
+import sys
+
+from aicore.llm.client import get_llm_client
+
+from fiaregs.config import (
+    DATA_DIR,
+    DOC_DIR,
+    REGS,
+    EMBEDDING_MODEL_NAME,
+    CROSS_ENCODER_NAME,
+    LLM_MODEL_NAME,
+    LLM_API_KEY,
+    PRE_EXPAND,
+    POST_EXPAND,
+    USE_DEFINITIONS,
+    TOP_K
+)
+from fiaregs import drivers
+from fiaregs.llm_cache import start_cached_chat
+from fiaregs.batching import BatchConfig
+from fiaregs.service import make_endpoints, make_server
+from fiaregs.trace import JsonlExporter, add_exporter
+
+
+# Suppress a runtime warning re: tokenizer parallelism and multiple threads.
+os.environ["TOKENIZERS_PARALLELISM"] = "false"
+
+# === Basic logger setup ===================================================
+logging.basicConfig(
+    stream=sys.stdout,
+    format='%(asctime)s %(message)s',
+    datefmt='%m/%d/%Y %H:%M:%S'
+)
+logging.getLogger(__name__).setLevel(logging.DEBUG)
+logging.getLogger('service').setLevel(logging.INFO)
+log = logging.getLogger(__name__)
+# ===================================================================
+
+# The documents, models and retrieval parameters are in `fiaregs.config`
+
+# Concurrent requests share query encoding and reranking forward passes
+BATCH_CONFIG = BatchConfig(max_batch_size=32, max_wait_ms=5.0)
+
+# See scripts/eval.py
+LLM_CACHE_MODE = 'passthrough'
+LLM_CACHE = DATA_DIR / 'llm_cache.jsonl'
+
+
+def load():
+    """Load models and indexes and make the service endpoints."""
+    api_client = None if LLM_CACHE_MODE=='replay' else get_llm_client(LLM_API_KEY)
+    llm_model = start_cached_chat(LLM_MODEL_NAME, api_client, None, LLM_CACHE, LLM_CACHE_MODE)
+
+    _, agentic_search, generate_response, retrieve = drivers.setup(
+        llm_model,
+        DATA_DIR,
+        DOC_DIR,
+        REGS,
+        PRE_EXPAND,
+        POST_EXPAND,
+        EMBEDDING_MODEL_NAME,
+        CROSS_ENCODER_NAME,
+        TOP_K,
+        USE_DEFINITIONS,
+        batch_config=BATCH_CONFIG,
+        return_retrieval=True
+    )
+    return make_endpoints(retrieve, agentic_search, generate_response)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=4, help='Requests handled at once')
+    parser.add_argument('--max-queue', type=int, default=16, help='Requests waiting for a worker before rejecting')
+    parser.add_argument('--timeout', type=float, default=120.0, help='Request timeout in seconds')
+    parser.add_argument('--spans', type=Path, default=None, help='Append tracing spans to this JSONL file')
+    args = parser.parse_args()
+
+    if args.spans is not None:
+        add_exporter(JsonlExporter(args.spans))
+
+    server = make_server(load, args.host, args.port, args.workers, args.max_queue, args.timeout)
+    log.info(f'Serving on http://{args.host}:{args.port} (loading models...)')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        log.info('Shutting down')
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
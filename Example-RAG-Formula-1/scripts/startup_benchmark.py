@@ -0,0 +1,136 @@
+"""
+Benchmark startup with and without the prebuilt index bundle.
+
+Each run is a fresh Python process that imports the search modules, loads the
+embedding model, loads the regulations, definitions, definition index and
+embeddings (from the documents and cached embeddings, or from the bundle) and
+runs one search.  Reports the median time of each phase over the runs:
+
+    python scripts/build_bundle.py
+    python scripts/startup_benchmark.py --runs 5
+
+The embeddings must already be cached (any driver run or `build_bundle.py`
+caches them).  The cross-encoder load is the same either way and is not
+included.
+"""
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from fiaregs.config import DATA_DIR, DOC_DIR, REGS, EMBEDDING_MODEL_NAME, TOP_K
+
+
+QUERY = 'What happens if a car is under the minimum weight?'
+
+MODES = ['documents', 'bundle']
+# Phases that the bundle replaces (the rest is the same in both modes)
+DATA_PHASES = ['bundle_manifest', 'data', 'definition_index', 'embeddings']
+TIMINGS_PREFIX = 'TIMINGS '
+
+
+def measure_startup(mode: str, pre_expand: bool, model_name: str) -> dict[str, float]:
+    """Time the startup phases in this process."""
+    timings = {}
+    start_time = time.perf_counter()
+
+    def lap(name: str):
+        nonlocal start_time
+        now = time.perf_counter()
+        timings[name] = now - start_time
+        start_time = now
+
+    # Imports are part of startup, so they are timed here rather than at the top
+    import fiaregs.search.embeddings as emb
+    from fiaregs import drivers
+    from fiaregs.bundle import open_bundle
+    from fiaregs.search.keyword_search import build_index
+    from fiaregs.search.semantic_search import cosine_search
+    from fiaregs.utils import get_embeddings
+    lap('imports')
+
+    model = emb.get_model(model_name)
+    lap('embedding_model')
+
+    if mode=='bundle':
+        bundle = open_bundle(DATA_DIR, DOC_DIR, REGS, pre_expand, model_name)
+        if bundle is None:
+            raise SystemExit('No bundle for these settings; run scripts/build_bundle.py first')
+        lap('bundle_manifest')
+        _, _, _ = bundle.load_data()
+        lap('data')
+        bundle.load_definition_index()
+        lap('definition_index')
+        embeddings, flat_texts, flat_ids = bundle.load_embeddings(model.device)
+        lap('embeddings')
+    else:
+        doc_trees, _, definitions_flat = drivers.load_data(DOC_DIR, REGS)
+        lap('data')
+        build_index(definitions_flat)
+        lap('definition_index')
+        run_dir = drivers.get_run_dir(DATA_DIR, pre_expand, model_name)
+        embeddings, flat_texts, flat_ids = get_embeddings(doc_trees, run_dir, model, pre_expand)
+        lap('embeddings')
+
+    cosine_search(emb.encode(QUERY, model), embeddings, flat_ids, flat_texts, TOP_K)
+    lap('first_search')
+
+    return timings
+
+
+def run_child(mode: str, pre_expand: bool, model_name: str) -> dict[str, float]:
+    """Measure startup in a fresh process."""
+    command = [sys.executable, __file__, '--child', mode, '--embedding-model', model_name]
+    if pre_expand:
+        command.append('--pre-expand')
+    output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+    line = [line for line in output.splitlines() if line.startswith(TIMINGS_PREFIX)][-1]
+    return json.loads(line.removeprefix(TIMINGS_PREFIX))
+
+
+def print_table(results: dict[str, list[dict[str, float]]]) -> None:
+    """Print the median time of each phase per mode."""
+    phases = list(dict.fromkeys(phase for runs in results.values() for run in runs for phase in run))
+    medians = {
+        mode: {phase: float(np.median([run.get(phase, 0.0) for run in runs])) for phase in phases}
+        for mode,runs in results.items()
+    }
+    for mode in medians:
+        medians[mode]['data_total'] = sum(medians[mode].get(phase, 0.0) for phase in DATA_PHASES)
+        medians[mode]['total'] = sum(medians[mode][phase] for phase in phases)
+
+    modes = list(medians)
+    print(f'{"phase (median s)":<20}' + ''.join(f'{mode:>12}' for mode in modes))
+    for phase in phases + ['data_total', 'total']:
+        print(f'{phase:<20}' + ''.join(f'{medians[mode][phase]:>12.3f}' for mode in modes))
+    if 'documents' in medians and 'bundle' in medians and medians['bundle']['data_total']>0:
+        speedup = medians['documents']['data_total']/medians['bundle']['data_total']
+        print(f'\nData loading is {speedup:.1f}x faster with the bundle')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=3, help='Fresh processes per mode')
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=MODES)
+    parser.add_argument('--pre-expand', action='store_true')
+    parser.add_argument('--embedding-model', default=EMBEDDING_MODEL_NAME)
+    parser.add_argument('--child', choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        timings = measure_startup(args.child, args.pre_expand, args.embedding_model)
+        print(TIMINGS_PREFIX + json.dumps(timings))
+        return
+
+    results = {
+        mode: [run_child(mode, args.pre_expand, args.embedding_model) for _ in range(args.runs)]
+        for mode in args.modes
+    }
+    print_table(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,274 @@
+"""Evaluate a grid of RAG configurations and compare quality, cost and latency.
+
+Every combination of the values in `SWEEP` (or in a JSON grid given with
+`--grid`) is applied on top of the `scripts/eval.py` configuration and
+evaluated on `data/eval_set.json`.  Configurations with the same run_id (the
+embedding model and pre-expansion setting that determine the cached
+embeddings) are grouped so that documents, models and embeddings are loaded
+once per worker process and shared through `fiaregs.registry`.  Groups run in
+parallel worker processes, and groups are split when there are fewer of them
+than processes (e.g. the default grid has a single run_id); the configurations
+of a group are evaluated concurrently.  The worker processes append to the
+same LLM response store, with a file lock (see `fiaregs.jsonl_store`).
+
+Results are checkpointed by configuration hash in the same place as
+`scripts/eval.py`, so configurations that have already been evaluated (by
+either script) are not rerun.
+
+    python scripts/sweep.py --processes 2 --output sweep_results.csv
+
+A grid file maps configuration keys to lists of values, e.g.
+
+    {"top_k": [5, 10, 20], "cross_encoder": [null, "cross-encoder/ms-marco-MiniLM-L-12-v2"]}
+"""
+import os
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import groupby, product
+import argparse
+import csv
+import json
+import logging
+import sys
+
+from datasets import Dataset
+
+from aicore.llm.client import get_llm_client
+
+from fiaregs import drivers
+from fiaregs.config import (
+    DATA_DIR,
+    LLM_API_KEY,
+    CROSS_ENCODER_NAME,
+    get_eval_config,
+    make_eval_driver
+)
+from fiaregs.llm_cache import start_cached_chat
+from fiaregs.eval_runner import (
+    TaskUsageTracker,
+    TokenBucket,
+    evaluate_examples,
+    summarize_checkpoint
+)
+from fiaregs.jsonl_store import Checkpoint
+from fiaregs.search.utils.data_utils import get_dict_hash
+
+
+# Suppress a runtime warning re: tokenizer parallelism and multiple threads.
+os.environ["TOKENIZERS_PARALLELISM"] = "false"
+
+# === Basic logger setup ===================================================
+logging.basicConfig(
+    stream=sys.stdout,
+    format='%(asctime)s %(message)s',
+    datefmt='%m/%d/%Y %H:%M:%S'
+)
+logging.getLogger(__name__).setLevel(logging.DEBUG)
+log = logging.getLogger(__name__)
+
+
+# === Configuration ========================================================
+
+EVAL_SET = DATA_DIR / 'eval_set.json'
+CHECKPOINT_DIR = DATA_DIR / 'eval_checkpoints'
+
+# The configuration each sweep point starts from (the one scripts/eval.py
+# evaluates, so that checkpoints are shared)
+BASE_CONFIG = get_eval_config()
+
+# Values to sweep over; every combination is evaluated
+SWEEP = {
+    'top_k': [5, 10],
+    'post_expand': [False, True],
+    'cross_encoder': [None, CROSS_ENCODER_NAME],
+}
+
+# Concurrency, rate limiting and retries, shared by all worker processes
+PROCESSES = 2
+THREADS_PER_PROCESS = 4
+REQUESTS_PER_MINUTE = 60
+MAX_RETRIES = 3
+RETRY_BACKOFF_SEC = 2.0
+
+# LLM responses are recorded to and replayed from LLM_CACHE: 'passthrough' (no
+# cache), 'record' (reuse stored responses, store new ones) or 'replay' (only
+# stored responses, no API calls)
+LLM_CACHE_MODE = 'passthrough'
+LLM_CACHE = DATA_DIR / 'llm_cache.jsonl'
+
+SUMMARY_COLUMNS = [
+    'completed',
+    'mean_score',
+    'mean_input_tokens',
+    'mean_generated_tokens',
+    'mean_llm_calls',
+    'mean_context_tokens',
+    'p50_latency_sec',
+    'p95_latency_sec',
+]
+
+
+def get_configs(sweep: dict[str, list]) -> list[dict]:
+    """Get the configuration for every combination of the sweep values."""
+    unknown = [key for key in sweep if key not in BASE_CONFIG]
+    if len(unknown)>0:
+        raise ValueError(f'Unknown configuration keys in sweep: {unknown}')
+    return [
+        {**BASE_CONFIG, **dict(zip(sweep.keys(), values))}
+        for values in product(*sweep.values())
+    ]
+
+
+def get_run_id(config: dict) -> str:
+    """The run_id of the cached embeddings that a configuration uses."""
+    return drivers.get_run_id(config['pre_expand'], config['embedding_model'])
+
+
+def run_group(configs: list[dict], requests_per_minute: float) -> list[dict]:
+    """Evaluate configurations that share a run_id, returning their summaries.
+
+    All drivers are created before any is evaluated so that they hold their
+    shared components in the registry until the whole group is done; the
+    configurations that are not already evaluated then run concurrently."""
+    eval_set = Dataset.from_json(str(EVAL_SET), field='eval_set')
+    if 'answer' in eval_set.column_names:
+        eval_set = eval_set.remove_columns('answer')
+
+    api_client = None if LLM_CACHE_MODE=='replay' else get_llm_client(LLM_API_KEY)
+    # Every LLM API call of this process, answering or grading, takes a token
+    rate_limiter = TokenBucket(requests_per_minute/60)
+    runs = []
+    for config in configs:
+        config_hash = get_dict_hash(config)
+        checkpoint = Checkpoint(CHECKPOINT_DIR / f'{config_hash}.jsonl')
+        if all(example['question'] in checkpoint for example in eval_set):
+            log.info(f'Configuration {config_hash} already evaluated')
+            runs.append((config, checkpoint, None, None, None))
+            continue
+
+        tracker = TaskUsageTracker(f'llm_tracker_{config_hash}')
+        llm_model = start_cached_chat(
+            config['llm_model'], api_client, tracker, LLM_CACHE, LLM_CACHE_MODE,
+            rate_limiter=rate_limiter
+        )
+        # Grading usage is attributed to the configuration's questions too
+        eval_model = start_cached_chat(
+            config['evaluator_model'], api_client, tracker, LLM_CACHE, LLM_CACHE_MODE,
+            rate_limiter=rate_limiter
+        )
+        search = make_eval_driver(config, llm_model)
+        runs.append((config, checkpoint, search, tracker, eval_model))
+
+    # The configurations are evaluated at the same time, sharing the process's threads
+    pending = [run for run in runs if run[2] is not None]
+    workers = max(1, THREADS_PER_PROCESS//max(1, len(pending)))
+
+    def evaluate_run(run: tuple) -> None:
+        config, checkpoint, search, tracker, eval_model = run
+        log.info(f'Evaluating configuration {get_dict_hash(config)}')
+        evaluate_examples(
+            eval_set,
+            search,
+            eval_model,
+            tracker,
+            checkpoint,
+            workers,
+            MAX_RETRIES,
+            RETRY_BACKOFF_SEC
+        )
+
+    if len(pending)>0:
+        with ThreadPoolExecutor(max_workers=len(pending)) as executor:
+            list(executor.map(evaluate_run, pending))
+
+    return [
+        {
+            'config': config,
+            'config_hash': get_dict_hash(config),
+            **summarize_checkpoint(eval_set, checkpoint)
+        }
+        for config,checkpoint,_,_,_ in runs
+    ]
+
+
+def split_groups(groups: list[list[dict]], processes: int) -> list[list[dict]]:
+    """Halve the largest groups until there is one for every process.
+
+    Each part loads its own components, so groups are only split to use
+    processes that would otherwise be idle."""
+    groups = list(groups)
+    while len(groups)<processes:
+        largest = max(groups, key=len)
+        if len(largest)<2:
+            break
+        groups.remove(largest)
+        half = (len(largest) + 1)//2
+        groups += [largest[:half], largest[half:]]
+    return groups
+
+
+def print_table(summaries: list[dict], keys: list[str]) -> None:
+    """Print the comparison table, best mean score first."""
+    columns = keys + SUMMARY_COLUMNS
+    rows = [
+        [summary['config'][key] for key in keys] + [summary.get(column) for column in SUMMARY_COLUMNS]
+        for summary in summaries
+    ]
+    rows = [
+        [f'{value:.3f}' if isinstance(value, float) else str(value) for value in row]
+        for row in rows
+    ]
+    widths = [max(len(cell) for cell in column) for column in zip(columns, *rows)]
+    for row in [columns] + rows:
+        print('  '.join(f'{cell:>{width}}' for cell,width in zip(row, widths)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--grid', type=Path, default=None, help='JSON file of values to sweep over')
+    parser.add_argument('--processes', type=int, default=PROCESSES)
+    parser.add_argument('--output', type=Path, default=None, help='Write the comparison table as CSV')
+    args = parser.parse_args()
+
+    sweep = SWEEP
+    if args.grid is not None:
+        with open(args.grid, 'r') as f:
+            sweep = json.load(f)
+    configs = get_configs(sweep)
+
+    # One group per run_id (split to use every process), each run in its own
+    # process; the API rate limit is split between the processes that run at
+    # the same time
+    configs = sorted(configs, key=get_run_id)
+    groups = [list(group) for _,group in groupby(configs, key=get_run_id)]
+    groups = split_groups(groups, args.processes)
+    processes = min(args.processes, len(groups))
+    log.info(f'Sweeping {len(configs)} configurations in {len(groups)} groups on {processes} processes')
+
+    summaries = []
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [
+            executor.submit(run_group, group, REQUESTS_PER_MINUTE/processes) for group in groups
+        ]
+        for future in futures:
+            summaries += future.result()
+    summaries = sorted(summaries, key=lambda summary: summary.get('mean_score', 0), reverse=True)
+
+    keys = list(sweep.keys())
+    print()
+    print_table(summaries, keys)
+
+    if args.output is not None:
+        with open(args.output, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['config_hash'] + keys + SUMMARY_COLUMNS)
+            for summary in summaries:
+                writer.writerow(
+                    [summary['config_hash']] +
+                    [summary['config'][key] for key in keys] +
+                    [summary.get(column) for column in SUMMARY_COLUMNS]
+                )
+
+
+if __name__=='__main__':
+    main()
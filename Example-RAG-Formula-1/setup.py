@@ -8,5 +8,6 @@ setup(
         f"aicore[search] @ {local_path}",
         "datasets",
         "gradio",
+        "tiktoken",
     ]
 )
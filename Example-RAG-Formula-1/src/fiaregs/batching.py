@@ -0,0 +1,215 @@
+"""Dynamic micro-batching of model calls from concurrent requests.
+
+A `MicroBatcher` collects items submitted by any number of threads and passes
+them to a batch function on a background thread.  A batch is started when its
+first request arrives and closes once it holds `max_batch_size` items or
+`max_wait_ms` has passed; each caller then gets the outputs for its own items.
+Under load this turns many batch-of-one forward passes into a few larger ones,
+at the cost of up to `max_wait_ms` extra latency per call.
+
+`BatchedEncoder` and `BatchedCrossEncoder` put a batcher in front of a
+SentenceTransformer and a CrossEncoder and keep their `encode` and `predict`
+interfaces, so they can be passed to the search functions unchanged.
+"""
+
+from typing import Any, Callable, Sequence
+from collections import Counter
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+import logging
+import queue
+import threading
+import time
+import weakref
+
+from fiaregs import trace
+from fiaregs import metrics
+
+log = logging.getLogger('search')
+
+BATCH_SIZE = metrics.histogram(
+    'fiaregs_batch_size', 'Items per micro-batch', ['batcher'], (1, 2, 4, 8, 16, 32, 64, 128, 256)
+)
+
+MAX_BATCH_SIZE = 32
+MAX_BATCH_WAIT_MS = 5.0
+
+
+@dataclass(frozen=True)
+class BatchConfig:
+    """Micro-batching settings."""
+    max_batch_size: int = MAX_BATCH_SIZE
+    max_wait_ms: float = MAX_BATCH_WAIT_MS
+
+
+@dataclass
+class Request:
+    """Items submitted by one caller and the future for their outputs."""
+    items: list
+    future: Future = field(default_factory=Future)
+    batch_size: int = 0
+
+
+_batchers: weakref.WeakSet = weakref.WeakSet()
+
+
+class MicroBatcher:
+    """Runs `process_batch` on batches of items collected from concurrent callers.
+
+    `process_batch` takes a list of items and returns a sequence of outputs (a
+    list, array or tensor) with one output per item, in order.  The background
+    thread stops when the batcher is garbage collected."""
+
+    def __init__(
+            self,
+            process_batch: Callable[[list], Sequence],
+            config: BatchConfig = BatchConfig(),
+            name: str = 'batch'
+        ):
+        self.config = config
+        self.name = name
+        self.batch_sizes: Counter = Counter()
+        self._lock = threading.Lock()
+        self._queue: queue.Queue[Request | None] = queue.Queue()
+        threading.Thread(
+            target=run_batches,
+            args=(self._queue, process_batch, config, self.batch_sizes, self._lock, name),
+            name=f'{name}-batcher',
+            daemon=True
+        ).start()
+        weakref.finalize(self, self._queue.put, None)
+        _batchers.add(self)
+
+    def __call__(self, items: list) -> Sequence:
+        """Get the outputs for `items`, waiting for their batch to run."""
+        request = Request(list(items))
+        self._queue.put(request)
+        outputs = request.future.result()
+        trace.count(f'{self.name}_batch_items', request.batch_size)
+        trace.count(f'{self.name}_batches')
+        return outputs
+
+    def stats(self) -> dict[str, Any]:
+        """Number of batches and items, and the distribution of batch sizes."""
+        with self._lock:
+            batch_sizes = dict(sorted(self.batch_sizes.items()))
+        batches = sum(batch_sizes.values())
+        items = sum(size*count for size,count in batch_sizes.items())
+        return {
+            'batches': batches,
+            'items': items,
+            'mean_batch_size': items/batches if batches>0 else 0.0,
+            'max_batch_size': max(batch_sizes, default=0),
+            'batch_sizes': batch_sizes,
+        }
+
+
+def collect_batch(requests_queue: queue.Queue, config: BatchConfig) -> list[Request | None]:
+    """Wait for a request, then gather more until the batch is full or the wait is over."""
+    requests = [requests_queue.get()]
+    if requests[0] is None:
+        return requests
+    n_items = len(requests[0].items)
+    deadline = time.monotonic() + config.max_wait_ms/1000
+    while n_items<config.max_batch_size:
+        remaining = deadline - time.monotonic()
+        if remaining<=0:
+            break
+        try:
+            request = requests_queue.get(timeout=remaining)
+        except queue.Empty:
+            break
+        requests.append(request)
+        if request is None:
+            break
+        n_items += len(request.items)
+    return requests
+
+
+def run_batch(
+        requests: list[Request],
+        process_batch: Callable[[list], Sequence],
+        batch_sizes: Counter,
+        lock: threading.Lock,
+        name: str
+    ) -> None:
+    """Process the items of several requests as one batch and resolve their futures."""
+    items = [item for request in requests for item in request.items]
+    with lock:
+        batch_sizes[len(items)] += 1
+    BATCH_SIZE.observe(len(items), batcher=name)
+    try:
+        outputs = process_batch(items) if len(items)>0 else []
+    except Exception as e:
+        log.exception(f'{name} batch of {len(items)} failed')
+        for request in requests:
+            request.future.set_exception(e)
+        return
+
+    start = 0
+    for request in requests:
+        request.batch_size = len(items)
+        request.future.set_result(outputs[start:start + len(request.items)])
+        start += len(request.items)
+
+
+def run_batches(
+        requests_queue: queue.Queue,
+        process_batch: Callable[[list], Sequence],
+        config: BatchConfig,
+        batch_sizes: Counter,
+        lock: threading.Lock,
+        name: str
+    ) -> None:
+    """Process batches of requests until a `None` is queued."""
+    while True:
+        requests = collect_batch(requests_queue, config)
+        stop = requests[-1] is None
+        requests = [request for request in requests if request is not None]
+        if len(requests)>0:
+            run_batch(requests, process_batch, batch_sizes, lock, name)
+        # Don't hold on to the requests (and their callers) while waiting
+        del requests
+        if stop:
+            return
+
+
+def all_stats() -> dict[str, dict[str, Any]]:
+    """Stats of every batcher in the process, by name."""
+    return {batcher.name: batcher.stats() for batcher in list(_batchers)}
+
+
+class BatchedEncoder:
+    """SentenceTransformer whose `encode` calls for tensors are micro-batched."""
+
+    def __init__(self, model, config: BatchConfig = BatchConfig(), name: str = 'encode'):
+        self.model = model
+        self.batcher = MicroBatcher(
+            lambda texts: model.encode(texts, convert_to_tensor=True, show_progress_bar=False),
+            config,
+            name
+        )
+
+    def encode(self, texts: str | list[str], convert_to_tensor: bool = False, **kwargs):
+        if not convert_to_tensor or len(kwargs.keys() - {'show_progress_bar'})>0:
+            return self.model.encode(texts, convert_to_tensor=convert_to_tensor, **kwargs)
+        if isinstance(texts, str):
+            return self.batcher([texts])[0]
+        return self.batcher(texts)
+
+
+class BatchedCrossEncoder:
+    """CrossEncoder whose `predict` calls are micro-batched."""
+
+    def __init__(self, model, config: BatchConfig = BatchConfig(), name: str = 'rerank'):
+        self.model = model
+        self.batcher = MicroBatcher(
+            lambda pairs: model.predict(pairs, show_progress_bar=False),
+            config,
+            name
+        )
+
+    def predict(self, pairs: list[tuple[str, str]], **kwargs):
+        if len(kwargs.keys() - {'show_progress_bar'})>0:
+            return self.model.predict(pairs, **kwargs)
+        return self.batcher(pairs)
@@ -0,0 +1,248 @@
+"""Prebuilt index bundles for fast startup.
+
+Without a bundle, startup parses the regulation YAML into DocTrees, loads the
+definitions, builds the definition BM25 index and flattens the DocTrees into
+the texts and ids matching the cached embeddings.  A bundle stores all of these
+already built, for one document set and embedding configuration:
+
+- `manifest.json`: format version, configuration, source file hashes and sizes.
+- `data.pkl`: the DocTrees, flat definitions and definition ids.
+- `chunks.pkl`: the flat regulation ids (as `ChunkIds`).
+- `texts_*.npy`: the flat regulation texts (as a `TextArena`), memory-mapped
+  when loaded.
+- `embeddings.npy`: the regulation embeddings, memory-mapped when loaded.
+- `definition_bm25.pkl`: the definition keyword index.
+
+Bundles live in `data_dir/bundles/<id>`, with the id a hash of the format
+version and configuration, so the drivers can find the bundle for their
+settings.  Nothing is read until it is needed, and a bundle whose sources have
+changed since it was built is ignored.
+"""
+
+from __future__ import annotations
+
+from typing import Any, TYPE_CHECKING
+from pathlib import Path
+import hashlib
+import json
+import logging
+import pickle
+import shutil
+import time
+
+import numpy as np
+
+from fiaregs.search.keyword_search import build_index
+from fiaregs.search.utils.arena import TextArena
+from fiaregs.search.utils.data_utils import ChunkIds, get_dict_hash
+from fiaregs.utils import load_regs, load_defs, get_embeddings
+
+if TYPE_CHECKING:
+    import torch
+
+log = logging.getLogger('setup')
+
+BUNDLE_VERSION = 3
+GLOSSARY_FILE = 'formula_one_glossary.defs'
+
+
+def get_bundle_config(reg_map: dict, pre_expand: bool, similarity_model_name: str) -> dict:
+    """Get the settings that determine a bundle."""
+    return {
+        'version': BUNDLE_VERSION,
+        'reg_map': reg_map,
+        'pre_expand': pre_expand,
+        'similarity_model_name': similarity_model_name
+    }
+
+
+def get_bundle_dir(data_dir: Path, reg_map: dict, pre_expand: bool, similarity_model_name: str) -> Path:
+    """Get the directory of the bundle for these settings."""
+    config = get_bundle_config(reg_map, pre_expand, similarity_model_name)
+    return data_dir / 'bundles' / get_dict_hash(config)
+
+
+def get_source_files(doc_dir: Path, reg_map: dict) -> list[Path]:
+    """Get the document files a bundle is built from."""
+    files = []
+    for filename in reg_map.values():
+        files.append(doc_dir / filename)
+        defs_file = doc_dir / filename.replace('yaml', 'defs')
+        if defs_file.exists():
+            files.append(defs_file)
+    files.append(doc_dir / GLOSSARY_FILE)
+    return files
+
+
+def get_file_hash(path: Path) -> str:
+    """sha256 of a file's contents."""
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def get_sources(doc_dir: Path, reg_map: dict) -> dict[str, str]:
+    """Hashes of the source files, by file name."""
+    return {path.name: get_file_hash(path) for path in get_source_files(doc_dir, reg_map)}
+
+
+def write_pickle(value: Any, path: Path) -> None:
+    with open(path, 'wb') as f:
+        pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def read_pickle(path: Path) -> Any:
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def build_bundle(
+        data_dir: Path,
+        doc_dir: Path,
+        reg_map: dict,
+        run_dir: Path,
+        model,
+        pre_expand: bool,
+        similarity_model_name: str
+    ) -> Path:
+    """Build the bundle for these settings and return its directory.
+
+    Embeddings are taken from (or cached in) `run_dir` as by the drivers.  The
+    bundle is written to a temporary directory and then moved into place, so
+    processes starting meanwhile never see a partial bundle."""
+    bundle_dir = get_bundle_dir(data_dir, reg_map, pre_expand, similarity_model_name)
+    build_dir = bundle_dir.with_name(bundle_dir.name + '.building')
+    if build_dir.exists():
+        shutil.rmtree(build_dir)
+    build_dir.mkdir(parents=True)
+
+    log.info('Loading regulations and definitions')
+    doc_trees = load_regs(reg_map, doc_dir)
+    definitions_flat, definition_ids = load_defs(reg_map, doc_dir)
+    write_pickle((doc_trees, definition_ids, definitions_flat), build_dir / 'data.pkl')
+
+    log.info('Building definition index')
+    write_pickle(build_index(definitions_flat), build_dir / 'definition_bm25.pkl')
+
+    log.info('Getting embeddings')
+    embeddings, flat_texts, flat_ids = get_embeddings(doc_trees, run_dir, model, pre_expand)
+    write_pickle(flat_ids, build_dir / 'chunks.pkl')
+    flat_texts.save(build_dir)
+    embeddings = embeddings.detach().cpu().numpy()
+    np.save(build_dir / 'embeddings.npy', embeddings)
+
+    manifest = {
+        **get_bundle_config(reg_map, pre_expand, similarity_model_name),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'sources': get_sources(doc_dir, reg_map),
+        'n_chunks': len(flat_texts),
+        'n_definitions': len(definitions_flat),
+        'embedding_shape': list(embeddings.shape),
+        'embedding_dtype': str(embeddings.dtype),
+        'files': {path.name: path.stat().st_size for path in sorted(build_dir.iterdir())}
+    }
+    with open(build_dir / 'manifest.json', 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    if bundle_dir.exists():
+        shutil.rmtree(bundle_dir)
+    build_dir.rename(bundle_dir)
+    log.info(f'Wrote bundle {bundle_dir}')
+
+    return bundle_dir
+
+
+class Bundle:
+    """A built bundle; each part is read from disk when first loaded."""
+
+    def __init__(self, bundle_dir: Path, manifest: dict):
+        self.bundle_dir = bundle_dir
+        self.manifest = manifest
+
+    def load_data(self) -> tuple[dict, list[tuple], list[str]]:
+        """DocTrees, definition ids and flat definitions (as `drivers.load_data`)."""
+        log.info(f'Loading regulations and definitions from {self.bundle_dir}')
+        return read_pickle(self.bundle_dir / 'data.pkl')
+
+    def load_definition_index(self):
+        """The definition BM25 index."""
+        return read_pickle(self.bundle_dir / 'definition_bm25.pkl')
+
+    def load_embeddings(self, device=None) -> tuple[torch.Tensor, TextArena, ChunkIds]:
+        """Embeddings, flat texts and flat ids (as `utils.get_embeddings`).
+
+        The embeddings are memory-mapped (copy on write) and the texts (read
+        only), so pages are only read as searches touch them; moving the
+        embeddings to another `device` reads them all."""
+        import torch
+
+        log.info(f'Loading embeddings from {self.bundle_dir}')
+        embeddings = torch.from_numpy(np.load(self.bundle_dir / 'embeddings.npy', mmap_mode='c'))
+        if device is not None and embeddings.device!=torch.device(device):
+            embeddings = embeddings.to(device)
+        flat_texts = TextArena.load(self.bundle_dir)
+        flat_ids = read_pickle(self.bundle_dir / 'chunks.pkl')
+        return embeddings, flat_texts, flat_ids
+
+
+def describe_other_bundles(data_dir: Path, config: dict) -> list[str]:
+    """Describe the bundles in `data_dir` by the settings in which they differ from `config`."""
+    others = []
+    for manifest_path in sorted((data_dir / 'bundles').glob('*/manifest.json')):
+        try:
+            with open(manifest_path, 'r') as f:
+                manifest = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            others.append(f'{manifest_path.parent.name} (unreadable manifest)')
+            continue
+        differences = [key for key,value in config.items() if manifest.get(key)!=value]
+        others.append(f'{manifest_path.parent.name} (differs in {", ".join(differences) or "nothing"})')
+    return others
+
+
+def open_bundle(
+        data_dir: Path,
+        doc_dir: Path,
+        reg_map: dict,
+        pre_expand: bool,
+        similarity_model_name: str
+    ) -> Bundle | None:
+    """Get the bundle for these settings, or None if there is no usable bundle.
+
+    Only the manifest is read here.  A bundle built from different source files
+    or by another format version is ignored with a warning, and so is the lack
+    of a bundle for these settings when there are bundles for others."""
+    bundle_dir = get_bundle_dir(data_dir, reg_map, pre_expand, similarity_model_name)
+    manifest_path = bundle_dir / 'manifest.json'
+    if not manifest_path.exists():
+        config = get_bundle_config(reg_map, pre_expand, similarity_model_name)
+        others = describe_other_bundles(data_dir, config)
+        if len(others)>0:
+            log.warning(
+                f'No bundle {bundle_dir.name} for these settings, loading from the documents; '
+                f'other bundles: {"; ".join(others)}'
+            )
+        else:
+            log.info(f'No bundle in {data_dir / "bundles"}, loading from the documents')
+        return None
+
+    try:
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+    except json.JSONDecodeError as e:
+        log.warning(f'Ignoring bundle {bundle_dir}: unreadable manifest ({e})')
+        return None
+    if manifest.get('version')!=BUNDLE_VERSION:
+        log.warning(f'Ignoring bundle {bundle_dir}: version {manifest.get("version")}, expected {BUNDLE_VERSION}')
+        return None
+    try:
+        sources = get_sources(doc_dir, reg_map)
+    except FileNotFoundError:
+        # Deployed with the bundle but without the documents
+        sources = manifest['sources']
+    changed = [name for name,file_hash in sources.items() if manifest['sources'].get(name)!=file_hash]
+    if len(changed)>0:
+        log.warning(f'Ignoring bundle {bundle_dir}: {", ".join(changed)} changed since it was built')
+        return None
+
+    log.info(f'Using bundle {bundle_dir}, built {manifest.get("created")}')
+    return Bundle(bundle_dir, manifest)
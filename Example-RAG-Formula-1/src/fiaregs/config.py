@@ -0,0 +1,76 @@
+"""Settings shared by the scripts.
+
+The document set, where documents and data are stored (relative to the
+project root, where the scripts are run from), the models, and the RAG
+configuration that `scripts/eval.py` evaluates and `scripts/sweep.py` varies
+(see `get_eval_config` and `make_eval_driver`).  Checkpoints are keyed on a
+hash of the configuration, so both scripts reuse each other's results.
+"""
+
+from pathlib import Path
+
+# Location where data will be stored and location/index of the documents to search
+DATA_DIR = Path('data')
+DOC_DIR = Path('data/docs')
+REGS = {
+    '2023 FIA Formula One Sporting Regulations': 'fia_2023_formula_1_sporting_regulations_-_issue_6_-_2023-08-31.yaml',
+    '2023 FIA International Sporting Code': '2023_international_sporting_code_fr-en_clean_9.01.2023.yaml',
+    '2023 FIA International Sporting Code, Appendix L, Chapter II': 'appendix_l_iii_2023_publie_le_20_juin_2023.yaml',
+    '2023 FIA International Sporting Code, Appendix L, Chapter IV': 'appendix_l_iv_2023_publie_le_20_juin_2023.yaml',
+    '2023 FIA Formula One Financial Regulations': 'fia_formula_1_financial_regulations_-_issue_16_-_2023-08-31.yaml',
+    '2023 FIA Formula One Technical Regulations': 'fia_2023_formula_1_technical_regulations_-_issue_7_-_2023-08-31.yaml'
+}
+
+# Models
+EMBEDDING_MODEL_NAME = 'all-mpnet-base-v2'
+CROSS_ENCODER_NAME = 'cross-encoder/ms-marco-MiniLM-L-12-v2'
+LLM_MODEL_NAME = 'gpt-4-0125-preview'
+LLM_API_KEY = 'OPENAI_API_KEY'
+EVALUATOR_MODEL_NAME = 'gpt-4o'
+
+# Evaluated retrieval parameters
+EVAL_DRIVER = 'driver_llm_with_agentic_search'
+PRE_EXPAND = False
+POST_EXPAND = True
+USE_DEFINITIONS = True
+TOP_K = 10
+
+
+def get_eval_config() -> dict:
+    """Everything that affects the answers and grades of an evaluation run."""
+    # drivers loads the search stack; importing the settings alone stays cheap
+    from fiaregs.drivers import MAX_CONTEXT_TOKENS
+
+    return {
+        'driver': EVAL_DRIVER,
+        'regs': REGS,
+        'pre_expand': PRE_EXPAND,
+        'post_expand': POST_EXPAND,
+        'use_definitions': USE_DEFINITIONS,
+        'top_k': TOP_K,
+        'embedding_model': EMBEDDING_MODEL_NAME,
+        'cross_encoder': CROSS_ENCODER_NAME,
+        'llm_model': LLM_MODEL_NAME,
+        'evaluator_model': EVALUATOR_MODEL_NAME,
+        'max_context_tokens': MAX_CONTEXT_TOKENS,
+    }
+
+
+def make_eval_driver(config: dict, llm_model):
+    """Create the RAG function for an evaluation configuration."""
+    from fiaregs import drivers
+
+    driver = getattr(drivers, config['driver'])
+    return driver(
+        llm_model,
+        DATA_DIR,
+        DOC_DIR,
+        config['regs'],
+        config['pre_expand'],
+        config['post_expand'],
+        config['embedding_model'],
+        config['cross_encoder'],
+        config['top_k'],
+        include_definitions=config['use_definitions'],
+        max_context_tokens=config['max_context_tokens']
+    )
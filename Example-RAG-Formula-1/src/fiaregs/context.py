@@ -0,0 +1,243 @@
+"""Token-budgeted assembly of LLM context from search results.
+
+Expanded search results (see `result_to_string`) include the supersection and
+subsection paragraphs around each hit, so neighbouring hits frequently repeat
+whole paragraphs.  Here each result is rendered from the text it carries (the
+text that was scored, possibly expanded by `rerank` or pre-expansion) and the
+context paragraphs from the DocTrees that it does not already include, every
+paragraph is emitted at most once, and results are added in score order until
+a token budget is filled.
+
+Tokens are counted with tiktoken.  Its encodings are downloaded on first use
+and cached (in `TIKTOKEN_CACHE_DIR`, if set); where that is not possible, e.g.
+when replaying offline, counts fall back to an estimate from the text length.
+"""
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+from dataclasses import dataclass
+from functools import lru_cache
+import logging
+
+from fiaregs.search.utils import tree
+import fiaregs.search.utils.doctree as doctree
+from fiaregs.search.utils.data_utils import (
+    SearchResult,
+    get_section_headings
+)
+
+if TYPE_CHECKING:
+    import tiktoken
+
+log = logging.getLogger('search')
+
+
+TOKENIZER_MODEL = 'gpt-4'
+FALLBACK_ENCODING = 'cl100k_base'
+# Characters per token for the estimate used when no encoding can be loaded
+CHARS_PER_TOKEN = 4
+REG_DIVIDER = '\n\n---\n\n'
+DEF_DIVIDER = '\n\n'
+
+ParagraphKey = tuple[str, tuple, int]
+
+
+@dataclass
+class PackedContext:
+    """Regulation and definition texts that fit within a token budget.
+
+    `unpacked_tokens` adds what packing cut (repeated paragraphs, duplicate and
+    dropped results, and definitions over budget) to `tokens`."""
+    regulations: str
+    definitions: str
+    tokens: int
+    unpacked_tokens: int
+    n_results: int
+    n_duplicates: int
+    n_dropped: int
+    n_definitions: int
+
+    @property
+    def tokens_saved(self) -> int:
+        return self.unpacked_tokens - self.tokens
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model_name: str = TOKENIZER_MODEL) -> tiktoken.Encoding | None:
+    """Get (and cache) the tokenizer used to count context tokens.
+
+    None if it cannot be loaded, e.g. without network access on first use."""
+    try:
+        import tiktoken
+        try:
+            return tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            return tiktoken.get_encoding(FALLBACK_ENCODING)
+    except Exception as e:
+        log.warning(
+            f'Could not load the tokenizer for {model_name} ({type(e).__name__}: {e}); '
+            f'estimating tokens as {CHARS_PER_TOKEN} characters each'
+        )
+        return None
+
+
+def count_tokens(text: str, model_name: str = TOKENIZER_MODEL) -> int:
+    """Count the tokens in a string."""
+    encoding = get_encoding(model_name)
+    if encoding is None:
+        return -(-len(text)//CHARS_PER_TOKEN)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def result_score(result: SearchResult) -> float:
+    """The score results are ranked by: reranked if available, else similarity."""
+    if result.reranked_score!=-1000:
+        return result.reranked_score
+    return result.similarity_score
+
+
+def get_paragraph(doc_tree: doctree.DocTree, ind: tuple, paragraph: int) -> str | None:
+    """Get a paragraph from the contents of the section at `ind`."""
+    section = tree.get_from_tree(doc_tree, ind)
+    if not isinstance(section, doctree.Section):
+        return None
+    if paragraph<0 or paragraph>=len(section.contents):
+        return None
+    return section.contents[paragraph]
+
+
+def result_paragraphs(
+        result: SearchResult,
+        doc_trees: dict[str, doctree.DocTree]
+    ) -> list[tuple[ParagraphKey, str | None, bool]]:
+    """Get the paragraphs that make up an expanded result, in reading order.
+
+    Each item is `(key, text, is_hit)` where `key` identifies the paragraph
+    within the DocTrees.  The hit's text is the result's own text, i.e. what was
+    scored.  When that text already includes the supersection or subsection
+    paragraph (expanded by `rerank` or pre-expansion), the paragraph's text is
+    None, so it is not repeated but its key still counts as included."""
+    file = result.file
+    doc_tree = doc_trees[file]
+    section_ind = result.tree_index
+
+    hit_text = result.text
+    paragraphs = [((file, section_ind, result.paragraph_index), hit_text, True)]
+
+    super_ind = tree.move_up(section_ind)
+    super_section = tree.get_from_tree(doc_tree, super_ind)
+    if isinstance(super_section, doctree.Section) and len(super_section.contents)>0:
+        last = len(super_section.contents) - 1
+        super_text = super_section.contents[last]
+        included = hit_text.startswith(super_text + ' ')
+        paragraphs.insert(
+            0, ((file, super_ind, last), None if included else super_text, False)
+        )
+
+    sub_ind = tree.move_down(section_ind)
+    sub_text = get_paragraph(doc_tree, sub_ind, 0)
+    if sub_text is not None:
+        included = hit_text.endswith(' ' + sub_text)
+        paragraphs.append(((file, sub_ind, 0), None if included else sub_text, False))
+
+    return paragraphs
+
+
+def format_paragraphs(
+        result: SearchResult,
+        doc_trees: dict[str, doctree.DocTree],
+        paragraphs: list[tuple[ParagraphKey, str | None, bool]]
+    ) -> str:
+    """Format a result from its paragraphs, matching `result_to_string`."""
+    section_headings = get_section_headings(doc_trees[result.file], result.tree_index)
+    text = '\n\n'.join(
+        f'**{text}**' if is_hit else text for _,text,is_hit in paragraphs if text is not None
+    )
+    return (
+        f'{result.file.title()} Regulation: {", ".join(section_headings)}\n\n'
+        f'{text}\n'
+    )
+
+
+def pack_context(
+        regulation_results: list[SearchResult],
+        definitions: list[str],
+        doc_trees: dict[str, doctree.DocTree],
+        max_tokens: int | None = None,
+        definition_share: float = 0.25
+    ) -> PackedContext:
+    """Assemble regulation and definition texts within a token budget.
+
+    Definitions are taken in the order given, up to `definition_share` of the
+    budget.  Regulation results then fill the remaining budget in score order,
+    skipping results whose hit paragraph has already been included and omitting
+    context paragraphs that have already been included.  With `max_tokens=None`
+    results are only deduplicated.
+    """
+    budget = float('inf') if max_tokens is None else max_tokens
+    reg_divider_tokens = count_tokens(REG_DIVIDER)
+    def_divider_tokens = count_tokens(DEF_DIVIDER)
+
+    # Definitions
+    definition_budget = budget*definition_share
+    definition_texts = []
+    definition_tokens = 0
+    # Tokens of everything packing leaves out, for `unpacked_tokens`
+    cut_tokens = 0
+    for definition in definitions:
+        tokens = count_tokens(definition) + (def_divider_tokens if definition_texts else 0)
+        if definition_tokens+tokens>definition_budget:
+            cut_tokens += tokens
+            continue
+        definition_texts.append(definition)
+        definition_tokens += tokens
+
+    # Regulations
+    regulation_budget = budget - definition_tokens
+    regulation_texts = []
+    regulation_tokens = 0
+    seen: set[ParagraphKey] = set()
+    n_duplicates, n_dropped = 0, 0
+    for result in sorted(regulation_results, key=result_score, reverse=True):
+        paragraphs = result_paragraphs(result, doc_trees)
+        hit_key = next(key for key,_,is_hit in paragraphs if is_hit)
+        if hit_key in seen:
+            n_duplicates += 1
+            cut_tokens += count_tokens(format_paragraphs(result, doc_trees, paragraphs)) + reg_divider_tokens
+            continue
+
+        # Repeated paragraphs (and their separators, one token each) are counted
+        # on their own, rather than formatting and counting the whole result again
+        cut_tokens += sum(
+            count_tokens(text) + 1 for key,text,_ in paragraphs if key in seen and text is not None
+        )
+        paragraphs = [item for item in paragraphs if item[0] not in seen]
+        text = format_paragraphs(result, doc_trees, paragraphs)
+        tokens = count_tokens(text) + (reg_divider_tokens if regulation_texts else 0)
+        if regulation_tokens+tokens>regulation_budget:
+            n_dropped += 1
+            cut_tokens += tokens
+            continue
+
+        regulation_texts.append(text)
+        regulation_tokens += tokens
+        seen.update(key for key,_,_ in paragraphs)
+
+    packed = PackedContext(
+        regulations=REG_DIVIDER.join(regulation_texts),
+        definitions=DEF_DIVIDER.join(definition_texts),
+        tokens=regulation_tokens + definition_tokens,
+        unpacked_tokens=regulation_tokens + definition_tokens + cut_tokens,
+        n_results=len(regulation_texts),
+        n_duplicates=n_duplicates,
+        n_dropped=n_dropped,
+        n_definitions=len(definition_texts)
+    )
+    log.info(
+        f'Packed context: {packed.tokens} tokens ({packed.tokens_saved} saved), '
+        f'{packed.n_results} results, {packed.n_duplicates} duplicates, '
+        f'{packed.n_dropped} dropped, {packed.n_definitions} definitions'
+    )
+
+    return packed
@@ -0,0 +1,68 @@
+"""Per-request latency budgets.
+
+A `Deadline` is created for each request and passed through the search
+closures.  Stages check how much time is left and shrink or skip work when it
+runs short, recording each degradation on the deadline so that the caller can
+see what was applied to the response.
+"""
+
+from dataclasses import dataclass, field
+import logging
+import threading
+import time
+
+log = logging.getLogger('search')
+
+
+@dataclass
+class Deadline:
+    """Time budget for one request, in seconds (None for no limit)."""
+    budget_sec: float | None = None
+    start_time: float = field(default_factory=time.perf_counter)
+    degradations: list[str] = field(default_factory=list)
+
+    def elapsed(self) -> float:
+        """Seconds since the request started."""
+        return time.perf_counter() - self.start_time
+
+    def remaining(self) -> float:
+        """Seconds left in the budget."""
+        if self.budget_sec is None:
+            return float('inf')
+        return self.budget_sec - self.elapsed()
+
+    def expired(self) -> bool:
+        """Whether the budget has been used up."""
+        return self.remaining()<=0
+
+    def affordable(self, cost_per_item: float, n_items: int, parallelism: int = 1) -> int:
+        """How many of `n_items` can be processed in the remaining time."""
+        remaining = self.remaining()
+        if remaining==float('inf'):
+            return n_items
+        if remaining<=0:
+            return 0
+        if cost_per_item<=0:
+            return n_items
+        return min(n_items, int(parallelism*remaining/cost_per_item))
+
+    def degrade(self, degradation: str) -> None:
+        """Record that a stage reduced its work."""
+        self.degradations.append(degradation)
+        log.info(f'Degraded ({self.remaining():.3f}s left): {degradation}')
+
+
+class CostEstimate:
+    """Exponentially weighted moving average of the time per item of a stage."""
+
+    def __init__(self, initial_sec: float, weight: float = 0.2):
+        self.per_item = initial_sec
+        self.weight = weight
+        self._lock = threading.Lock()
+
+    def update(self, elapsed_sec: float, n_items: int) -> None:
+        """Update the estimate with a measurement over `n_items` items."""
+        if n_items<=0:
+            return
+        with self._lock:
+            self.per_item += self.weight*(elapsed_sec/n_items - self.per_item)
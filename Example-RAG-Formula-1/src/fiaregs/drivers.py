@@ -3,21 +3,33 @@ import re
 import json
 import logging
 import sys
+import time
+import weakref
 from pathlib import Path
 from typing import Callable
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 
-from sentence_transformers import CrossEncoder
-
-from aicore.llm import openaiapi as openai
+from aicore.llm.messages import SystemMessage, UserMessage, ToolMessage
 import fiaregs.search.embeddings as emb
 
-from fiaregs.search.semantic_search import cosine_search, rerank
-from fiaregs.search.keyword_search import keyword_search, build_index
+from fiaregs.search.semantic_search import cosine_search_batch, rerank_batch
+from fiaregs.search.keyword_search import keyword_search_batch, build_index
 from fiaregs.search.utils.data_utils import (
-    result_to_string,
+    ResultBatch,
+    SearchResult,
     get_dict_hash,
     reciprocal_rank_fusion)
 from fiaregs.text_utils import get_capitalized_phrases
+from fiaregs.context import PackedContext, pack_context
+from fiaregs.memo import memoize_functions
+from fiaregs import registry
+from fiaregs.executor import Stage, run_stages, fan_out, format_timings
+from fiaregs.deadline import Deadline, CostEstimate
+from fiaregs.batching import BatchConfig, BatchedEncoder, BatchedCrossEncoder
+from fiaregs.bundle import Bundle, open_bundle
+from fiaregs import trace
+from fiaregs import metrics
 
 from fiaregs.utils import (
     load_regs,
@@ -36,6 +48,27 @@ log = logging.getLogger('setup')
 
 REG_DIVIDER = '\n\n---\n\n'
 MAX_LLM_CALLS_PER_INTERACTION = 5
+MAX_CONTEXT_TOKENS = 6000
+MAX_SEARCH_WORKERS = 4
+MAX_STAGE_WORKERS = 4
+
+# Initial cost estimates used for latency budgets, refined as requests are served
+RERANK_SEC_PER_PAIR = 0.02
+DEFINITION_SEARCH_SEC = 0.01
+EXPANDED_PAIRS_PER_RESULT = 4
+
+CANDIDATES = metrics.histogram(
+    'fiaregs_candidates', 'Regulation candidates per search', buckets=metrics.COUNT_BUCKETS
+)
+REGULATION_RESULTS = metrics.histogram(
+    'fiaregs_regulation_results', 'Regulation results per search after thresholds', buckets=metrics.COUNT_BUCKETS
+)
+INDEX_BYTES = metrics.gauge('fiaregs_index_bytes', 'Memory used by loaded indexes', ['index', 'run_id'])
+
+REPEATED_QUESTION_NOTE = (
+    'This query repeats the original question, so its results are already included '
+    'above.  Rephrase or refine the query to get new results.'
+)
 
 SYSTEM_MESSAGE_BASE = (
     'You are an assitant to a Formula 1 team.  Your job is to answer team questions '
@@ -75,34 +108,90 @@ def load_data(doc_dir: Path, reg_map: dict):
     return doc_trees, definition_ids, definitions_flat
 
 
+def acquire_data(doc_dir: Path, reg_map: dict, bundle: Bundle | None = None) -> tuple[tuple, tuple]:
+    """Get the loaded data for a document set from the registry.
+
+    Returns the registry key (to be released by the caller) and the data."""
+    data_key = ('data', str(doc_dir), get_dict_hash(reg_map))
+    factory = (lambda: load_data(doc_dir, reg_map)) if bundle is None else bundle.load_data
+    source = 'documents' if bundle is None else 'bundle'
+    data = registry.acquire(data_key, trace.traced('load_data', factory, source=source))
+    return data_key, data
+
+
+def acquire_embedding_model(similarity_model_name: str) -> tuple[tuple, emb.Model]:
+    """Get the embedding model from the registry.
+
+    Returns the registry key (to be released by the caller) and the model."""
+    model_key = ('embedding_model', similarity_model_name)
+    model = registry.acquire(
+        model_key,
+        trace.traced('load_model', lambda: emb.get_model(similarity_model_name), model=similarity_model_name)
+    )
+    return model_key, model
+
+
+def get_run_config(pre_expand: bool, similarity_model_name: str) -> dict:
+    """Get the settings that determine the cached embeddings."""
+    return {
+        'pre_expand': pre_expand,
+        'similarity_model_name': similarity_model_name
+    }
+
+
+def get_run_id(pre_expand: bool, similarity_model_name: str) -> str:
+    """Get the id of the cached embeddings for these settings."""
+    return get_dict_hash(get_run_config(pre_expand, similarity_model_name))
+
+
+def get_run_dir(data_dir: Path, pre_expand: bool, similarity_model_name: str) -> Path:
+    """Get (and create if needed) the directory for cached embeddings."""
+    config = get_run_config(pre_expand, similarity_model_name)
+    run_id = get_dict_hash(config)
+    run_dir = data_dir / Path(str(run_id))
+    if not run_dir.exists():
+        run_dir.mkdir(parents=True)
+        with open(run_dir / 'config.json', 'w') as f:
+            json.dump(config, f)
+
+    return run_dir
+
+
 ## Search functions
 
 
 def make_definition_search(
         definition_ids,
-        definitions_flat
+        definitions_flat,
+        bundle: Bundle | None = None
     ) -> Callable[[str], list[str]]:
 
-    definition_bm25 = build_index(definitions_flat)
+    index_key = ('definition_bm25', get_dict_hash(definitions_flat))
+    factory = (lambda: build_index(definitions_flat)) if bundle is None else bundle.load_definition_index
+    definition_bm25 = registry.acquire(index_key, factory)
 
     # Wrapper functions for search and generation
     def search_definitions(query: str) -> list[str]:
         """Do a keyword search over definitions."""
         log.info(f'Searching definitions: {query[:20]}...')
-        results = keyword_search(
-            definition_bm25,
-            query,
-            definition_ids,
-            definitions_flat,
-            5
-        )
+        trace.count('definition_searches')
+        with trace.stage('definition_search', top_k=5):
+            results = keyword_search_batch(
+                definition_bm25,
+                query,
+                definition_ids,
+                definitions_flat,
+                5
+            )
 
         results = [
-            f'{defn_hit.text} (from {defn_hit.file})' for defn_hit in results
+            f'{results.text(row)} (from {results.file(row)})' for row in range(len(results))
         ]
 
         return results
 
+    registry.release_with(search_definitions, [index_key])
+
     return search_definitions
 
 
@@ -113,101 +202,308 @@ def make_regulation_search(
         cross_encoder_name,
         pre_expand,
         post_expand,
-        top_k
+        top_k,
+        batch_config: BatchConfig | None = None,
+        bundle: Bundle | None = None
     ) -> Callable[[str], list[str]]:
+    """Make a regulation search function.
+
+    With a `batch_config`, query encoding and reranking calls from concurrent
+    searches are micro-batched (see `fiaregs.batching`).  With a `bundle`, the
+    embeddings and flat texts are loaded from it (see `fiaregs.bundle`)."""
 
     log.info('Getting encodings for regs')
-    model = emb.get_model(similarity_model_name)
+    model_key, model = acquire_embedding_model(similarity_model_name)
 
-    embeddings, flat_texts, flat_ids = get_embeddings(
-        doc_trees,
-        embedding_path,
-        model,
+    embeddings_key = (
+        'embeddings',
+        str(embedding_path),
+        get_dict_hash(sorted(doc_trees.keys())),
         pre_expand
     )
+    embeddings, flat_texts, flat_ids = registry.acquire(
+        embeddings_key,
+        trace.traced(
+            'load_embeddings',
+            lambda: (
+                get_embeddings(doc_trees, embedding_path, model, pre_expand) if bundle is None
+                else bundle.load_embeddings(model.device)
+            ),
+            source='documents' if bundle is None else 'bundle'
+        )
+    )
     log.info(f'Embeddings -- {type(embeddings)} -- {embeddings.shape}')
+    # Drivers with different settings in one process each load their own indexes
+    run_id = get_run_id(pre_expand, similarity_model_name)
+    INDEX_BYTES.set(embeddings.element_size()*embeddings.nelement(), index='embeddings', run_id=run_id)
+    INDEX_BYTES.set(flat_texts.nbytes, index='chunk_texts', run_id=run_id)
+    INDEX_BYTES.set(flat_ids.nbytes, index='chunk_ids', run_id=run_id)
+    registry_keys = [model_key, embeddings_key]
+
+    query_model = model
+    if batch_config is not None:
+        batched_model_key = ('batched_embedding_model', similarity_model_name, batch_config)
+        query_model = registry.acquire(
+            batched_model_key, lambda: BatchedEncoder(model, batch_config)
+        )
+        registry_keys.append(batched_model_key)
 
     rerank_flag = cross_encoder_name is not None
     if rerank_flag:
-        rerank_model = CrossEncoder(cross_encoder_name)
+        rerank_key = ('cross_encoder', cross_encoder_name)
+        rerank_model = registry.acquire(
+            rerank_key,
+            trace.traced('load_model', lambda: emb.get_cross_encoder(cross_encoder_name), model=cross_encoder_name)
+        )
+        registry_keys.append(rerank_key)
+        if batch_config is not None:
+            batched_rerank_key = ('batched_cross_encoder', cross_encoder_name, batch_config)
+            cross_encoder = rerank_model
+            rerank_model = registry.acquire(
+                batched_rerank_key, lambda: BatchedCrossEncoder(cross_encoder, batch_config)
+            )
+            registry_keys.append(batched_rerank_key)
+
+    rerank_cost = CostEstimate(RERANK_SEC_PER_PAIR)
+
+    def search_regulations(query: str, deadline: Deadline | None = None) -> list[SearchResult]:
+        """Search regulation embeddings.
+
+        When the `deadline` is short, reranking is reduced: first post-expansion is
+        skipped, then only the top results are reranked, then reranking is skipped."""
+        with trace.span('regulation_search', top_k=top_k) as search_span:
+            deadline = Deadline() if deadline is None else deadline
+            log.info(f'Searching regulations: {query[:20]}...')
+            trace.count('regulation_searches')
+            with trace.stage('encode'):
+                query_emb = emb.encode(query, query_model)
+
+            with trace.stage('cosine_search', top_k=top_k):
+                results = cosine_search_batch(query_emb, embeddings, flat_ids, flat_texts, top_k)
+            trace.count('candidates', len(results))
+            CANDIDATES.observe(len(results))
+            reranked, not_reranked = results.take(slice(0, 0)), results
+            if rerank_flag:
+                expand = post_expand
+                pairs_per_result = EXPANDED_PAIRS_PER_RESULT if expand else 1
+                n_rerank = deadline.affordable(rerank_cost.per_item*pairs_per_result, len(results))
+                if expand and n_rerank<len(results):
+                    expand = False
+                    pairs_per_result = 1
+                    n_rerank = deadline.affordable(rerank_cost.per_item, len(results))
+                    deadline.degrade('skip_post_expand')
+                if n_rerank==0:
+                    deadline.degrade('skip_rerank')
+                elif n_rerank<len(results):
+                    deadline.degrade(f'rerank_top_{n_rerank}')
+
+                if n_rerank>0:
+                    start_time = time.perf_counter()
+                    with trace.stage('rerank', candidates=n_rerank, post_expand=expand):
+                        reranked = rerank_batch(
+                            results.take(slice(0, n_rerank)), doc_trees, query, rerank_model, post_expand=expand
+                        )
+                    rerank_cost.update(time.perf_counter() - start_time, n_rerank*pairs_per_result)
+                    trace.count('reranked', n_rerank)
+                not_reranked = results.take(slice(n_rerank, None))
+
+            # Apply a threshold to results
+            results = ResultBatch.concat([
+                reranked.where(reranked_above=-2),
+                not_reranked.where(similarity_above=0.3)
+            ]).to_results()
+            log.debug(f'Found {len(results)} regulation results.')
+            search_span.set(results=len(results), degradations=list(deadline.degradations))
+            trace.count('regulation_results', len(results))
+            REGULATION_RESULTS.observe(len(results))
+            trace.record('chunk_ids', [result.chunk_id for result in results])
 
-    def search_regulations(query: str) -> list[str]:
-        """Search regulation embeddings."""
-        log.info(f'Searching regulations: {query[:20]}...')
-        query_emb = emb.encode(query, model)
+        return results
 
-        results = cosine_search(query_emb, embeddings, flat_ids, flat_texts, top_k)
-        if rerank_flag:
-            results = rerank(results, doc_trees, query, rerank_model, post_expand=post_expand)
+    registry.release_with(search_regulations, registry_keys)
 
-        # Apply a threshold to results
-        if rerank_flag:
-            results = [result for result in results if result.reranked_score>-2]
-        else:
-            results = [result for result in results if result.similarity_score>0.3]
-        [print(result) for result in results]
-        log.debug(f'Found {len(results)} regulation results.')
+    return search_regulations
 
-        return results
 
-    return search_regulations
+@dataclass
+class CompoundResults:
+    """Everything a compound search found for a query."""
+    regulation_results: list[SearchResult]
+    definitions: list[str]
+    packed: PackedContext
+    degradations: list[str]
 
 
-def make_compound_search(
+def make_compound_retrieval(
         search_regulations,
         search_definitions,
         doc_trees,
-        definitions_flat
-    ) -> Callable[[str], tuple[str,str]]:
-
-    def search(query: str) -> tuple[str,str]:
-        """Do a semantic search over embeddings.  Also return potentially relevant definitiosn."""
-        regulation_results = search_regulations(query)
-        # regulation_results_str = results_to_string(regulation_results, doc_trees, REG_DIVIDER)
+        definitions_flat,
+        max_context_tokens: int | None = MAX_CONTEXT_TOKENS,
+        max_workers: int = MAX_SEARCH_WORKERS,
+        latency_budget: float | None = None,
+        stage_workers: int = MAX_STAGE_WORKERS
+    ) -> Callable[[str], CompoundResults]:
+
+    # Stages and the per-result definition fan-out use separate pools so that a
+    # stage waiting on its fan-out can never starve it of workers
+    stage_executor = ThreadPoolExecutor(max_workers=stage_workers, thread_name_prefix='search-stage')
+    fan_out_executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='search-fan-out')
+
+    definition_cost = CostEstimate(DEFINITION_SEARCH_SEC)
+
+    def find_phrase_definitions(regulation_results, deadline: Deadline) -> list[str]:
+        """Look for capitalized phrases from the regulations in the definitions."""
+        if deadline.expired():
+            deadline.degrade('skip_phrase_definitions')
+            return []
 
-        # Get definitions that may be semantically relevant to the query
-        query_definitions = search_definitions(query)
-        # query_definitions = [
-        #     f'{defn_hit.text} (from {defn_hit.file})' for defn_hit in query_definitions
-        # ]
-        # log.debug(f'Found {len(query_definitions)} query definitions')
-
-        # Look for capitalized phrases from the regulations in the definitions
         # TODO Could speed this up by storing definitions in a dictionary
         phrase_definitions = []
-        for res in regulation_results:
-            phrases = set(get_capitalized_phrases(res.text))
-            if len(phrases)>0:
-                for phrase in phrases:
-                    search_phrase = phrase.replace('[','').replace(']','')
-                    if len(phrase)>5:
-                        defs = [defn for defn in definitions_flat if re.match(f'"?{search_phrase}"?', defn)]
-                        phrase_definitions += defs
-        phrase_definitions = list(set(phrase_definitions))
+        with trace.stage('phrase_definitions', results=len(regulation_results)):
+            for res in regulation_results:
+                phrases = set(get_capitalized_phrases(res.text))
+                if len(phrases)>0:
+                    for phrase in phrases:
+                        search_phrase = phrase.replace('[','').replace(']','')
+                        if len(phrase)>5:
+                            defs = [defn for defn in definitions_flat if re.match(f'"?{search_phrase}"?', defn)]
+                            phrase_definitions += defs
+        phrase_definitions = list(dict.fromkeys(phrase_definitions))
         log.debug(f'Found {len(phrase_definitions)} phrase definitions')
+        return phrase_definitions
 
-        # Look for definitions that may be semantically similar to to the regulation results
-        regulation_definitions_set = []
-        for result in regulation_results:
-            regulation_definitions_set.append(search_definitions(result.text))
-
+    def find_regulation_definitions(regulation_results, deadline: Deadline) -> list[str]:
+        """Look for definitions that may be semantically similar to to the regulation results."""
+        n_results = deadline.affordable(
+            definition_cost.per_item, len(regulation_results), max_workers
+        )
+        if n_results==0 and len(regulation_results)>0:
+            deadline.degrade('skip_definition_fan_out')
+        elif n_results<len(regulation_results):
+            deadline.degrade(f'definition_fan_out_top_{n_results}')
+
+        start_time = time.perf_counter()
+        regulation_definitions_set = fan_out(
+            search_definitions,
+            [result.text for result in regulation_results[:n_results]],
+            fan_out_executor
+        )
+        definition_cost.update(
+            (time.perf_counter() - start_time)*min(n_results, max_workers), n_results
+        )
         regulation_definitions = reciprocal_rank_fusion(regulation_definitions_set)
         log.debug(f'Found {len(regulation_definitions)} regulation definitions')
-
-        definition_results = list(
-            set(regulation_definitions[:5] + phrase_definitions + query_definitions[:2])
+        return regulation_definitions
+
+    def retrieve(query: str, deadline: Deadline | None = None) -> CompoundResults:
+        """Do a semantic search over embeddings.  Also return potentially relevant definitiosn.
+
+        Independent retrieval stages run concurrently.  Stages shrink their work if
+        the `deadline` (by default one of `latency_budget` seconds) runs short, and
+        record what they skipped in `deadline.degradations`.  The regulation and
+        definition texts are packed to fit within `max_context_tokens`."""
+        with trace.span('retrieve', latency_budget=latency_budget) as retrieve_span:
+            deadline = Deadline(latency_budget) if deadline is None else deadline
+            stages = {
+                'regulations': Stage(lambda: search_regulations(query, deadline)),
+                # Get definitions that may be semantically relevant to the query
+                'query_definitions': Stage(lambda: search_definitions(query)),
+                'phrase_definitions': Stage(
+                    lambda results: find_phrase_definitions(results, deadline), ('regulations',)
+                ),
+                'regulation_definitions': Stage(
+                    lambda results: find_regulation_definitions(results, deadline), ('regulations',)
+                ),
+            }
+            outputs, timings = run_stages(stages, stage_executor)
+            log.info(f'Compound search stages: {format_timings(timings)}')
+            if len(deadline.degradations)>0:
+                log.info(f'Compound search degradations: {", ".join(deadline.degradations)}')
+
+            # Definitions are kept in priority order so that packing drops the least useful
+            definition_results = list(
+                dict.fromkeys(
+                    outputs['regulation_definitions'][:5] +
+                    outputs['phrase_definitions'] +
+                    outputs['query_definitions'][:2]
+                )
+            )
+
+            with trace.stage('packing', max_tokens=max_context_tokens) as packing_span:
+                packed = pack_context(
+                    outputs['regulations'],
+                    definition_results,
+                    doc_trees,
+                    max_context_tokens
+                )
+                packing_span.set(
+                    tokens=packed.tokens,
+                    results=packed.n_results,
+                    duplicates=packed.n_duplicates,
+                    dropped=packed.n_dropped,
+                    definitions=packed.n_definitions
+                )
+            trace.count('definitions', packed.n_definitions)
+            trace.count('context_tokens', packed.tokens)
+            trace.count('context_tokens_saved', packed.tokens_saved)
+            trace.count('degradations', len(deadline.degradations))
+            # Every path (plain, agentic and the UI) retrieves here, so this reaches each response's trace
+            trace.record('degradations', list(deadline.degradations))
+            retrieve_span.set(degradations=list(deadline.degradations))
+
+        return CompoundResults(
+            outputs['regulations'],
+            definition_results,
+            packed,
+            deadline.degradations
         )
 
-        definition_results_str = '\n\n'.join(definition_results)
-        regulation_results_str = REG_DIVIDER.join(
-            [result_to_string(result, doc_trees) for result in regulation_results]
-        )
+    # The pools' threads exit once the retrieval (and the driver holding it) is garbage collected
+    weakref.finalize(retrieve, stage_executor.shutdown, wait=False)
+    weakref.finalize(retrieve, fan_out_executor.shutdown, wait=False)
+
+    return retrieve
+
 
-        return regulation_results_str, definition_results_str
+def search_from_retrieval(
+        retrieve: Callable[[str], CompoundResults]
+    ) -> Callable[[str], tuple[str,str]]:
+    """Make a search function that returns the packed regulation and definition texts."""
+
+    def search(query: str, deadline: Deadline | None = None) -> tuple[str,str]:
+        """Search regulations and definitions (see `make_compound_retrieval`)."""
+        results = retrieve(query, deadline)
+        return results.packed.regulations, results.packed.definitions
 
     return search
 
 
+def make_compound_search(
+        search_regulations,
+        search_definitions,
+        doc_trees,
+        definitions_flat,
+        max_context_tokens: int | None = MAX_CONTEXT_TOKENS,
+        max_workers: int = MAX_SEARCH_WORKERS,
+        latency_budget: float | None = None,
+        stage_workers: int = MAX_STAGE_WORKERS
+    ) -> Callable[[str], tuple[str,str]]:
+    """Make a search function for the regulation and definition texts to give an LLM."""
+    return search_from_retrieval(
+        make_compound_retrieval(
+            search_regulations,
+            search_definitions,
+            doc_trees,
+            definitions_flat,
+            max_context_tokens,
+            max_workers,
+            latency_budget,
+            stage_workers
+        )
+    )
+
+
 ## Helper function
 
 
@@ -237,11 +533,13 @@ def build_context(regulations: str | None, definitions: str | None) -> str:
 
 def driver_llm_only(llm_model: Callable) -> Callable[[str], str]:
 
+    llm_model = trace.traced('llm', llm_model, 'llm_calls')
+
     def respond(query: str) -> str:
         log.debug('Calling LLM...')
         messages = [
-            openai.SystemMessage(SYSTEM_MESSAGE_BASE),
-            openai.UserMessage(query)
+            SystemMessage(SYSTEM_MESSAGE_BASE),
+            UserMessage(query)
         ]
         return llm_model(messages).content
 
@@ -258,24 +556,23 @@ def driver_llm_with_search(
         similarity_model_name: str,
         cross_encoder_model_name: str | None,
         top_k: int,
-        include_definitions: bool
+        include_definitions: bool,
+        max_context_tokens: int | None = MAX_CONTEXT_TOKENS,
+        latency_budget: float | None = None,
+        search_workers: int = MAX_SEARCH_WORKERS,
+        stage_workers: int = MAX_STAGE_WORKERS,
+        batch_config: BatchConfig | None = None
 ) -> Callable:
 
-    # Load data
-    doc_trees, definition_ids, definitions_flat = load_data(doc_dir, reg_map)
+    llm_model = trace.traced('llm', llm_model, 'llm_calls')
 
-    config = {
-        'pre_expand': pre_expand,
-        'similarity_model_name': similarity_model_name
-    }
-    run_id = get_dict_hash(config)
-    run_dir = data_dir / Path(str(run_id))
-    if not run_dir.exists():
-        run_dir.mkdir(parents=True)
-        with open(run_dir / 'config.json', 'w') as f:
-            json.dump(config, f)
+    # Load data (shared with other drivers in this process), from a prebuilt
+    # bundle if there is one for these settings
+    bundle = open_bundle(data_dir, doc_dir, reg_map, pre_expand, similarity_model_name)
+    data_key, (doc_trees, definition_ids, definitions_flat) = acquire_data(doc_dir, reg_map, bundle)
+    run_dir = get_run_dir(data_dir, pre_expand, similarity_model_name)
 
-    search_definitions = make_definition_search(definition_ids, definitions_flat)
+    search_definitions = make_definition_search(definition_ids, definitions_flat, bundle)
     search_regulations = make_regulation_search(
         doc_trees,
         run_dir,
@@ -283,14 +580,21 @@ def driver_llm_with_search(
         cross_encoder_model_name,
         pre_expand,
         post_expand,
-        top_k
+        top_k,
+        batch_config,
+        bundle
     )
     compound_search = make_compound_search(
         search_regulations,
         search_definitions,
         doc_trees,
-        definitions_flat
+        definitions_flat,
+        max_context_tokens,
+        search_workers,
+        latency_budget,
+        stage_workers
     )
+    registry.release_with(compound_search, [data_key])
 
     def generate_response(question: str) -> str:
         """Generate a simple response."""
@@ -301,8 +605,8 @@ def driver_llm_with_search(
         context = build_context(regulations, definitions)
         prompt = context + f'\n\nHere is the question: {question}'
         messages = [
-            openai.SystemMessage(SYSTEM_MESSAGE),
-            openai.UserMessage(prompt)
+            SystemMessage(SYSTEM_MESSAGE),
+            UserMessage(prompt)
         ]
         log.info('Calling LLM')
         return llm_model(messages).content
@@ -320,24 +624,23 @@ def driver_llm_with_agentic_search(
         similarity_model_name: str,
         cross_encoder_model_name: str | None,
         top_k: int,
-        include_definitions: bool
+        include_definitions: bool,
+        max_context_tokens: int | None = MAX_CONTEXT_TOKENS,
+        latency_budget: float | None = None,
+        search_workers: int = MAX_SEARCH_WORKERS,
+        stage_workers: int = MAX_STAGE_WORKERS,
+        batch_config: BatchConfig | None = None
 ) -> Callable:
 
-    # Load data
-    doc_trees, definition_ids, definitions_flat = load_data(doc_dir, reg_map)
+    llm_model = trace.traced('llm', llm_model, 'llm_calls')
 
-    config = {
-        'pre_expand': pre_expand,
-        'similarity_model_name': similarity_model_name
-    }
-    run_id = get_dict_hash(config)
-    run_dir = data_dir / Path(str(run_id))
-    if not run_dir.exists():
-        run_dir.mkdir(parents=True)
-        with open(run_dir / 'config.json', 'w') as f:
-            json.dump(config, f)
+    # Load data (shared with other drivers in this process), from a prebuilt
+    # bundle if there is one for these settings
+    bundle = open_bundle(data_dir, doc_dir, reg_map, pre_expand, similarity_model_name)
+    data_key, (doc_trees, definition_ids, definitions_flat) = acquire_data(doc_dir, reg_map, bundle)
+    run_dir = get_run_dir(data_dir, pre_expand, similarity_model_name)
 
-    search_definitions = make_definition_search(definition_ids, definitions_flat)
+    search_definitions = make_definition_search(definition_ids, definitions_flat, bundle)
     search_regulations = make_regulation_search(
         doc_trees,
         run_dir,
@@ -345,14 +648,23 @@ def driver_llm_with_agentic_search(
         cross_encoder_model_name,
         pre_expand,
         post_expand,
-        top_k
+        top_k,
+        batch_config,
+        bundle
     )
     compound_search = make_compound_search(
         search_regulations,
         search_definitions,
         doc_trees,
-        definitions_flat
+        definitions_flat,
+        max_context_tokens,
+        search_workers,
+        latency_budget,
+        stage_workers
     )
+    # The memo recognizes near-duplicate tool queries with the search's embedding model
+    model_key, embedding_model = acquire_embedding_model(similarity_model_name)
+    registry.release_with(compound_search, [data_key, model_key])
 
     function_descriptions = [
         {
@@ -387,9 +699,12 @@ def driver_llm_with_agentic_search(
     function_descriptions = [{'type': 'function', 'function': func} for func in function_descriptions]
     functions = {
         'lookup_definition': lambda query: '\n\n'.join(search_definitions(query)),
-        'regulation_search': lambda query: REG_DIVIDER.join(
-            [result_to_string(result, doc_trees) for result in search_regulations(query)]
-        )
+        'regulation_search': lambda query: pack_context(
+            search_regulations(query), [], doc_trees, max_context_tokens
+        ).regulations
+    }
+    functions = {
+        name: trace.traced('tools', function, 'tool_calls', tool=name) for name,function in functions.items()
     }
 
     def generate_response(question: str) -> str:
@@ -414,14 +729,22 @@ def driver_llm_with_agentic_search(
         context = build_context(regulations, definitions)
         prompt = context + f'\n\nHere is the question: {question}'
         messages = [
-            openai.SystemMessage(system_message_new),
-            openai.UserMessage(prompt)
+            SystemMessage(system_message_new),
+            UserMessage(prompt)
         ]
 
+        # Tool results are memoized for the duration of this interaction
+        tools = memoize_functions(
+            functions,
+            precomputed={'regulation_search': [({'query': question}, REPEATED_QUESTION_NOTE)]},
+            model=embedding_model
+        )
+
         call_count = 0
         while call_count < MAX_LLM_CALLS_PER_INTERACTION:
             log.info('Calling LLM')
             response = llm_model(messages, tools=function_descriptions)
+            call_count += 1
             messages.append(response)
             if response.tool_calls is None:
                 break
@@ -429,15 +752,16 @@ def driver_llm_with_agentic_search(
                 log.info('Calling tools...')
                 try:
                     tool_output_messages = [
-                        openai.ToolMessage(
-                            str(functions[tool.function_name](**tool.function_args)),
+                        ToolMessage(
+                            str(tools[tool.function_name](**tool.function_args)),
                             tool.tool_call_id)
                         for tool in response.tool_calls
                     ]
                 except Exception as e:
-                    tool_output_messages = [openai.UserMessage(f'There was a problem calling a tool: {e}')]
+                    tool_output_messages = [UserMessage(f'There was a problem calling a tool: {e}')]
                 messages += tool_output_messages
 
+        metrics.AGENT_LLM_CALLS.observe(call_count)
         return messages[-1].content
 
     return generate_response
@@ -456,29 +780,33 @@ def setup(
         similarity_model_name: str,
         cross_encoder_model_name: str | None,
         top_k: int,
-        include_definitions: bool
+        include_definitions: bool,
+        max_context_tokens: int | None = MAX_CONTEXT_TOKENS,
+        latency_budget: float | None = None,
+        search_workers: int = MAX_SEARCH_WORKERS,
+        stage_workers: int = MAX_STAGE_WORKERS,
+        batch_config: BatchConfig | None = None,
+        return_retrieval: bool = False
     ):
-    """Setup everything needed for the demo."""
+    """Setup everything needed for the demo.
+
+    Returns the compound search, agentic search and response functions, and
+    with `return_retrieval` also the retrieval function that returns structured
+    results (see `make_compound_retrieval`)."""
     # NOTE: There is redundancy in this function and those above.
     # This function supports a unifed UI, where the above functions
     # support modularity of a single type of interaction (RAG mode).
     # They could be refactored to share more code... at some future time...
 
-    # Load data
-    doc_trees, definition_ids, definitions_flat = load_data(doc_dir, reg_map)
+    llm_model = trace.traced('llm', llm_model, 'llm_calls')
 
-    config = {
-        'pre_expand': pre_expand,
-        'similarity_model_name': similarity_model_name
-    }
-    run_id = get_dict_hash(config)
-    run_dir = data_dir / Path(str(run_id))
-    if not run_dir.exists():
-        run_dir.mkdir(parents=True)
-        with open(run_dir / 'config.json', 'w') as f:
-            json.dump(config, f)
+    # Load data (shared with other drivers in this process), from a prebuilt
+    # bundle if there is one for these settings
+    bundle = open_bundle(data_dir, doc_dir, reg_map, pre_expand, similarity_model_name)
+    data_key, (doc_trees, definition_ids, definitions_flat) = acquire_data(doc_dir, reg_map, bundle)
+    run_dir = get_run_dir(data_dir, pre_expand, similarity_model_name)
 
-    search_definitions = make_definition_search(definition_ids, definitions_flat)
+    search_definitions = make_definition_search(definition_ids, definitions_flat, bundle)
     search_regulations = make_regulation_search(
         doc_trees,
         run_dir,
@@ -486,14 +814,24 @@ def setup(
         cross_encoder_model_name,
         pre_expand,
         post_expand,
-        top_k
+        top_k,
+        batch_config,
+        bundle
     )
-    compound_search = make_compound_search(
+    retrieve = make_compound_retrieval(
         search_regulations,
         search_definitions,
         doc_trees,
-        definitions_flat
+        definitions_flat,
+        max_context_tokens,
+        search_workers,
+        latency_budget,
+        stage_workers
     )
+    compound_search = search_from_retrieval(retrieve)
+    # The memo recognizes near-duplicate tool queries with the search's embedding model
+    model_key, embedding_model = acquire_embedding_model(similarity_model_name)
+    registry.release_with(retrieve, [data_key, model_key])
 
     function_descriptions = [
         {
@@ -528,9 +866,12 @@ def setup(
     function_descriptions = [{'type': 'function', 'function': func} for func in function_descriptions]
     functions = {
         'lookup_definition': lambda query: '\n\n'.join(search_definitions(query)),
-        'regulation_search': lambda query: REG_DIVIDER.join(
-            [result_to_string(result, doc_trees) for result in search_regulations(query)]
-        )
+        'regulation_search': lambda query: pack_context(
+            search_regulations(query), [], doc_trees, max_context_tokens
+        ).regulations
+    }
+    functions = {
+        name: trace.traced('tools', function, 'tool_calls', tool=name) for name,function in functions.items()
     }
 
 
@@ -542,8 +883,8 @@ def setup(
         context = build_context(regulations, definitions)
         prompt = context + f'\n\nHere is the question: {question}'
         messages = [
-            openai.SystemMessage(SYSTEM_MESSAGE),
-            openai.UserMessage(prompt)
+            SystemMessage(SYSTEM_MESSAGE),
+            UserMessage(prompt)
         ]
         log.info('Calling LLM')
         return llm_model(messages).content
@@ -569,14 +910,22 @@ def setup(
         context = build_context(regulations, definitions)
         prompt = context + f'\n\nHere is the question: {question}'
         messages = [
-            openai.SystemMessage(system_message_new),
-            openai.UserMessage(prompt)
+            SystemMessage(system_message_new),
+            UserMessage(prompt)
         ]
 
+        # Tool results are memoized for the duration of this interaction
+        tools = memoize_functions(
+            functions,
+            precomputed={'regulation_search': [({'query': question}, REPEATED_QUESTION_NOTE)]},
+            model=embedding_model
+        )
+
         call_count = 0
         while call_count < MAX_LLM_CALLS_PER_INTERACTION:
             log.info('Calling LLM')
             response = llm_model(messages, tools=function_descriptions)
+            call_count += 1
             messages.append(response)
             if response.tool_calls is None:
                 break
@@ -584,17 +933,22 @@ def setup(
                 log.info('Calling tools...')
                 try:
                     tool_output_messages = [
-                        openai.ToolMessage(
-                            str(functions[tool.function_name](**tool.function_args)),
+                        ToolMessage(
+                            str(tools[tool.function_name](**tool.function_args)),
                             tool.tool_call_id)
                         for tool in response.tool_calls
                     ]
                 except Exception as e:
-                    tool_output_messages = [openai.UserMessage(f'There was a problem calling a tool: {e}')]
+                    tool_output_messages = [UserMessage(f'There was a problem calling a tool: {e}')]
                 messages += tool_output_messages
 
             yield messages[-1].content
 
+        metrics.AGENT_LLM_CALLS.observe(call_count)
+
     # return generate_response
 
+    if return_retrieval:
+        return compound_search, agentic_search, generate_response, retrieve
+
     return compound_search, agentic_search, generate_response
\ No newline at end of file
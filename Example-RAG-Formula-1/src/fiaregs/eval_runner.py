@@ -0,0 +1,364 @@
+"""Bounded-concurrency runner for evaluations.
+
+Evaluation questions are answered (and graded) on a pool of worker threads,
+with retries with exponential backoff.  A `TokenBucket` shared by the chat
+functions (see `fiaregs.llm_cache.start_cached_chat`) limits the rate of LLM
+API calls, however many each answer takes.
+LLM usage is attributed to the question being answered by the calling thread,
+so stats stay with the right question even when answers finish out of order.
+Completed items are appended to a JSONL checkpoint (see
+`fiaregs.jsonl_store`) so that an interrupted run can be resumed.
+Per-request traces (see `fiaregs.trace`) can be added to the Excel report as a
+per-question sheet and an aggregate summary sheet.
+
+`evaluate_examples` answers and grades an evaluation set for one RAG
+configuration; `summarize_checkpoint` reduces its results to quality, cost and
+latency figures for comparing configurations.
+"""
+
+from __future__ import annotations
+
+from typing import Any, Callable, Hashable, Iterator, Sequence, TYPE_CHECKING
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import contextvars
+import logging
+import random
+import threading
+import time
+
+import numpy as np
+
+from aicore.llm.tracker import Usage, UsageTracker
+from aicore.performance.data import Evaluation
+from aicore.performance.autoeval import evaluate
+
+from fiaregs.jsonl_store import Checkpoint
+from fiaregs.trace import trace_request
+
+if TYPE_CHECKING:
+    # Only needed for evaluation sets; the runner is also used by the CLI
+    from datasets import Dataset
+
+log = logging.getLogger('eval')
+
+API_ERROR_PREFIX = 'There was an API error'
+
+
+class TokenBucket:
+    """Token-bucket rate limiter that is safe to share between threads."""
+
+    def __init__(self, rate_per_sec: float, capacity: float | None = None):
+        self.rate = rate_per_sec
+        self.capacity = max(rate_per_sec, 1.0) if capacity is None else capacity
+        self.tokens = self.capacity
+        self.last_time = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1.0) -> None:
+        """Block until `tokens` are available, then take them."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_time)*self.rate)
+                self.last_time = now
+                if self.tokens>=tokens:
+                    self.tokens -= tokens
+                    return
+                wait_time = (tokens - self.tokens)/self.rate
+            time.sleep(wait_time)
+
+
+class TaskUsageTracker(UsageTracker):
+    """UsageTracker that also attributes usage to the task running in the calling thread.
+
+    Wrap the work for each task in `with tracker.task(key):` and get its totals
+    with `task_totals(key)`; `clear_task(key)` drops them, e.g. before a retry."""
+
+    def __init__(self, name: str):
+        super().__init__(name)
+        self.task_usage: dict[Hashable, list[Usage]] = defaultdict(list)
+        self._current_task = contextvars.ContextVar(f'{name}_task', default=None)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def task(self, key: Hashable) -> Iterator[None]:
+        """Attribute LLM usage in this block to `key`."""
+        token = self._current_task.set(key)
+        try:
+            yield
+        finally:
+            self._current_task.reset(token)
+
+    def update(
+            self,
+            input_tokens: int,
+            generated_tokens: int,
+            elapsed_time: float
+        ) -> None:
+        usage = Usage(input_tokens, generated_tokens, elapsed_time)
+        key = self._current_task.get()
+        with self._lock:
+            self.llm_usage.append(usage)
+            if key is not None:
+                self.task_usage[key].append(usage)
+
+    def clear_task(self, key: Hashable) -> None:
+        """Forget the usage attributed to `key` so far."""
+        with self._lock:
+            self.task_usage.pop(key, None)
+
+    def task_totals(self, key: Hashable) -> dict[str, Any]:
+        """Total usage of a task, in the format of the evaluation `llm_usage` dict."""
+        with self._lock:
+            usages = list(self.task_usage.get(key, []))
+        return {
+            'Input tokens': sum(usage.input_tokens for usage in usages),
+            'Generated tokens': sum(usage.generated_tokens for usage in usages),
+            'Elapsed time': sum(usage.elapsed_time_sec for usage in usages),
+            'LLM calls': len(usages),
+        }
+
+
+class TaskFailed(Exception):
+    """Raised when a task still fails after all retries."""
+
+
+def with_retries(
+        func: Callable[[Any], Any],
+        max_retries: int = 3,
+        backoff_sec: float = 1.0,
+        is_failure: Callable[[Any], bool] | None = None
+    ) -> Callable[[Any], Any]:
+    """Wrap a function to retry with exponential backoff (and jitter).
+
+    An attempt fails if it raises or if `is_failure(output)` is true; e.g. the
+    chat functions return an error message rather than raising on API errors."""
+
+    def retrying(item: Any) -> Any:
+        for attempt in range(max_retries + 1):
+            try:
+                output = func(item)
+                if is_failure is None or not is_failure(output):
+                    return output
+                error = f'failed with output {str(output)[:100]}'
+            except Exception as e:
+                error = f'raised {type(e).__name__}: {e}'
+
+            if attempt<max_retries:
+                wait_time = backoff_sec*2**attempt*(1 + random.random())
+                log.warning(f'Attempt {attempt + 1} {error}; retrying in {wait_time:.1f} s')
+                time.sleep(wait_time)
+
+        raise TaskFailed(f'Failed after {max_retries + 1} attempts, last attempt {error}')
+
+    return retrying
+
+
+def run_concurrent(
+        func: Callable[[Any], Any],
+        items: Sequence[Any],
+        workers: int = 4,
+        max_retries: int = 3,
+        backoff_sec: float = 1.0,
+        is_failure: Callable[[Any], bool] | None = None
+    ) -> list[Any]:
+    """Call `func` on every item with at most `workers` running at once.
+
+    Outputs are returned in the order of `items`.  Items that still fail after
+    all retries get the `TaskFailed` exception as their output."""
+    retrying = with_retries(func, max_retries, backoff_sec, is_failure)
+
+    def run_one(item: Any) -> Any:
+        try:
+            return retrying(item)
+        except TaskFailed as e:
+            log.error(str(e))
+            return e
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(run_one, items))
+
+
+def is_api_error(response: str) -> bool:
+    """The chat functions return an error message instead of raising on API errors."""
+    return response is None or response.startswith(API_ERROR_PREFIX)
+
+
+def evaluate_examples(
+        eval_set: Dataset,
+        search: Callable,
+        eval_model: Callable,
+        tracker: TaskUsageTracker,
+        checkpoint: Checkpoint,
+        workers: int = 4,
+        max_retries: int = 3,
+        backoff_sec: float = 2.0
+    ) -> None:
+    """Answer and grade every example that is not already in the checkpoint.
+
+    The search function calls the RAG system and returns the response.  Examples
+    are processed concurrently and each is added to the checkpoint (answer, LLM
+    usage, trace and grade) as soon as it is graded.  Answering and grading are
+    retried separately, and the usage and trace are of the successful attempts
+    only; examples that still fail are left out of the checkpoint so that the
+    next run picks them up.  Make `eval_model` with `tracker` too to record the
+    grading usage (as `grading_llm_usage`).  To limit the rate of API calls, make
+    the chat functions of `search` and `eval_model` with a shared `TokenBucket`."""
+    retry_args = {
+        'max_retries': max_retries,
+        'backoff_sec': backoff_sec
+    }
+
+    def answer_attempt(key: str) -> tuple[str, dict]:
+        # Each attempt starts afresh, so only the successful one is recorded
+        tracker.clear_task(key)
+        with tracker.task(key), trace_request() as request_trace:
+            response = search(key)
+        return response, request_trace.to_dict()
+
+    def grade_attempt(example: dict) -> tuple[str, float]:
+        grade_key = (example['question'], 'grade')
+        tracker.clear_task(grade_key)
+        with tracker.task(grade_key):
+            return evaluate(
+                eval_model, example['question'], example['ground_truth'], example['answer']
+            )
+
+    answer = with_retries(
+        answer_attempt, is_failure=lambda output: is_api_error(output[0]), **retry_args
+    )
+    grade = with_retries(grade_attempt, **retry_args)
+
+    def evaluate_example(example: dict) -> None:
+        key = example['question']
+        response, trace = answer(key)
+
+        # Here we are using an LLM to evaluate the responses, but the LLM
+        # is not always correct, so the evaluation should be inspected for
+        # accuracy and consistency.
+        explanation, score = grade({**example, 'answer': response})
+        checkpoint.add(key, {
+            'answer': response,
+            'llm_usage': tracker.task_totals(key),
+            'grading_llm_usage': tracker.task_totals((key, 'grade')),
+            'trace': trace,
+            'explanation': explanation,
+            'score': score
+        })
+        log.info(f'Completed {len(checkpoint.records)}/{len(eval_set)}: {key[:40]}...')
+
+    pending = [example for example in eval_set if example['question'] not in checkpoint]
+    log.info(f'{len(eval_set) - len(pending)} examples already completed, {len(pending)} to run')
+    run_concurrent(evaluate_example, pending, workers=workers, max_retries=0)
+
+
+def checkpoint_to_evaluations(eval_set: Dataset, checkpoint: Checkpoint) -> list[Evaluation]:
+    """Collect the completed examples, in evaluation set order."""
+    performance_evals = []
+    for example in eval_set:
+        record = checkpoint.get(example['question'])
+        if record is None:
+            log.warning(f'No result for question: {example["question"]}')
+            continue
+
+        perf_eval = Evaluation(
+            task='FIA QA',
+            metadata={
+                'question': example['question'],
+                'context': example['contexts'],
+                'eval notes': record['explanation'],
+            },
+            llm_usage={
+                **record['llm_usage'],
+                'Context tokens': record.get('trace', {}).get('counts', {}).get('context_tokens', 0),
+                'Total time': record.get('trace', {}).get('timings', {}).get('total', 0),
+            },
+            expected=example['ground_truth'],
+            actual=record['answer'],
+            confidence=record['score']
+        )
+        performance_evals.append(perf_eval)
+
+    return performance_evals
+
+
+TRACE_PERCENTILES = [50, 95]
+
+
+def flatten_trace(trace: dict[str, dict[str, Any]]) -> dict[str, float]:
+    """Flatten a trace dict (from `RequestTrace.to_dict`) into named columns."""
+    row = {f'{name} (s)': value for name,value in trace.get('timings', {}).items()}
+    row.update(trace.get('counts', {}))
+    return row
+
+
+def add_trace_sheets(filename: str, questions: list[str], traces: list[dict]) -> None:
+    """Add per-question trace and aggregate summary sheets to an Excel report.
+
+    Stage times are summed over threads, so concurrent stages can add up to
+    more than the total."""
+    from openpyxl import load_workbook
+    from openpyxl.styles import Font
+
+    rows = [flatten_trace(trace) for trace in traces]
+    columns = list(dict.fromkeys(column for row in rows for column in row))
+    bold_font = Font(bold=True)
+
+    wb = load_workbook(filename)
+
+    ws = wb.create_sheet('Traces')
+    ws.append(['Question'] + columns)
+    for question,row in zip(questions, rows):
+        ws.append([question] + [row.get(column, 0) for column in columns])
+    for cell in ws[1]:
+        cell.font = bold_font
+
+    ws = wb.create_sheet('Trace Summary')
+    percentile_names = [f'p{p}' for p in TRACE_PERCENTILES]
+    ws.append(['Metric', 'Mean'] + percentile_names + ['Max', 'Share of total time'])
+    totals = [row.get('total (s)', 0) for row in rows]
+    for column in columns:
+        values = np.array([row.get(column, 0) for row in rows], dtype=float)
+        share = (
+            float(values.sum()/sum(totals))
+            if column.endswith('(s)') and sum(totals)>0 else None
+        )
+        ws.append(
+            [column, float(values.mean())] +
+            [float(np.percentile(values, p)) for p in TRACE_PERCENTILES] +
+            [float(values.max()), share]
+        )
+    for cell in ws[1]:
+        cell.font = bold_font
+
+    wb.save(filename)
+    log.info(f'Added trace sheets to {filename}.')
+
+
+def summarize_checkpoint(eval_set: Dataset, checkpoint: Checkpoint) -> dict[str, float]:
+    """Quality, cost and latency of the completed examples in a checkpoint."""
+    records = [
+        checkpoint.get(example['question']) for example in eval_set
+        if example['question'] in checkpoint
+    ]
+    if len(records)==0:
+        return {'completed': 0}
+
+    def mean(values) -> float:
+        return float(np.mean(list(values)))
+
+    totals = [record.get('trace', {}).get('timings', {}).get('total', 0.0) for record in records]
+    return {
+        'completed': len(records),
+        'mean_score': mean(record['score'] for record in records),
+        'mean_input_tokens': mean(record['llm_usage']['Input tokens'] for record in records),
+        'mean_generated_tokens': mean(record['llm_usage']['Generated tokens'] for record in records),
+        'mean_llm_calls': mean(record['llm_usage']['LLM calls'] for record in records),
+        'mean_context_tokens': mean(
+            record.get('trace', {}).get('counts', {}).get('context_tokens', 0) for record in records
+        ),
+        'p50_latency_sec': float(np.percentile(totals, 50)),
+        'p95_latency_sec': float(np.percentile(totals, 95)),
+    }
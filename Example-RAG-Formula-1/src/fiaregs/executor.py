@@ -0,0 +1,82 @@
+"""Dependency-aware execution of pipeline stages on a thread pool.
+
+A pipeline is a dict of named `Stage`s.  Each stage is called with the outputs of
+its dependencies (in order) and is started as soon as they are all available,
+so independent stages run concurrently.  Stages and fan-out calls run in a
+copy of the caller's context, so context variables (e.g. the request trace in
+`fiaregs.trace`) carry over to the worker threads.
+"""
+
+from typing import Any, Callable, Iterable
+from concurrent.futures import Executor, Future, wait, FIRST_COMPLETED
+from dataclasses import dataclass
+import contextvars
+import time
+
+
+@dataclass(frozen=True)
+class Stage:
+    """A pipeline stage and the names of the stages it depends on."""
+    func: Callable[..., Any]
+    deps: tuple[str, ...] = ()
+
+
+def timed(func: Callable[..., Any]) -> Callable[..., tuple[Any, float]]:
+    """Wrap a function to also return its elapsed time in seconds."""
+
+    def timed_func(*args) -> tuple[Any, float]:
+        start_time = time.perf_counter()
+        output = func(*args)
+        return output, time.perf_counter() - start_time
+
+    return timed_func
+
+
+def run_stages(
+        stages: dict[str, Stage],
+        executor: Executor
+    ) -> tuple[dict[str, Any], dict[str, float]]:
+    """Run a pipeline, returning the output and elapsed time of every stage.
+
+    Stages must not wait on other tasks submitted to `executor`; use a separate
+    executor for fan-out work within a stage (see `fan_out`)."""
+    for name,stage in stages.items():
+        unknown = [dep for dep in stage.deps if dep not in stages]
+        if len(unknown)>0:
+            raise ValueError(f'Stage {name} depends on unknown stages {unknown}')
+
+    outputs, timings = {}, {}
+    pending = dict(stages)
+    running: dict[Future, str] = {}
+    while len(pending)>0 or len(running)>0:
+        ready = [
+            name for name,stage in pending.items()
+            if all(dep in outputs for dep in stage.deps)
+        ]
+        if len(ready)==0 and len(running)==0:
+            raise ValueError(f'Circular dependencies between stages {list(pending)}')
+        for name in ready:
+            stage = pending.pop(name)
+            args = [outputs[dep] for dep in stage.deps]
+            context = contextvars.copy_context()
+            running[executor.submit(context.run, timed(stage.func), *args)] = name
+
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            name = running.pop(future)
+            outputs[name], timings[name] = future.result()
+
+    return outputs, timings
+
+
+def fan_out(func: Callable[[Any], Any], items: Iterable[Any], executor: Executor) -> list[Any]:
+    """Call `func` on every item concurrently, returning outputs in order."""
+    futures = [
+        executor.submit(contextvars.copy_context().run, func, item) for item in items
+    ]
+    return [future.result() for future in futures]
+
+
+def format_timings(timings: dict[str, float]) -> str:
+    """Format stage timings for logging."""
+    return ', '.join(f'{name} {elapsed:.3f}s' for name,elapsed in timings.items())
@@ -0,0 +1,110 @@
+"""Memory accounting for loaded components.
+
+`deep_sizeof` follows an object's references and adds up the size of
+everything reachable from it: containers, strings, dataclasses and slotted
+objects, numpy arrays (their data, unless memory-mapped or a view) and torch
+tensors (their storage).  Pass the same `seen` set to successive calls to
+count memory shared between components (e.g. strings held by both the
+DocTrees and the flat texts) only with the first one.
+
+`rss_bytes` reads the resident set size of the process, to compare the
+accounted sizes with what the process actually holds.
+"""
+
+from __future__ import annotations
+
+from types import FunctionType, ModuleType
+import resource
+import sys
+
+import numpy as np
+
+# Shared by everything and not part of any component
+SKIP_TYPES = (type, ModuleType, FunctionType)
+
+
+def tensor_bytes(tensor) -> int:
+    """Bytes held by a torch tensor's storage."""
+    return tensor.untyped_storage().nbytes()
+
+
+def model_bytes(model) -> int:
+    """Bytes of a torch model's parameters and buffers."""
+    return sum(tensor_bytes(tensor) for tensor in [*model.parameters(), *model.buffers()])
+
+
+def is_tensor(value) -> bool:
+    return type(value).__module__.startswith('torch') and hasattr(value, 'untyped_storage')
+
+
+def is_model(value) -> bool:
+    return hasattr(value, 'parameters') and hasattr(value, 'buffers') and hasattr(value, 'modules')
+
+
+def deep_sizeof(value, seen: set[int] | None = None) -> int:
+    """Bytes of `value` and everything it references that is not in `seen`."""
+    seen = set() if seen is None else seen
+    total = 0
+    stack = [value]
+    while len(stack)>0:
+        value = stack.pop()
+        if id(value) in seen or isinstance(value, SKIP_TYPES):
+            continue
+        seen.add(id(value))
+
+        if is_tensor(value):
+            # Storage objects are made on access, so tensors sharing one are told apart by address
+            storage = value.untyped_storage()
+            if storage.data_ptr() not in seen:
+                seen.add(storage.data_ptr())
+                total += storage.nbytes()
+            total += sys.getsizeof(value)
+            continue
+        if is_model(value):
+            total += model_bytes(value)
+            continue
+        if isinstance(value, np.ndarray):
+            # Includes the data only if the array owns it; otherwise it is in the
+            # base (an array, bytes, or a memory map that is not counted)
+            total += sys.getsizeof(value)
+            if value.base is not None:
+                stack.append(value.base)
+            if value.dtype==object:
+                stack.extend(value.ravel().tolist())
+            continue
+
+        total += sys.getsizeof(value)
+        match value:
+            case str() | bytes() | int() | float() | None:
+                pass
+            case dict():
+                stack.extend(value.keys())
+                stack.extend(value.values())
+            case list() | tuple() | set() | frozenset():
+                stack.extend(value)
+            case _:
+                if hasattr(value, '__dict__'):
+                    stack.append(value.__dict__)
+                for cls in type(value).__mro__:
+                    for name in getattr(cls, '__slots__', ()):
+                        if hasattr(value, name):
+                            stack.append(getattr(value, name))
+    return total
+
+
+def rss_bytes() -> int:
+    """Resident set size of this process (peak RSS where /proc is not available)."""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1])*resource.getpagesize()
+    except OSError:
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Kilobytes on Linux, bytes on macOS
+        return max_rss if sys.platform=='darwin' else max_rss*1024
+
+
+def format_bytes(n: float) -> str:
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if abs(n)<1024 or unit=='GB':
+            return f'{n:.0f} {unit}' if unit=='B' else f'{n:.1f} {unit}'
+        n /= 1024
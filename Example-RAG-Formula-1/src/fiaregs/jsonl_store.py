@@ -0,0 +1,87 @@
+"""Append-only JSONL stores of completed records.
+
+Used for evaluation checkpoints (see `fiaregs.eval_runner`) and the LLM
+response store (see `fiaregs.llm_cache`).  Several processes can append to
+the same store (e.g. the workers of `scripts/sweep.py` share the LLM response
+store): writes hold an exclusive lock on the file, where the platform has
+`fcntl`.
+"""
+
+from typing import IO, Iterator
+from pathlib import Path
+from contextlib import contextmanager
+import json
+import logging
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # Windows has no fcntl; writes are then only serialized within a process
+    fcntl = None
+
+log = logging.getLogger('eval')
+
+
+@contextmanager
+def file_lock(f: IO) -> Iterator[None]:
+    """Hold an exclusive lock on an open file, across processes."""
+    if fcntl is None:
+        yield
+        return
+    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+    try:
+        yield
+    finally:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class Checkpoint:
+    """Append-only JSONL file of completed items, keyed by a string `key` field.
+
+    Each record is flushed to disk as soon as it is added, so a crashed run
+    loses at most the items in flight.  A partially written last line is
+    ignored when loading."""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.records: dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+        if self.path.exists():
+            with open(self.path, 'r') as f, file_lock(f):
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        log.warning(f'Skipping corrupt line in checkpoint {self.path}')
+                        continue
+                    self.records[record['key']] = record
+                # Terminate a partially written line so new records start cleanly
+                if f.tell()>0:
+                    f.seek(f.tell() - 1)
+                    if f.read(1)!='\n':
+                        with open(self.path, 'a') as f_append:
+                            f_append.write('\n')
+            log.info(f'Loaded {len(self.records)} completed items from {self.path}')
+        else:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.records
+
+    def get(self, key: str) -> dict | None:
+        """Get a completed record."""
+        return self.records.get(key)
+
+    def add(self, key: str, record: dict) -> None:
+        """Add a completed record and write it to the checkpoint file."""
+        record = {'key': key, **record}
+        line = json.dumps(record) + '\n'
+        with self._lock:
+            with open(self.path, 'a') as f, file_lock(f):
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            self.records[key] = record
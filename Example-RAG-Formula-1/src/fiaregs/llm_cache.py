@@ -0,0 +1,181 @@
+"""Record/replay cache for LLM chat functions.
+
+`start_cached_chat` has the same interface as `aicore.llm.openaiapi.start_chat`
+and adds a response store and a mode:
+
+- 'passthrough': always call the model; the store is not used.
+- 'record': return a stored response if there is one, otherwise call the model
+  and store its response.
+- 'replay': only return stored responses and raise `CacheMiss` otherwise, so
+  no API client (or network) is needed.
+
+Calls are keyed on a hash of the model name, the messages, the tools and any
+other arguments.  Responses, including tool calls, are stored with their token
+usage in a JSONL file.  Replayed calls report their recorded tokens to the
+tracker with an elapsed time of zero, so costs stay comparable and the
+latency that is left is from the non-LLM parts.
+
+In every mode, the latency and tokens of calls to the model and the cache
+hits and misses (and, in passthrough mode, the uncached calls) are recorded as
+metrics (see `fiaregs.metrics`).  Calls to the
+model (not cache hits) can take a token from a shared rate limiter first.
+"""
+
+from __future__ import annotations
+
+from typing import Callable, TYPE_CHECKING
+from pathlib import Path
+import hashlib
+import json
+import logging
+import threading
+
+from aicore.llm.messages import AssistantMessage, Message, message_to_dict, dict_to_message
+from aicore.llm.tracker import UsageTracker
+
+from fiaregs.jsonl_store import Checkpoint
+from fiaregs import trace
+from fiaregs import metrics
+
+if TYPE_CHECKING:
+    from fiaregs.eval_runner import TokenBucket
+
+log = logging.getLogger('setup')
+
+MODES = ['passthrough', 'record', 'replay']
+
+LLM_CALL_SECONDS = metrics.histogram('fiaregs_llm_call_seconds', 'Latency of LLM API calls', ['model'])
+LLM_INPUT_TOKENS = metrics.histogram(
+    'fiaregs_llm_input_tokens', 'Input tokens per LLM API call', ['model'], metrics.TOKEN_BUCKETS
+)
+LLM_GENERATED_TOKENS = metrics.histogram(
+    'fiaregs_llm_generated_tokens', 'Generated tokens per LLM API call', ['model'], metrics.TOKEN_BUCKETS
+)
+LLM_CACHE_REQUESTS = metrics.counter(
+    'fiaregs_llm_cache_requests_total',
+    'LLM chat requests by cache result (hit, miss or passthrough)',
+    ['model', 'result']
+)
+
+
+class CacheMiss(Exception):
+    """Raised in replay mode when a call has no stored response."""
+
+
+class CallUsageTracker(UsageTracker):
+    """Forwards usage to another tracker, records it as metrics and keeps the
+    last usage of each thread."""
+
+    def __init__(self, tracker: UsageTracker | None = None, model: str = ''):
+        super().__init__('llm_cache')
+        self.tracker = tracker
+        self.model = model
+        self._last = threading.local()
+
+    def update(
+            self,
+            input_tokens: int,
+            generated_tokens: int,
+            elapsed_time: float
+        ) -> None:
+        self._last.usage = (input_tokens, generated_tokens, elapsed_time)
+        LLM_CALL_SECONDS.observe(elapsed_time, model=self.model)
+        LLM_INPUT_TOKENS.observe(input_tokens, model=self.model)
+        LLM_GENERATED_TOKENS.observe(generated_tokens, model=self.model)
+        if self.tracker is not None:
+            self.tracker.update(input_tokens, generated_tokens, elapsed_time)
+
+    def pop_last(self) -> tuple[int, int, float] | None:
+        """Get and clear the usage of this thread's last call."""
+        usage = getattr(self._last, 'usage', None)
+        self._last.usage = None
+        return usage
+
+
+def get_call_key(model: str, messages: list[Message], *args, **kwargs) -> str:
+    """Hash of everything that determines the response to a call."""
+    call = {
+        'model': model,
+        'messages': [message_to_dict(message) for message in messages],
+        'args': args,
+        'kwargs': kwargs
+    }
+    return hashlib.sha256(json.dumps(call, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def rate_limited(chat: Callable, rate_limiter: TokenBucket | None) -> Callable:
+    """Wrap a chat function to take a token from `rate_limiter` before every call."""
+    if rate_limiter is None:
+        return chat
+
+    def limited_chat(messages: list[Message], *args, **kwargs) -> Message:
+        rate_limiter.acquire()
+        return chat(messages, *args, **kwargs)
+
+    return limited_chat
+
+
+def start_cached_chat(
+        model: str,
+        client,
+        tracker: UsageTracker | None = None,
+        store_path: Path | None = None,
+        mode: str = 'record',
+        start_chat: Callable | None = None,
+        rate_limiter: TokenBucket | None = None
+    ) -> Callable:
+    """Make an LLM interface function whose responses are recorded and replayed.
+
+    `start_chat` makes the underlying chat function (by default OpenAI's, or
+    e.g. that of another API); it is only called with `client` when a response
+    is not in the store.  Each call to it first takes a token from
+    `rate_limiter`, which can be shared by several chat functions."""
+    if mode not in MODES:
+        raise ValueError(f'Unknown LLM cache mode {mode}; expected one of {MODES}')
+    if start_chat is None and (mode!='replay' or store_path is None):
+        # The OpenAI client is slow to import and not needed to replay responses
+        from aicore.llm.openaiapi import start_chat
+    if mode=='passthrough' or store_path is None:
+        chat = rate_limited(start_chat(model, client, CallUsageTracker(tracker, model)), rate_limiter)
+
+        def passthrough_chat(messages: list[Message], *args, **kwargs) -> Message:
+            LLM_CACHE_REQUESTS.inc(model=model, result='passthrough')
+            return chat(messages, *args, **kwargs)
+
+        return passthrough_chat
+
+    store = Checkpoint(store_path)
+    call_usage = CallUsageTracker(tracker, model)
+    chat = rate_limited(start_chat(model, client, call_usage), rate_limiter) if mode=='record' else None
+
+    def chat_func(messages: list[Message], *args, **kwargs) -> Message:
+        key = get_call_key(model, messages, *args, **kwargs)
+        record = store.get(key)
+        if record is not None:
+            trace.count('llm_cache_hits')
+            LLM_CACHE_REQUESTS.inc(model=model, result='hit')
+            input_tokens, generated_tokens, _ = record['usage']
+            if tracker is not None:
+                tracker.update(input_tokens, generated_tokens, 0.0)
+            return dict_to_message(record['response'])
+
+        trace.count('llm_cache_misses')
+        LLM_CACHE_REQUESTS.inc(model=model, result='miss')
+        if chat is None:
+            raise CacheMiss(f'No recorded response from {model} for call {key[:12]}')
+
+        response = chat(messages, *args, **kwargs)
+        usage = call_usage.pop_last()
+        # API errors come back as user messages; only store real responses
+        if isinstance(response, AssistantMessage) and usage is not None:
+            store.add(key, {
+                'model': model,
+                # Keep `content` even when it is None (tool calls), as dict_to_message expects it
+                'response': {**message_to_dict(response), 'content': response.content},
+                'usage': usage
+            })
+        return response
+
+    log.info(f'LLM cache for {model} in {mode} mode: {len(store.records)} stored responses')
+
+    return chat_func
@@ -0,0 +1,113 @@
+"""Per-interaction memoization of agent tool calls.
+
+Agents frequently repeat a query (or the original question) as a tool argument.
+The wrapped tools return the earlier result instead of running the full
+retrieval stack again.
+"""
+
+from typing import Callable, Any
+import json
+import logging
+import re
+
+import fiaregs.search.embeddings as emb
+from fiaregs import metrics
+
+log = logging.getLogger('search')
+
+TOOL_MEMO_REQUESTS = metrics.counter(
+    'fiaregs_tool_memo_requests_total', 'Agent tool calls by memo result', ['tool', 'result']
+)
+
+
+NEAR_DUPLICATE_THRESHOLD = 0.95
+NEAR_DUPLICATE_NOTE = (
+    '(Note: this query is nearly identical to the earlier query "{query}", '
+    'so these are the same results.  Rephrase or refine the query to get new results.)\n\n'
+)
+
+
+def normalize_query(text: str) -> str:
+    """Lowercase a query and strip punctuation and extra whitespace."""
+    text = re.sub(r'[^\w\s]', ' ', text.lower())
+    return ' '.join(text.split())
+
+
+def normalize_args(arguments: dict[str, Any]) -> str:
+    """Get a cache key for a set of tool arguments."""
+    normalized = {
+        name: normalize_query(value) if isinstance(value, str) else value
+        for name,value in arguments.items()
+    }
+    return json.dumps(normalized, sort_keys=True)
+
+
+def memoize_functions(
+        functions: dict[str, Callable],
+        precomputed: dict[str, list[tuple[dict, Any]]] | None = None,
+        model: emb.Model | None = None,
+        threshold: float = NEAR_DUPLICATE_THRESHOLD
+    ) -> dict[str, Callable]:
+    """Wrap tool functions with a shared memo.
+
+    Create a new memo for each interaction.  `precomputed` maps a function
+    name to `(arguments, result)` pairs that are already known, e.g. a note that
+    the results for the original question are already in the context.
+
+    If an embedding `model` is given, tools with a single string argument also
+    return a cached result (with a note) when a new query has cosine similarity
+    of at least `threshold` with an earlier query to the same tool.
+    """
+    cache: dict[tuple[str, str], Any] = {}
+    query_embeddings: dict[str, list[tuple[Any, str, str]]] = {}
+
+    for name,items in (precomputed or {}).items():
+        for arguments,result in items:
+            key = normalize_args(arguments)
+            cache[(name, key)] = result
+            query = next(iter(arguments.values())) if len(arguments)==1 else None
+            if model is not None and isinstance(query, str):
+                query_embeddings.setdefault(name, []).append(
+                    (emb.encode(query, model), key, query)
+                )
+
+    def find_near_duplicate(name: str, query_emb) -> tuple[str, str] | None:
+        """Get the key and text of the most similar earlier query, if close enough."""
+        best_score, best = threshold, None
+        for other_emb,other_key,other_query in query_embeddings.get(name, []):
+            score = emb.similarity(query_emb, other_emb)
+            if score>=best_score:
+                best_score, best = score, (other_key, other_query)
+        return best
+
+    def memoize(name: str, function: Callable) -> Callable:
+
+        def memoized(**arguments) -> Any:
+            key = normalize_args(arguments)
+            if (name, key) in cache:
+                log.info(f'Memo hit for {name}, args = {arguments}')
+                TOOL_MEMO_REQUESTS.inc(tool=name, result='hit')
+                return cache[(name, key)]
+
+            query = next(iter(arguments.values())) if len(arguments)==1 else None
+            query_emb = None
+            if model is not None and isinstance(query, str):
+                query_emb = emb.encode(query, model)
+                near_duplicate = find_near_duplicate(name, query_emb)
+                if near_duplicate is not None:
+                    other_key, other_query = near_duplicate
+                    log.info(f'Near-duplicate memo hit for {name}, args = {arguments}')
+                    TOOL_MEMO_REQUESTS.inc(tool=name, result='near_duplicate')
+                    return NEAR_DUPLICATE_NOTE.format(query=other_query) + str(cache[(name, other_key)])
+
+            TOOL_MEMO_REQUESTS.inc(tool=name, result='miss')
+            result = function(**arguments)
+            cache[(name, key)] = result
+            if query_emb is not None:
+                query_embeddings.setdefault(name, []).append((query_emb, key, query))
+
+            return result
+
+        return memoized
+
+    return {name: memoize(name, function) for name,function in functions.items()}
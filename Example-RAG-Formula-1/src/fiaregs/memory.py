@@ -0,0 +1,156 @@
+"""Memory policies that bound the conversation history of an agent.
+
+A policy takes the message history and returns the messages to keep.  The
+history is split into a prefix (the system message and any extra context) and
+turns, each starting with a user question.  Policies always keep the prefix
+and the current turn, and only drop or shorten whole messages of earlier
+turns, so tool calls stay paired with their results.
+"""
+
+from typing import Callable
+
+from aicore.llm.messages import SystemMessage, UserMessage, ToolMessage, Message
+
+from fiaregs.context import count_tokens
+
+
+QUESTION_PREFIX = 'Question: '
+SUMMARY_PREFIX = 'Summary of the earlier conversation:\n\n'
+OMITTED_OBSERVATION = 'Observation: (omitted to save context)'
+SUMMARY_INSTRUCTIONS = (
+    'Summarize the following conversation between a user and an assistant in at most '
+    '{max_words} words.  Keep the questions, the answers and any facts or regulation '
+    'references that may be needed later.  If there is a summary of an earlier part '
+    'of the conversation, include it in your summary.'
+)
+
+MemoryPolicy = Callable[[list[Message]], list[Message]]
+
+
+def is_question(message: Message) -> bool:
+    """Whether a message starts a new turn."""
+    return (
+        isinstance(message, UserMessage) and
+        message.content.startswith(QUESTION_PREFIX)
+    )
+
+
+def is_summary(message: Message) -> bool:
+    """Whether a message is a summary of dropped turns."""
+    return (
+        isinstance(message, UserMessage) and
+        message.content.startswith(SUMMARY_PREFIX)
+    )
+
+
+def split_turns(
+        messages: list[Message]
+    ) -> tuple[list[Message], list[list[Message]]]:
+    """Split a history into its prefix and its turns."""
+    prefix, turns = [], []
+    for message in messages:
+        if is_question(message):
+            turns.append([message])
+        elif len(turns)>0:
+            turns[-1].append(message)
+        else:
+            prefix.append(message)
+    return prefix, turns
+
+
+def flatten(turns: list[list[Message]]) -> list[Message]:
+    """Join turns back into a list of messages."""
+    return [message for turn in turns for message in turn]
+
+
+def message_tokens(message: Message) -> int:
+    """Approximate number of tokens a message adds to a call."""
+    tokens = count_tokens(message.content or '')
+    for tool_call in getattr(message, 'tool_calls', None) or []:
+        tokens += count_tokens(f'{tool_call.function_name} {tool_call.function_args}')
+    return tokens
+
+
+def history_tokens(messages: list[Message]) -> int:
+    """Approximate number of tokens in a list of messages."""
+    return sum(message_tokens(message) for message in messages)
+
+
+def make_sliding_window(max_turns: int) -> MemoryPolicy:
+    """Keep only the last `max_turns` turns (including the current one)."""
+
+    def sliding_window(messages: list[Message]) -> list[Message]:
+        prefix, turns = split_turns(messages)
+        return prefix + flatten(turns[-max_turns:])
+
+    return sliding_window
+
+
+def make_token_budget(max_tokens: int) -> MemoryPolicy:
+    """Keep the history within `max_tokens` where possible.
+
+    Tool observations of earlier turns are replaced by a short placeholder first,
+    oldest first, then the earliest turns are dropped."""
+
+    def token_budget(messages: list[Message]) -> list[Message]:
+        tokens = history_tokens(messages)
+        if tokens<=max_tokens:
+            return messages
+
+        prefix, turns = split_turns(messages)
+        earlier, current = turns[:-1], turns[-1:]
+
+        observations = [
+            (turn, index)
+            for turn in earlier
+            for index,message in enumerate(turn)
+            if isinstance(message, ToolMessage) and message.content!=OMITTED_OBSERVATION
+        ]
+        for turn,index in observations:
+            if tokens<=max_tokens:
+                break
+            replacement = ToolMessage(OMITTED_OBSERVATION, turn[index].tool_call_id)
+            tokens -= message_tokens(turn[index]) - message_tokens(replacement)
+            turn[index] = replacement
+
+        while tokens>max_tokens and len(earlier)>0:
+            tokens -= history_tokens(earlier.pop(0))
+
+        return prefix + flatten(earlier + current)
+
+    return token_budget
+
+
+def make_summarizing(model: Callable, max_turns: int, max_words: int = 200) -> MemoryPolicy:
+    """Keep the last `max_turns` turns and replace earlier ones by a summary.
+
+    The summary is written by `model` and kept in the history after the prefix,
+    so it is updated (not rewritten from scratch) as more turns are dropped."""
+
+    def summarize(summary: str | None, turns: list[list[Message]]) -> str:
+        transcript = '\n\n'.join(
+            f'{message.role}: {message.content}'
+            for message in flatten(turns)
+            if message.content
+        )
+        if summary is not None:
+            transcript = f'Summary of the earlier conversation: {summary}\n\n{transcript}'
+        messages = [
+            SystemMessage(SUMMARY_INSTRUCTIONS.format(max_words=max_words)),
+            UserMessage(transcript)
+        ]
+        return model(messages).content
+
+    def summarizing(messages: list[Message]) -> list[Message]:
+        prefix, turns = split_turns(messages)
+        if len(turns)<=max_turns:
+            return messages
+
+        summaries = [message for message in prefix if is_summary(message)]
+        summary = summaries[-1].content.removeprefix(SUMMARY_PREFIX) if len(summaries)>0 else None
+        prefix = [message for message in prefix if not is_summary(message)]
+
+        summary = summarize(summary, turns[:-max_turns])
+        return prefix + [UserMessage(SUMMARY_PREFIX + summary)] + flatten(turns[-max_turns:])
+
+    return summarizing
@@ -0,0 +1,253 @@
+"""Process-wide operational metrics in the Prometheus text format.
+
+Modules declare their metrics at import with `counter`, `gauge` and
+`histogram`, which return the existing metric if one is already registered
+under the name, and update them as they run:
+
+    RERANK_PAIRS = metrics.counter('fiaregs_rerank_pairs_total', 'Query-text pairs scored')
+    RERANK_PAIRS.inc(len(pairs))
+
+Metrics that several modules update (e.g. `AGENT_LLM_CALLS`) are declared
+here.  Labels are passed as keyword arguments and must match the metric's
+`labelnames`.  `render` formats every metric for a scrape; the service answers
+`GET /metrics` with it, and `start_http_server` serves it on its own port for
+processes without an HTTP server (e.g. the Gradio app).
+"""
+
+from typing import Callable, Iterable
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+import math
+import threading
+
+log = logging.getLogger('service')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_BUCKETS = (100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LabelKey = tuple[str, ...]
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value>0 else '-Inf'
+    return repr(float(value))
+
+
+def escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names: Iterable[str], values: Iterable[str]) -> str:
+    labels = ','.join(
+        f'{name}="{escape(value)}"' for name,value in zip(names, values)
+    )
+    return '{' + labels + '}' if labels else ''
+
+
+class Metric(ABC):
+    """A named metric with one value (or histogram) per combination of label values."""
+    kind = 'untyped'
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def key(self, labels: dict[str, object]) -> LabelKey:
+        if labels.keys()!=set(self.labelnames):
+            raise ValueError(f'{self.name} takes labels {self.labelnames}, got {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    @abstractmethod
+    def samples(self) -> list[tuple[str, str, float]]:
+        """(name suffix, formatted labels, value) of every sample."""
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        lines += [
+            f'{self.name}{suffix}{labels} {format_value(value)}'
+            for suffix,labels,value in self.samples()
+        ]
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """A total that only goes up."""
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, help, labelnames)
+        self.values: dict[LabelKey, float] = {}
+
+    def inc(self, n: float = 1, **labels) -> None:
+        key = self.key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + n
+
+    def get(self, **labels) -> float:
+        with self._lock:
+            return self.values.get(self.key(labels), 0)
+
+    def samples(self) -> list[tuple[str, str, float]]:
+        with self._lock:
+            return [('', format_labels(self.labelnames, key), value) for key,value in self.values.items()]
+
+
+class Gauge(Counter):
+    """A value that can go up and down, or that is read from a function at each scrape."""
+    kind = 'gauge'
+
+    def __init__(self, name: str, help: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, help, labelnames)
+        self.functions: dict[LabelKey, Callable[[], float]] = {}
+
+    def set(self, value: float, **labels) -> None:
+        key = self.key(labels)
+        with self._lock:
+            self.values[key] = value
+
+    def dec(self, n: float = 1, **labels) -> None:
+        self.inc(-n, **labels)
+
+    def set_function(self, function: Callable[[], float], **labels) -> None:
+        """Read the value from `function` at each scrape."""
+        key = self.key(labels)
+        with self._lock:
+            self.functions[key] = function
+
+    def samples(self) -> list[tuple[str, str, float]]:
+        samples = super().samples()
+        with self._lock:
+            functions = list(self.functions.items())
+        for key,function in functions:
+            try:
+                samples.append(('', format_labels(self.labelnames, key), function()))
+            except Exception:
+                log.exception(f'Reading gauge {self.name} failed')
+        return samples
+
+
+class Histogram(Metric):
+    """Counts of observations in cumulative buckets, with their sum."""
+    kind = 'histogram'
+
+    def __init__(
+            self,
+            name: str,
+            help: str,
+            labelnames: Iterable[str] = (),
+            buckets: Iterable[float] = LATENCY_BUCKETS
+        ):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per label key: observations per bucket (the last one is +Inf) and their sum
+        self.counts: dict[LabelKey, list[int]] = {}
+        self.sums: dict[LabelKey, float] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self.key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self.counts.get(key)
+            if counts is None:
+                counts = self.counts[key] = [0]*(len(self.buckets) + 1)
+                self.sums[key] = 0.0
+            counts[index] += 1
+            self.sums[key] += value
+
+    def get_count(self, **labels) -> int:
+        with self._lock:
+            return sum(self.counts.get(self.key(labels), []))
+
+    def samples(self) -> list[tuple[str, str, float]]:
+        samples = []
+        with self._lock:
+            for key,counts in self.counts.items():
+                total = 0
+                for bound,count in zip(self.buckets + (math.inf,), counts):
+                    total += count
+                    labels = format_labels(self.labelnames + ('le',), key + (format_value(bound),))
+                    samples.append(('_bucket', labels, total))
+                labels = format_labels(self.labelnames, key)
+                samples.append(('_sum', labels, self.sums[key]))
+                samples.append(('_count', labels, total))
+        return samples
+
+
+_metrics: dict[str, Metric] = {}
+_lock = threading.Lock()
+
+
+def register(metric: Metric) -> Metric:
+    """Register a metric, or get the one already registered under its name."""
+    with _lock:
+        existing = _metrics.get(metric.name)
+        if existing is None:
+            _metrics[metric.name] = metric
+            return metric
+    if type(existing) is not type(metric) or existing.labelnames!=metric.labelnames:
+        raise ValueError(f'Metric {metric.name} is already registered as a different {existing.kind}')
+    return existing
+
+
+def counter(name: str, help: str, labelnames: Iterable[str] = ()) -> Counter:
+    return register(Counter(name, help, labelnames))
+
+
+def gauge(name: str, help: str, labelnames: Iterable[str] = ()) -> Gauge:
+    return register(Gauge(name, help, labelnames))
+
+
+def histogram(
+        name: str,
+        help: str,
+        labelnames: Iterable[str] = (),
+        buckets: Iterable[float] = LATENCY_BUCKETS
+    ) -> Histogram:
+    return register(Histogram(name, help, labelnames, buckets))
+
+
+# Metrics updated by more than one module
+AGENT_LLM_CALLS = histogram(
+    'fiaregs_agent_llm_calls', 'LLM calls per agentic interaction', buckets=COUNT_BUCKETS
+)
+
+
+def render() -> str:
+    """Every registered metric in the Prometheus text format."""
+    with _lock:
+        metrics = sorted(_metrics.values(), key=lambda metric: metric.name)
+    return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+def start_http_server(port: int, host: str = '127.0.0.1') -> ThreadingHTTPServer:
+    """Serve `GET /metrics` on a background thread."""
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path!='/metrics':
+                self.send_error(404)
+                return
+            data = render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    log.info(f'Serving metrics on http://{host}:{port}/metrics')
+    return server
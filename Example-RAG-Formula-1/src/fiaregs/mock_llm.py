@@ -0,0 +1,142 @@
+"""Offline stand-in for an LLM chat model.
+
+`start_mock_chat` returns a function with the same interface as the chat
+functions from `aicore.llm.openaiapi.start_chat`: it takes a list of messages
+(and optionally `tools`) and returns an `AssistantMessage`.  Latency is drawn
+from a configurable distribution and tool calls follow a simple script, so the
+drivers can be load tested without calling a real model.
+"""
+
+from typing import Callable
+import math
+import random
+import time
+import uuid
+
+from aicore.llm.messages import ToolCall, UserMessage, AssistantMessage, Message
+from aicore.llm.tracker import UsageTracker
+
+from fiaregs.text_utils import get_capitalized_phrases
+
+
+QUESTION_PREFIX = 'Here is the question: '
+MOCK_ANSWER = 'Final Answer: This is a mock response based on the provided regulations.'
+TOKENS_PER_WORD = 4/3
+
+
+def make_latency(
+        distribution: str = 'lognormal',
+        mean_sec: float = 1.0,
+        spread: float = 0.5,
+        seed: int | None = None
+    ) -> Callable[[], float]:
+    """Make a function that samples latencies in seconds.
+
+    `distribution` is one of 'constant', 'uniform' (mean +/- spread*mean) or
+    'lognormal' (with the given mean and log-space standard deviation `spread`)."""
+    rng = random.Random(seed)
+
+    match distribution:
+        case 'constant':
+            return lambda: mean_sec
+        case 'uniform':
+            return lambda: rng.uniform(mean_sec*(1 - spread), mean_sec*(1 + spread))
+        case 'lognormal':
+            # Choose mu so that the mean of the distribution is mean_sec
+            if mean_sec<=0:
+                return lambda: 0.0
+            mu = math.log(mean_sec) - spread**2/2
+            return lambda: rng.lognormvariate(mu, spread)
+        case _:
+            raise ValueError(f'Unknown latency distribution: {distribution}')
+
+
+def estimate_tokens(text: str | None) -> int:
+    """Rough token count of a string."""
+    return 0 if text is None else int(len(text.split())*TOKENS_PER_WORD)
+
+
+def get_question(messages: list[Message]) -> str:
+    """Get the question from the last user message."""
+    for message in reversed(messages):
+        if isinstance(message, UserMessage):
+            text = message.content
+            if QUESTION_PREFIX in text:
+                text = text.split(QUESTION_PREFIX)[-1]
+            return text.strip()
+    return ''
+
+
+def tool_rounds_so_far(messages: list[Message]) -> int:
+    """Count the assistant tool-calling rounds since the last user message."""
+    rounds = 0
+    for message in reversed(messages):
+        if isinstance(message, UserMessage):
+            break
+        if isinstance(message, AssistantMessage) and message.tool_calls is not None:
+            rounds += 1
+    return rounds
+
+
+def make_tool_call(tool: dict, question: str, round_num: int) -> ToolCall:
+    """Make a tool call with every required string argument filled from the question."""
+    function = tool['function']
+    if function['name']=='lookup_definition':
+        phrases = get_capitalized_phrases(question) if len(question.strip())>0 else []
+        query = phrases[round_num % len(phrases)] if len(phrases)>0 else question
+    else:
+        query = f'{question} (refinement {round_num + 1})'
+
+    required = function.get('parameters', {}).get('required', [])
+    return ToolCall(
+        f'call_{uuid.uuid4().hex[:12]}',
+        'function',
+        function['name'],
+        {name: query for name in required}
+    )
+
+
+def start_mock_chat(
+        latency: Callable[[], float] | None = None,
+        tool_rounds: int = 1,
+        tool_names: list[str] | None = None,
+        answer: str = MOCK_ANSWER,
+        tracker: UsageTracker | None = None
+    ) -> Callable:
+    """Make a mock LLM interface function that you can use with Messages.
+
+    When `tools` are passed, the mock calls them (all of them, or those in
+    `tool_names`) for the first `tool_rounds` rounds of each question and then
+    answers with `answer`."""
+    latency = make_latency('constant', 0.0) if latency is None else latency
+
+    def chat_func(messages: list[Message], *args, tools: list[dict] | None = None, **kwargs) -> Message:
+        assert len(messages) > 0
+
+        start_time = time.time()
+        time.sleep(max(latency(), 0.0))
+
+        round_num = tool_rounds_so_far(messages)
+        available = [
+            tool for tool in (tools or [])
+            if tool_names is None or tool['function']['name'] in tool_names
+        ]
+        if len(available)>0 and round_num<tool_rounds:
+            question = get_question(messages)
+            response = AssistantMessage(
+                None,
+                [make_tool_call(tool, question, round_num) for tool in available]
+            )
+        else:
+            response = AssistantMessage(answer)
+
+        if tracker is not None:
+            tracker.update(
+                sum(estimate_tokens(message.content) for message in messages),
+                estimate_tokens(response.content),
+                time.time() - start_time
+            )
+
+        return response
+
+    return chat_func
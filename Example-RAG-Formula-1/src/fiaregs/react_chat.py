@@ -1,12 +1,29 @@
 """
 Implementation of ReAct agent.
+
+Tool calls in a response run one after the other, or concurrently on an
+executor (shared between agents) with a per-call timeout.
 """
 import json
 import logging
+import contextvars
+import time
 
 from collections.abc import Callable, Generator
+from concurrent.futures import Executor, wait, FIRST_COMPLETED
+
+from aicore.llm.messages import (
+    ToolCall,
+    SystemMessage,
+    UserMessage,
+    AssistantMessage,
+    ToolMessage,
+    Message
+)
 
-from aicore.llm import openaiapi as openai
+from fiaregs.memory import MemoryPolicy, QUESTION_PREFIX, history_tokens
+from fiaregs import trace
+from fiaregs import metrics
 
 logging.getLogger('react').setLevel(logging.DEBUG)
 log = logging.getLogger('react')
@@ -21,28 +38,89 @@ FORMAT_MESSAGE = (
 )
 
 
+def call_tool(tool_call: ToolCall, functions: dict[str, Callable]) -> ToolMessage:
+    """Call the function for a tool call and return its observation."""
+    name = tool_call.function_name
+    arguments = tool_call.function_args
+    log.info(f'Function {name}, args = {arguments}')
+    start_time = time.perf_counter()
+    with trace.span('tool', tool=name):
+        results = functions[name](**arguments)
+    log.info(f'Function {name} finished in {time.perf_counter() - start_time:.3f} s')
+    return ToolMessage(f'Observation: {str(results)}', tool_call.tool_call_id)
+
+
+def iter_tool_messages(
+        tool_calls: list[ToolCall],
+        functions: dict[str, Callable],
+        executor: Executor,
+        timeout_sec: float | None = None
+    ) -> Generator[tuple[int, ToolMessage], None, None]:
+    """Call tools concurrently, yielding (index, observation) as each one finishes.
+
+    Calls that raise, or that have not finished `timeout_sec` after they were
+    dispatched, get an observation saying so.  A call that times out is not
+    interrupted, but its result is ignored."""
+    futures = {
+        executor.submit(contextvars.copy_context().run, call_tool, tool_call, functions): index
+        for index,tool_call in enumerate(tool_calls)
+    }
+    deadline = None if timeout_sec is None else time.perf_counter() + timeout_sec
+
+    while len(futures)>0:
+        remaining = None if deadline is None else max(deadline - time.perf_counter(), 0.0)
+        done, _ = wait(futures, timeout=remaining, return_when=FIRST_COMPLETED)
+
+        if len(done)==0:
+            for future,index in futures.items():
+                future.cancel()
+                tool_call = tool_calls[index]
+                log.warning(f'Function {tool_call.function_name} timed out after {timeout_sec} s')
+                yield index, ToolMessage(
+                    f'Observation: {tool_call.function_name} timed out after {timeout_sec} s',
+                    tool_call.tool_call_id
+                )
+            return
+
+        for future in done:
+            index = futures.pop(future)
+            tool_call = tool_calls[index]
+            try:
+                message = future.result()
+            except Exception as e:
+                log.warning(f'Function {tool_call.function_name} raised {type(e).__name__}: {e}')
+                message = ToolMessage(
+                    f'Observation: there was a problem calling {tool_call.function_name}: {e}',
+                    tool_call.tool_call_id
+                )
+            yield index, message
+
+
 def get_next_message(
-        response: openai.AssistantMessage,
-        functions: dict[str, Callable]) -> tuple[list[openai.Message], bool]:
-    """Get a response to a ReAct LLM call."""
+        response: AssistantMessage,
+        functions: dict[str, Callable],
+        executor: Executor | None = None,
+        timeout_sec: float | None = None) -> tuple[list[Message], bool]:
+    """Get a response to a ReAct LLM call.
+
+    With an `executor`, the tool calls run concurrently (see `iter_tool_messages`);
+    observations are returned in the order of the tool calls either way."""
 
     function_called = False
     return_messages = []
     if response.tool_calls is not None:
-        for tool_call in response.tool_calls:
-            tcid = tool_call.tool_call_id
-            name = tool_call.function_name
-            arguments = tool_call.function_args
-            results = functions[name](**arguments)
-            log.info(f'Function {name}, args = {arguments}')
-            return_messages.append(
-                openai.ToolMessage(f'Observation: {str(results)}', tcid)
+        if executor is None:
+            return_messages = [call_tool(tool_call, functions) for tool_call in response.tool_calls]
+        else:
+            observations = dict(
+                iter_tool_messages(response.tool_calls, functions, executor, timeout_sec)
             )
+            return_messages = [observations[index] for index in sorted(observations)]
 
         function_called = True
     else:
         return_messages.append(
-            openai.UserMessage(
+            UserMessage(
                 ('When you have the answer to my question, please say '
                 '"Final Answer:" and then write the final answer.')
             )
@@ -58,6 +136,9 @@ def make_react_agent(
         functions: dict[str, Callable],
         max_llm_calls: int = 10,
         extra_context: str | None = None,
+        memory: MemoryPolicy | None = None,
+        tool_executor: Executor | None = None,
+        tool_timeout_sec: float | None = None,
     ) -> Callable:
     """Return a ReAct agent.
 
@@ -65,35 +146,64 @@ def make_react_agent(
     function_descriptions and functions arguments.
 
     There is a maximum number of times the LLM (model) may be called, max_llm_calls.
+
+    The conversation history is kept between questions.  Without a `memory` policy
+    (see `fiaregs.memory`) it grows with every question; with one, the history is
+    trimmed by the policy before every LLM call.
+
+    With a `tool_executor`, the tool calls of a response run concurrently, each
+    with a timeout of `tool_timeout_sec`, and observations are yielded as they
+    finish.
     """
 
     system_message += FORMAT_MESSAGE
 
-    messages = [openai.SystemMessage(system_message)]
+    messages = [SystemMessage(system_message)]
 
     if extra_context:
         messages.append(
-            openai.UserMessage(
+            UserMessage(
                 'Additional information that may be useful:\n\n'+extra_context
             )
         )
 
     def run_once(user_input: str) -> Generator:
         """Engage an LLM ReACT agent to answer a question."""
-        input_msg = f'Question: {user_input}'
-        messages.append(openai.UserMessage(input_msg))
+        input_msg = f'{QUESTION_PREFIX}{user_input}'
+        messages.append(UserMessage(input_msg))
         yield messages[-1]
 
         function_call_counter = 0
+        llm_calls = 0
         for _ in range(max_llm_calls):
-            log.info('calling llm')
-            response = model(messages, tools=function_descriptions)
+            tokens = history_tokens(messages)
+            if memory is not None:
+                messages[:] = memory(messages)
+                dropped_tokens = tokens - history_tokens(messages)
+                tokens -= dropped_tokens
+                trace.count('history_tokens_dropped', dropped_tokens)
+            trace.count('history_tokens', tokens)
+            log.info(f'calling llm with {len(messages)} messages, ~{tokens} tokens')
+            with trace.span('llm', messages=len(messages), history_tokens=tokens):
+                response = model(messages, tools=function_descriptions)
+            llm_calls += 1
             messages.append(response)
             yield messages[-1]
 
             if response.content and "Final Answer" in response.content:
                 break
 
+            if tool_executor is not None and response.tool_calls is not None:
+                # Yield observations as they finish, but keep them in order in the history
+                observations = {}
+                for index,message in iter_tool_messages(
+                        response.tool_calls, functions, tool_executor, tool_timeout_sec):
+                    observations[index] = message
+                    yield message
+                messages.extend(observations[index] for index in sorted(observations))
+                function_call_counter += 1
+                continue
+
             next_messages, function_called = get_next_message(
                 response,
                 functions,
@@ -103,4 +213,6 @@ def make_react_agent(
             messages.extend(next_messages)
             yield from next_messages
 
+        metrics.AGENT_LLM_CALLS.observe(llm_calls)
+
     return run_once
@@ -0,0 +1,91 @@
+"""Process-wide registry of loaded models, documents and indexes.
+
+Loading models and building indexes is expensive, and several drivers in one
+process (e.g. an A/B evaluation) usually need the same ones.  Components are
+stored under a configuration key and reference counted; the first `acquire`
+builds a component and later ones share it.  A component is dropped when its
+last reference is released.
+"""
+
+from typing import Any, Callable, Hashable, Iterable
+from dataclasses import dataclass
+import logging
+import threading
+import weakref
+
+log = logging.getLogger('setup')
+
+
+@dataclass
+class Entry:
+    """A registered component and its reference count."""
+    value: Any
+    refs: int
+
+
+_entries: dict[Hashable, Entry] = {}
+_build_locks: dict[Hashable, threading.Lock] = {}
+_lock = threading.Lock()
+
+
+def acquire(key: Hashable, factory: Callable[[], Any]) -> Any:
+    """Get the component registered under `key`, building it with `factory` if needed.
+
+    Each call adds a reference that should be balanced with `release`."""
+    with _lock:
+        if key in _entries:
+            _entries[key].refs += 1
+            log.debug(f'Sharing {key[0]} ({_entries[key].refs} references)')
+            return _entries[key].value
+        build_lock = _build_locks.setdefault(key, threading.Lock())
+
+    # Build outside the registry lock so that unrelated components can load in
+    # parallel, but only once per key
+    with build_lock:
+        with _lock:
+            if key in _entries:
+                _entries[key].refs += 1
+                return _entries[key].value
+
+        value = factory()
+
+        with _lock:
+            _entries[key] = Entry(value, 1)
+            _build_locks.pop(key, None)
+
+    return value
+
+
+def release(key: Hashable) -> None:
+    """Drop a reference to a component, removing it when none are left."""
+    with _lock:
+        entry = _entries.get(key)
+        if entry is None:
+            return
+        entry.refs -= 1
+        if entry.refs<=0:
+            del _entries[key]
+            log.debug(f'Released {key[0]}')
+
+
+def release_with(owner: object, keys: Iterable[Hashable]) -> None:
+    """Release `keys` once `owner` (e.g. a search or driver closure) is garbage collected."""
+    keys = list(keys)
+
+    def release_all():
+        for key in keys:
+            release(key)
+
+    weakref.finalize(owner, release_all)
+
+
+def references() -> dict[Hashable, int]:
+    """Get the reference count of every registered component."""
+    with _lock:
+        return {key: entry.refs for key,entry in _entries.items()}
+
+
+def components() -> dict[Hashable, Any]:
+    """Get every registered component by key."""
+    with _lock:
+        return {key: entry.value for key,entry in _entries.items()}
@@ -0,0 +1,61 @@
+"""Retrieval quality metrics against gold contexts.
+
+Gold contexts are excerpts of regulation text, so they are matched to retrieved
+texts by word overlap rather than by chunk id: a retrieved text matches a gold
+context if it contains (almost) all of the gold context's words.
+"""
+
+import re
+
+MATCH_THRESHOLD = 0.8
+
+
+def words(text: str) -> list[str]:
+    """Lowercase words in a text, ignoring punctuation and formatting."""
+    return re.findall(r'\w+', text.lower())
+
+
+def overlap(gold: str, retrieved: str) -> float:
+    """Fraction of the distinct words of `gold` that appear in `retrieved`."""
+    gold_words = set(words(gold))
+    if len(gold_words)==0:
+        return 0.0
+    return len(gold_words & set(words(retrieved)))/len(gold_words)
+
+
+def matches(gold: str, retrieved: str, threshold: float = MATCH_THRESHOLD) -> bool:
+    """Whether a retrieved text contains a gold context."""
+    return overlap(gold, retrieved)>=threshold
+
+
+def recall_at_k(
+        golds: list[str],
+        retrieved: list[str],
+        k: int,
+        threshold: float = MATCH_THRESHOLD
+    ) -> float:
+    """Fraction of gold contexts matched by one of the top `k` retrieved texts."""
+    if len(golds)==0:
+        return 0.0
+    top_k = retrieved[:k]
+    found = sum(any(matches(gold, text, threshold) for text in top_k) for gold in golds)
+    return found/len(golds)
+
+
+def reciprocal_rank(
+        golds: list[str],
+        retrieved: list[str],
+        threshold: float = MATCH_THRESHOLD
+    ) -> float:
+    """1/rank of the first retrieved text that matches any gold context (0 if none)."""
+    for rank,text in enumerate(retrieved, start=1):
+        if any(matches(gold, text, threshold) for gold in golds):
+            return 1/rank
+    return 0.0
+
+
+def coverage(golds: list[str], context: str) -> float:
+    """Mean fraction of each gold context's words present in the full context."""
+    if len(golds)==0:
+        return 0.0
+    return sum(overlap(gold, context) for gold in golds)/len(golds)
@@ -1,20 +1,33 @@
-"""Wrapper for common embedding functions."""
+"""Wrapper for common embedding functions.
 
-from typing import Any
+torch and sentence_transformers take seconds to import, so they are imported
+when first used rather than with this module."""
+
+from __future__ import annotations
+
+from typing import Any, TYPE_CHECKING
 import pickle
 
-import torch
+import numpy as np
 
-from sentence_transformers import SentenceTransformer, util
+if TYPE_CHECKING:
+    import torch
 
 Model = Any
 
 
 def get_model(model: str) -> Model:
     """Get an embedding model."""
+    from sentence_transformers import SentenceTransformer
     return SentenceTransformer(model)
 
 
+def get_cross_encoder(model: str) -> Model:
+    """Get a cross-encoder model for reranking."""
+    from sentence_transformers import CrossEncoder
+    return CrossEncoder(model)
+
+
 def encode(texts: list[str], model: Model):
     """Get embeddings for texts."""
     show_progress = len(texts)>10
@@ -27,10 +40,30 @@ def query(
         top_k: int = 5
     ):
     """Query a set of embeddings"""
+    from sentence_transformers import util
     hits = util.semantic_search(query_embedding, target_embeddings, top_k=top_k)
     return hits
 
 
+def query_topk(
+        target_embeddings: torch.Tensor,
+        query_embedding: torch.Tensor,
+        top_k: int = 5
+    ) -> tuple[np.ndarray, np.ndarray]:
+    """Indices and cosine similarities of the `top_k` most similar embeddings, best first."""
+    import torch
+    from sentence_transformers import util
+    scores = util.cos_sim(query_embedding, target_embeddings)[0]
+    top_scores, top_indices = torch.topk(scores, min(top_k, len(scores)))
+    return top_indices.cpu().numpy(), top_scores.cpu().numpy()
+
+
+def similarity(embedding_a: torch.Tensor, embedding_b: torch.Tensor) -> float:
+    """Cosine similarity between two embeddings."""
+    from sentence_transformers import util
+    return float(util.cos_sim(embedding_a, embedding_b)[0][0])
+
+
 def load_embeddings(fname: str):
     """Load embeddings from file."""
     with open(fname, 'rb') as f:
@@ -1,47 +1,57 @@
-"""BM25-based keyword search."""
+"""BM25-based keyword search.
+
+NLTK (and its data, downloaded if missing) and rank_bm25 are loaded on first
+use rather than with this module."""
+
+from __future__ import annotations
+
+from typing import Callable, Sequence, TYPE_CHECKING
+from functools import lru_cache
 
 import numpy as np
 
-from nltk.corpus import stopwords
-from nltk.corpus import stopwords
-from nltk.tokenize import word_tokenize
-from nltk import WordNetLemmatizer
+from fiaregs.search.utils.data_utils import ResultBatch, SearchResult
 
-from rank_bm25 import BM25Okapi
+if TYPE_CHECKING:
+    from rank_bm25 import BM25Okapi
 
-from fiaregs.search.utils.data_utils import SearchResult
 
-try:
-    STOPWORDS = stopwords.words('english')
-except:
+@lru_cache(maxsize=1)
+def get_tokenizer() -> tuple[set[str], Callable[[str], list[str]], Callable[[str], str]]:
+    """Get the stopwords, word tokenizer and lemmatizer."""
     import nltk
-    nltk.download('stopwords')
-    STOPWORDS = stopwords.words('english')
+    from nltk.corpus import stopwords
+    from nltk.tokenize import word_tokenize
+    from nltk import WordNetLemmatizer
 
-try:
-    word_tokenize('This is a test')
-except:
-    import nltk
-    nltk.download('punkt')
-    nltk.download('punkt_tab')
+    try:
+        stopwords_english = stopwords.words('english')
+    except:
+        nltk.download('stopwords')
+        stopwords_english = stopwords.words('english')
 
-try:
-    WordNetLemmatizer().lemmatize('testing')
-except:
-    import nltk
-    nltk.download('wordnet')
+    try:
+        word_tokenize('This is a test')
+    except:
+        nltk.download('punkt')
+        nltk.download('punkt_tab')
 
+    try:
+        WordNetLemmatizer().lemmatize('testing')
+    except:
+        nltk.download('wordnet')
 
-LEMMATIZE = WordNetLemmatizer().lemmatize
+    return set(stopwords_english), word_tokenize, WordNetLemmatizer().lemmatize
 
 
 def tokenize(texts: list[str]) -> list[list[str]]:
     """Tokenize texts with lemmatization."""
+    stopwords, word_tokenize, lemmatize = get_tokenizer()
     tokens = [
         [
-            LEMMATIZE(token)
+            lemmatize(token)
             for token in word_tokenize(text.lower())
-            if token not in STOPWORDS
+            if token not in stopwords
         ]
         for text in texts
     ]
@@ -50,40 +60,47 @@ def tokenize(texts: list[str]) -> list[list[str]]:
 
 def build_index(corpus: list[str]) -> BM25Okapi:
     """Tokenize and index a corpus for BM25."""
+    from rank_bm25 import BM25Okapi
     return BM25Okapi(tokenize(corpus))
 
 
-def bm25_topk(query: str, index: BM25Okapi, top_k: int):
-    """Get the top-k BM25 matches from an index."""
+def bm25_topk(query: str, index: BM25Okapi, top_k: int) -> tuple[np.ndarray, np.ndarray]:
+    """Get the top-k BM25 matches from an index, best first.
+
+    `top_k` is clamped to the number of documents; none are returned for `top_k<=0`."""
+    if top_k<=0:
+        return np.empty(0, dtype=np.int64), np.empty(0)
     scores = index.get_scores(tokenize([query,])[0])
-    top_k_inds = list(np.argsort(scores, )[-top_k:])[::-1]
-    return top_k_inds, list(scores[top_k_inds])
+    top_k = min(top_k, len(scores))
+    if top_k<len(scores):
+        # Only the top k need sorting
+        top_k_inds = np.argpartition(scores, len(scores) - top_k)[-top_k:]
+    else:
+        top_k_inds = np.arange(len(scores))
+    top_k_inds = top_k_inds[np.argsort(scores[top_k_inds])[::-1]]
+    return top_k_inds, scores[top_k_inds]
+
+
+def keyword_search_batch(
+        index: BM25Okapi,
+        query: str,
+        ids: Sequence[tuple],
+        chunks: Sequence[str],
+        top_k: int
+    ) -> ResultBatch:
+    """Get the top-k BM25 matches as a `ResultBatch`."""
+    if top_k<=0:
+        return ResultBatch.empty(ids, chunks)
+    indices, scores = bm25_topk(query, index, top_k)
+    return ResultBatch(indices, scores, ids, chunks)
 
 
 def keyword_search(
         index: BM25Okapi,
         query: str,
-        ids: list[tuple[int]],
-        chunks: list[str],
+        ids: Sequence[tuple],
+        chunks: Sequence[str],
         top_k: int
     ) -> list[SearchResult]:
     """Get the top-k BM25 matches as a list of SearchResults."""
-    indices, scores = bm25_topk(query, index, top_k)
-
-    results = []
-    for chunk_id,score in zip(indices, scores):
-        file = ids[chunk_id][0]
-        tree_ind = ids[chunk_id][1:-1]
-        paragraph = ids[chunk_id][-1]
-        result = {
-            'similarity_score': score,
-            'file': file,
-            'tree_index': tree_ind,
-            'paragraph_index': paragraph,
-            'chunk_id': int(chunk_id),
-            'text': chunks[chunk_id],
-            'reranked_score': -1000
-        }
-        results.append(SearchResult(**result))
-
-    return results
+    return keyword_search_batch(index, query, ids, chunks, top_k).to_results()
@@ -1,48 +1,84 @@
-"""Functions for similarity and cross-encoder search."""
+"""Functions for similarity and cross-encoder search.
 
-import torch
+The `*_batch` functions work on columnar `ResultBatch`es; the others return
+lists of `SearchResult`s."""
+
+from __future__ import annotations
+
+from typing import Sequence, TYPE_CHECKING
+
+import numpy as np
 
 import fiaregs.search.embeddings as emb
 from fiaregs.search.utils import doctree
-from fiaregs.search.utils.data_utils import SearchResult
+from fiaregs.search.utils.data_utils import ResultBatch, SearchResult
+from fiaregs import metrics
 
+if TYPE_CHECKING:
+    import torch
 
-def cosine_search(
+RERANK_PAIRS = metrics.counter('fiaregs_rerank_pairs_total', 'Query-text pairs scored by the cross-encoder')
+
+
+def cosine_search_batch(
         query_emb: torch.Tensor,
         embeddings: torch.Tensor,
-        ids: list[tuple[int]],
-        chunks: list[str],
+        ids: Sequence[tuple],
+        chunks: Sequence[str],
         top_k: int,
-    ) -> list[SearchResult]:
+    ) -> ResultBatch:
     """Use cosine distance to get the `top_k` most similar text chunks to `query`.
 
     Each embedding (row of the tensor) should coincide with an entry in `ids` and
     `chunks`.  I.e., `embeddings[i,:] ~ ids[i] ~ chunks[i]`.  Each chunk is a
     piece of text taken from index id from the DocTree.
     """
-    # Get similarity scores and identifiers
-    hits = emb.query(embeddings, query_emb, top_k)[0]
-
-    results = []
-    for hit in hits:
-        score = hit['score']
-        chunk_id = hit['corpus_id']
-        file = ids[chunk_id][0]
-        ind = ids[chunk_id][1:-1]
-        paragraph = ids[chunk_id][-1]
-
-        result = {
-            'similarity_score': float(score),
-            'file': file,
-            'tree_index': ind,
-            'paragraph_index': paragraph,
-            'chunk_id': chunk_id,
-            'text': chunks[chunk_id],
-            'reranked_score':-1000
-        }
-        results.append(SearchResult(**result))
+    chunk_ids, scores = emb.query_topk(embeddings, query_emb, top_k)
+    return ResultBatch(chunk_ids, scores, ids, chunks)
 
-    return results
+
+def cosine_search(
+        query_emb: torch.Tensor,
+        embeddings: torch.Tensor,
+        ids: Sequence[tuple],
+        chunks: Sequence[str],
+        top_k: int,
+    ) -> list[SearchResult]:
+    """`cosine_search_batch` as a list of `SearchResult`s."""
+    return cosine_search_batch(query_emb, embeddings, ids, chunks, top_k).to_results()
+
+
+def score_candidates(
+        texts: list[str],
+        tree_indices: list[tuple],
+        files: list[str],
+        doc_trees: dict[str, doctree.DocTree],
+        query: str,
+        rerank_model: emb.Model,
+        post_expand: bool
+    ) -> tuple[np.ndarray, list[str]]:
+    """Cross-encoder score and best scoring text of each result.
+
+    With `post_expand`, each result is scored on its text with and without its
+    super and sub sections.  All pairs are scored in a single batch."""
+    candidates = [
+        doctree.expand(text, doc_trees[file], tree_index) if post_expand else [text]
+        for text,tree_index,file in zip(texts, tree_indices, files)
+    ]
+    pairs = [(query, text) for texts in candidates for text in texts]
+    RERANK_PAIRS.inc(len(pairs))
+    if len(pairs)==0:
+        return np.zeros(0), []
+
+    scores = np.asarray(rerank_model.predict(pairs), dtype=np.float64)
+    # Best candidate of each result: the max over each result's slice of the scores
+    starts = np.cumsum([0] + [len(texts) for texts in candidates[:-1]])
+    best_scores = np.maximum.reduceat(scores, starts)
+    best_texts = []
+    for start,texts,best_score in zip(starts.tolist(), candidates, best_scores):
+        best = int(np.argmax(scores[start:start + len(texts)]==best_score))
+        best_texts.append(texts[best])
+    return best_scores, best_texts
 
 
 def rerank(
@@ -55,26 +91,53 @@ def rerank(
     """Re-rank a list of results from `cosine_search`.
 
     `inputs` should be a list of dicts containing at least `text` and `tree_index`.
+    With `post_expand`, each result is scored on its text with and without its
+    super and sub sections, and takes the best scoring text.  All pairs are
+    scored in a single batch.
     """
-
-    # Re-rank
-    for result in inputs:
-        text = result.text
-
-        if post_expand:
-            file = result.file
-            tree_ind = result.tree_index
-            expanded_items = doctree.expand(text, doc_trees[file], tree_ind)
-            max_score = -10000
-            for item in expanded_items:
-                score = rerank_model.predict([(query, item)])[0]
-                if score>max_score:
-                    result.reranked_score = float(score)
-                    result.text = item
-        else:
-            result.reranked_score = float(rerank_model.predict([(query, text)])[0])
+    scores, texts = score_candidates(
+        [result.text for result in inputs],
+        [result.tree_index for result in inputs],
+        [result.file for result in inputs],
+        doc_trees,
+        query,
+        rerank_model,
+        post_expand
+    )
+    for result,score,text in zip(inputs, scores.tolist(), texts):
+        result.reranked_score = score
+        result.text = text
 
     # Re sort
     results = sorted(inputs, key=lambda res: res.reranked_score, reverse=True)
 
     return results
+
+
+def rerank_batch(
+        batch: ResultBatch,
+        doc_trees: dict[str, doctree.DocTree],
+        query: str,
+        rerank_model: emb.Model,
+        post_expand: bool
+    ) -> ResultBatch:
+    """`rerank` for a `ResultBatch`: a new batch with reranked scores and texts, best first."""
+    rows = range(len(batch))
+    scores, texts = score_candidates(
+        [batch.text(row) for row in rows],
+        [batch.tree_index(row) for row in rows],
+        [batch.file(row) for row in rows],
+        doc_trees,
+        query,
+        rerank_model,
+        post_expand
+    )
+    reranked = ResultBatch(
+        batch.chunk_ids,
+        batch.similarity_scores,
+        batch.ids,
+        batch.chunks,
+        scores,
+        {**batch.texts, **dict(zip(batch.chunk_ids.tolist(), texts))}
+    )
+    return reranked.sorted('reranked_scores')
@@ -0,0 +1,116 @@
+"""Chunk texts stored once, as spans of a single UTF-8 buffer.
+
+Flattening DocTrees into chunk texts, and more so expanding each paragraph
+with its super and sub sections, makes a string per text.  A `TextArena`
+instead holds every paragraph once in `data`, with its offset and length, and
+describes each text as up to three paragraphs joined by spaces (the paragraph,
+optionally preceded by its supersection and followed by its subsection).
+Texts are decoded only when indexed, e.g. when a result is rendered.
+
+The arrays can be saved as `.npy` files and memory-mapped when loaded, so the
+texts of a prebuilt bundle stay in the page cache (shared between processes)
+rather than on each process's heap.
+"""
+
+from collections.abc import Sequence
+from pathlib import Path
+
+import numpy as np
+
+from fiaregs.search.utils import doctree
+
+# Paragraphs per text: supersection, paragraph, subsection
+SPAN_WIDTH = 3
+ARRAYS = ['data', 'offsets', 'lengths', 'spans']
+
+
+class TextArena(Sequence):
+    """Texts as rows of paragraph numbers (-1 for none) into one UTF-8 buffer.
+
+    Indexing gives the text as a string (and slicing a `TextArena` over the
+    same buffer), so this can stand in for a list of chunk texts."""
+    __slots__ = ARRAYS
+
+    def __init__(self, data: np.ndarray, offsets: np.ndarray, lengths: np.ndarray, spans: np.ndarray):
+        self.data = data
+        self.offsets = offsets
+        self.lengths = lengths
+        self.spans = spans
+
+    @classmethod
+    def from_doctrees(
+            cls,
+            doc_trees: dict[str, doctree.DocTree],
+            pre_expand: bool
+        ) -> tuple['TextArena', list[tuple]]:
+        """The chunk texts and ids of the DocTrees, in the order of `utils.get_embeddings`.
+
+        With `pre_expand`, each paragraph gives the texts of `doctree.expand`."""
+        paragraphs = []
+        numbers = {}
+        for reg,doc_tree in doc_trees.items():
+            for ind,item in doctree.flatten_doctree(doc_tree):
+                numbers[(reg,)+ind] = len(paragraphs)
+                paragraphs.append(item.encode())
+
+        spans = []
+        ids = []
+        for reg,doc_tree in doc_trees.items():
+            for ind,_ in doctree.flatten_doctree(doc_tree):
+                number = numbers[(reg,)+ind]
+                variants = [(-1, number, -1)]
+                if pre_expand:
+                    tree_ind = ind[:-1]
+                    super_ind = doctree.get_supersection_index(doc_tree, tree_ind)
+                    sub_ind = doctree.get_subsection_index(doc_tree, tree_ind)
+                    super_number = -1 if super_ind is None else numbers[(reg,)+super_ind]
+                    sub_number = -1 if sub_ind is None else numbers[(reg,)+sub_ind]
+                    # Same texts, in the same order, as `doctree.expand`
+                    if super_number>=0:
+                        variants.append((super_number, number, -1))
+                    if sub_number>=0:
+                        variants.append((-1, number, sub_number))
+                    if super_number>=0 and sub_number>=0:
+                        variants.append((super_number, number, sub_number))
+                spans += variants
+                ids += [(reg,)+ind]*len(variants)
+
+        lengths = np.array([len(paragraph) for paragraph in paragraphs], dtype=np.int64)
+        offsets = np.zeros(len(paragraphs), dtype=np.int64)
+        np.cumsum(lengths[:-1], out=offsets[1:])
+        arena = cls(
+            np.frombuffer(b''.join(paragraphs), dtype=np.uint8),
+            offsets,
+            lengths.astype(np.int32),
+            np.array(spans, dtype=np.int32).reshape(-1, SPAN_WIDTH)
+        )
+        return arena, ids
+
+    def paragraph(self, number: int) -> str:
+        start = self.offsets[number]
+        return self.data[start:start + self.lengths[number]].tobytes().decode()
+
+    def __len__(self) -> int:
+        return len(self.spans)
+
+    def __getitem__(self, index: int | slice) -> 'str | TextArena':
+        if isinstance(index, slice):
+            return TextArena(self.data, self.offsets, self.lengths, self.spans[index])
+        return ' '.join(self.paragraph(number) for number in self.spans[index].tolist() if number>=0)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(getattr(self, name).nbytes for name in ARRAYS)
+
+    def save(self, directory: Path, prefix: str = 'texts') -> None:
+        """Write the arrays as `<prefix>_<array>.npy` files in `directory`."""
+        for name in ARRAYS:
+            np.save(directory / f'{prefix}_{name}.npy', getattr(self, name))
+
+    @classmethod
+    def load(cls, directory: Path, prefix: str = 'texts', mmap: bool = True) -> 'TextArena':
+        """Read an arena written by `save`, memory-mapped (read only) by default."""
+        return cls(*(
+            np.load(directory / f'{prefix}_{name}.npy', mmap_mode='r' if mmap else None)
+            for name in ARRAYS
+        ))
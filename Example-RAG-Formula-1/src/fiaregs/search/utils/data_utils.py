@@ -2,10 +2,13 @@
 
 from dataclasses import dataclass
 from typing import Iterable, Any
+from collections.abc import Sequence
 from hashlib import md5
 import json
 from collections import defaultdict
 
+import numpy as np
+
 import fiaregs.search.utils.doctree as doctree
 from fiaregs.search.utils import tree
 
@@ -20,7 +23,7 @@ class Page:
 Document = Iterable[Page]
 
 
-@dataclass
+@dataclass(slots=True)
 class SearchResult:
     """Structure for consistent search results."""
     similarity_score: float
@@ -32,29 +35,183 @@ class SearchResult:
     reranked_score: float = -1000
 
 
+class ChunkIds(Sequence):
+    """Chunk ids `(file, *tree_index, paragraph)`, stored as integer codes.
+
+    A list of id tuples costs about 100 bytes per chunk; here each id is a row
+    of an int32 array (padded with -1) whose first column indexes `files`.
+    Indexing gives the id tuple (and slicing a `ChunkIds`), so this can stand
+    in for the list."""
+    __slots__ = ('files', 'codes')
+
+    def __init__(self, files: list[str], codes: np.ndarray):
+        self.files = files
+        self.codes = codes
+
+    @classmethod
+    def from_tuples(cls, ids: Iterable[tuple]) -> 'ChunkIds':
+        ids = list(ids)
+        files = list(dict.fromkeys(id[0] for id in ids))
+        file_codes = {file: code for code,file in enumerate(files)}
+        width = max((len(id) for id in ids), default=1)
+        codes = np.full((len(ids), width), -1, dtype=np.int32)
+        for row,id in zip(codes, ids):
+            row[0] = file_codes[id[0]]
+            row[1:len(id)] = id[1:]
+        return cls(files, codes)
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def __getitem__(self, index: int | slice) -> 'tuple | ChunkIds':
+        if isinstance(index, slice):
+            return ChunkIds(self.files, self.codes[index])
+        row = self.codes[index]
+        return (self.files[row[0]], *row[1:][row[1:]>=0].tolist())
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes
+
+
+class ResultBatch:
+    """Search results as columns: chunk ids and scores in arrays.
+
+    Rows refer to chunks of the flat `ids` and `chunks` a search ran over;
+    files, tree indices and texts are looked up when asked for.  Reranking can
+    replace a result's text (e.g. with an expanded one); replaced texts are
+    kept in `texts` by chunk id.  Selecting, thresholding and sorting make new
+    batches without building a result object per hit, and `to_results` converts
+    to `SearchResult`s for callers that need them."""
+    __slots__ = ('chunk_ids', 'similarity_scores', 'reranked_scores', 'ids', 'chunks', 'texts')
+
+    def __init__(
+            self,
+            chunk_ids: np.ndarray,
+            similarity_scores: np.ndarray,
+            ids: Sequence[tuple],
+            chunks: Sequence[str],
+            reranked_scores: np.ndarray | None = None,
+            texts: dict[int, str] | None = None
+        ):
+        self.chunk_ids = np.asarray(chunk_ids, dtype=np.int64)
+        self.similarity_scores = np.asarray(similarity_scores, dtype=np.float64)
+        self.reranked_scores = (
+            np.full(len(self.chunk_ids), -1000.0) if reranked_scores is None
+            else np.asarray(reranked_scores, dtype=np.float64)
+        )
+        self.ids = ids
+        self.chunks = chunks
+        self.texts = {} if texts is None else texts
+
+    @classmethod
+    def empty(cls, ids: Sequence[tuple] = (), chunks: Sequence[str] = ()) -> 'ResultBatch':
+        """A batch without results (over `ids` and `chunks`, to concat with others)."""
+        return cls(np.empty(0, dtype=np.int64), np.empty(0), ids, chunks)
+
+    def __len__(self) -> int:
+        return len(self.chunk_ids)
+
+    def file(self, row: int) -> str:
+        return self.ids[self.chunk_ids[row]][0]
+
+    def tree_index(self, row: int) -> tuple:
+        return self.ids[self.chunk_ids[row]][1:-1]
+
+    def paragraph_index(self, row: int) -> int:
+        return self.ids[self.chunk_ids[row]][-1]
+
+    def text(self, row: int) -> str:
+        chunk_id = int(self.chunk_ids[row])
+        return self.texts.get(chunk_id, self.chunks[chunk_id])
+
+    def take(self, rows) -> 'ResultBatch':
+        """The batch of the given rows (indices or a boolean mask), in that order."""
+        return ResultBatch(
+            self.chunk_ids[rows],
+            self.similarity_scores[rows],
+            self.ids,
+            self.chunks,
+            self.reranked_scores[rows],
+            self.texts
+        )
+
+    def where(self, similarity_above: float | None = None, reranked_above: float | None = None) -> 'ResultBatch':
+        """The results with scores over the thresholds."""
+        mask = np.ones(len(self), dtype=bool)
+        if similarity_above is not None:
+            mask &= self.similarity_scores>similarity_above
+        if reranked_above is not None:
+            mask &= self.reranked_scores>reranked_above
+        return self.take(mask)
+
+    def sorted(self, by: str = 'reranked_scores') -> 'ResultBatch':
+        """The results by descending `similarity_scores` or `reranked_scores`."""
+        # Stable, so that ties keep their order
+        return self.take(np.argsort(-getattr(self, by), kind='stable'))
+
+    @staticmethod
+    def concat(batches: list['ResultBatch']) -> 'ResultBatch':
+        """Join batches over the same chunks."""
+        texts = {}
+        for batch in batches:
+            texts.update(batch.texts)
+        return ResultBatch(
+            np.concatenate([batch.chunk_ids for batch in batches]),
+            np.concatenate([batch.similarity_scores for batch in batches]),
+            batches[0].ids,
+            batches[0].chunks,
+            np.concatenate([batch.reranked_scores for batch in batches]),
+            texts
+        )
+
+    def to_results(self) -> list[SearchResult]:
+        results = []
+        for chunk_id,similarity_score,reranked_score in zip(
+                self.chunk_ids.tolist(), self.similarity_scores.tolist(), self.reranked_scores.tolist()):
+            id = self.ids[chunk_id]
+            results.append(SearchResult(
+                similarity_score,
+                id[0],
+                id[1:-1],
+                id[-1],
+                chunk_id,
+                self.texts.get(chunk_id, self.chunks[chunk_id]),
+                reranked_score
+            ))
+        return results
+
+
 def clean_text(text: str) -> str:
     """Strip white space and newlines from a string."""
     return text.replace('\n','').strip()
 
 
-def result_to_string(result: SearchResult, doc_trees: dict[str, doctree.DocTree]) -> str:
-    """Format a search result as a string with context."""
-    file = result.file
-    section_ind = result.tree_index
-
-    section = tree.get_from_tree(doc_trees[file], section_ind)
-    text = result.text
+def get_section_headings(doc_tree: doctree.DocTree, section_ind: tuple) -> list[str]:
+    """Get the titles of a section and all of its parents, top level first."""
+    section = tree.get_from_tree(doc_tree, section_ind)
 
     top_ind = section_ind
     section_headings = [section.title,]
     while len(next_up:=tree.move_up(top_ind))>0:
         top_ind = next_up
-        section_headings.append(tree.get_from_tree(doc_trees[file], top_ind).title)
+        section_headings.append(tree.get_from_tree(doc_tree, top_ind).title)
 
     section_headings = section_headings[::-1]
     if len(section_headings)<2:
         section_headings.append('None')
 
+    return section_headings
+
+
+def result_to_string(result: SearchResult, doc_trees: dict[str, doctree.DocTree]) -> str:
+    """Format a search result as a string with context."""
+    file = result.file
+    section_ind = result.tree_index
+
+    text = result.text
+    section_headings = get_section_headings(doc_trees[file], section_ind)
+
     # get additional context
     text = f'**{text}**'
     super_text = doctree.get_supersection(doc_trees[file], section_ind)
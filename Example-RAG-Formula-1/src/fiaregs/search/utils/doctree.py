@@ -1,7 +1,7 @@
 """Store a document as a tree."""
 
 from typing import Any, Callable
-from dataclasses import dataclass
+from dataclasses import dataclass, fields
 from copy import copy
 import os
 import yaml
@@ -10,7 +10,7 @@ from fiaregs.search.utils import tree
 from fiaregs.text_utils import words_in_list, combine_strings
 
 
-@dataclass
+@dataclass(slots=True)
 class Section:
     """A document section."""
     title: str
@@ -54,36 +54,43 @@ def flatten_doctree(tree_inp: DocTree, ind_prefix=None) -> tuple[Index, Any]:
                     yield tuple(ind_prefix + [i,j]), item
 
 
+def get_supersection_index(doc_tree: DocTree, ind: tuple[int]) -> Index | None:
+    """Get the index (with its paragraph) of the supersection of an index, i.e.
+    of the last string in the contents of a section directly above it."""
+    super_ind = tree.move_up(ind)
+    super_section = tree.get_from_tree(doc_tree, super_ind)
+    if isinstance(super_section, Section) and len(super_section.contents)>0:
+        return super_ind + (len(super_section.contents) - 1,)
+    return None
+
+
+def get_subsection_index(doc_tree: DocTree, ind: tuple[int]) -> Index | None:
+    """Get the index (with its paragraph) of the subsection of an index, i.e.
+    of the first string in the contents of a section directly below it."""
+    sub_ind = tree.move_down(ind)
+    sub_section = tree.get_from_tree(doc_tree, sub_ind)
+    if isinstance(sub_section, Section) and len(sub_section.contents)>0:
+        return sub_ind + (0,)
+    return None
+
+
+def get_paragraph(doc_tree: DocTree, ind: Index) -> Any:
+    """Get a paragraph by its index (section index and position in the contents)."""
+    return tree.get_from_tree(doc_tree, ind[:-1]).contents[ind[-1]]
+
+
 def get_supersection(doc_tree: DocTree, ind: tuple[int]) -> str | None:
     """Get the supersection of an index, i.e. the last string in the
     contents of a section directly above the given index."""
-    super_ind = tree.move_up(ind)
-    super_section = None
-    if super_ind is not None:
-        super_section = tree.get_from_tree(doc_tree, super_ind)
-        super_section = (
-            super_section.contents[-1]
-            if (isinstance(super_section, Section) and len(super_section.contents)>0)
-            else None
-        )
-
-    return super_section
+    super_ind = get_supersection_index(doc_tree, ind)
+    return None if super_ind is None else get_paragraph(doc_tree, super_ind)
 
 
 def get_subsection(doc_tree: DocTree, ind: tuple[int]) -> str | None:
     """Get the subsection of an index, i.e. the first string in the
     contents of a section directly below the given index."""
-    sub_ind = tree.move_down(ind)
-    sub_section = None
-    if sub_ind is not None:
-        sub_section = tree.get_from_tree(doc_tree, sub_ind)
-        sub_section = (
-            sub_section.contents[0]
-            if (isinstance(sub_section, Section) and len(sub_section.contents)>0)
-            else None
-        )
-
-    return sub_section
+    sub_ind = get_subsection_index(doc_tree, ind)
+    return None if sub_ind is None else get_paragraph(doc_tree, sub_ind)
 
 
 def expand(item: str, doc_tree: DocTree, index: tuple[int]) -> list[str]:
@@ -205,7 +212,9 @@ def consolidate_paragraphs(tree_inp: DocTree, word_limit: int = 100, sep=' ') ->
 
 def section_repr(dumper, data):
     """YAML represection of a Section."""
-    return dumper.represent_mapping('!section', vars(data))
+    return dumper.represent_mapping(
+        '!section', {field.name: getattr(data, field.name) for field in fields(data)}
+    )
 
 
 def section_constructor(loader, node):
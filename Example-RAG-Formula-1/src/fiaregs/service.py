@@ -0,0 +1,285 @@
+"""HTTP service for regulation search and answers.
+
+Endpoints (JSON in and out):
+
+- `GET /health`: 200 while the process is up.
+- `GET /ready`: 200 once models and indexes are loaded, 503 until then.
+- `GET /metrics`: metrics in the Prometheus text format (see `fiaregs.metrics`).
+- `POST /search`: regulation `SearchResult`s, definitions and the packed context.
+- `POST /summarize`: the search results and an LLM answer based on them.
+- `POST /agentic`: the search results and an agentic LLM answer.
+
+POST bodies are `{"query": "...", "budget_sec": 2.0}`, with an optional latency
+budget for the search (see `fiaregs.deadline`); without one, the search uses
+the `latency_budget` it was set up with.  Each request is traced (see
+`fiaregs.trace`) under the id in its `X-Request-Id` header, or a new one, which
+is returned in the response header and body.
+
+Connections are accepted on their own threads, but requests run on a fixed
+pool of workers.  At most `max_queue` requests wait for a worker; beyond that
+the service answers 503 with a Retry-After header so that clients (or a load
+balancer) can back off or go elsewhere.
+"""
+
+from typing import Any, Callable
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+from dataclasses import asdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import threading
+import time
+
+from fiaregs.deadline import Deadline
+from fiaregs import metrics
+from fiaregs.drivers import CompoundResults
+from fiaregs.trace import new_id, trace_request
+
+log = logging.getLogger('service')
+
+RETRY_AFTER_SEC = 1
+MAX_BODY_BYTES = 64*1024
+
+HTTP_REQUESTS = metrics.counter('fiaregs_http_requests_total', 'HTTP requests by path and status', ['path', 'status'])
+HTTP_REQUEST_SECONDS = metrics.histogram(
+    'fiaregs_http_request_seconds', 'Latency of HTTP POST requests by path and status', ['path', 'status']
+)
+IN_FLIGHT = metrics.gauge('fiaregs_http_in_flight', 'Requests running or waiting for a worker')
+
+
+class Overloaded(Exception):
+    """Raised when the worker pool queue is full."""
+
+
+class WorkerPool:
+    """Thread pool that admits at most `workers + max_queue` requests at once."""
+
+    def __init__(self, workers: int, max_queue: int):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='service-worker')
+        self.capacity = workers + max_queue
+        self._slots = threading.BoundedSemaphore(self.capacity)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+
+    def submit(self, func: Callable, *args) -> Future:
+        """Submit a request, or raise `Overloaded` if the queue is full."""
+        if not self._slots.acquire(blocking=False):
+            raise Overloaded(f'{self.capacity} requests already in flight')
+        with self._lock:
+            self.in_flight += 1
+
+        def release(_):
+            with self._lock:
+                self.in_flight -= 1
+            self._slots.release()
+
+        future = self.executor.submit(func, *args)
+        future.add_done_callback(release)
+        return future
+
+
+def to_json(value: Any) -> Any:
+    """Convert numpy scalars and other non-JSON values when serializing."""
+    return value.item() if hasattr(value, 'item') else str(value)
+
+
+def results_to_dict(results: CompoundResults) -> dict:
+    """Structured search results for a response."""
+    return {
+        'regulation_results': [asdict(result) for result in results.regulation_results],
+        'definitions': results.definitions,
+        'context': {
+            'regulations': results.packed.regulations,
+            'definitions': results.packed.definitions,
+            'tokens': results.packed.tokens,
+        },
+        'degradations': results.degradations,
+    }
+
+
+def run_traced(endpoint: Callable[[dict], dict], request: dict, request_id: str) -> dict:
+    """Run an endpoint within a trace of the request."""
+    with trace_request(request_id):
+        return endpoint(request)
+
+
+def make_endpoints(
+        retrieve: Callable,
+        agentic_search: Callable,
+        generate_response: Callable
+    ) -> dict[str, Callable[[dict], dict]]:
+    """Make the POST endpoint functions from the functions returned by `drivers.setup`."""
+
+    def search(request: dict) -> tuple[CompoundResults, dict]:
+        budget_sec = request.get('budget_sec')
+        results = retrieve(request['query'], None if budget_sec is None else Deadline(budget_sec))
+        return results, results_to_dict(results)
+
+    def search_endpoint(request: dict) -> dict:
+        _, response = search(request)
+        return response
+
+    def summarize_endpoint(request: dict) -> dict:
+        results, response = search(request)
+        response['answer'] = generate_response(
+            request['query'], results.packed.regulations, results.packed.definitions
+        )
+        return response
+
+    def agentic_endpoint(request: dict) -> dict:
+        results, response = search(request)
+        steps = list(
+            agentic_search(request['query'], results.packed.regulations, results.packed.definitions)
+        )
+        response['answer'] = steps[-1] if len(steps)>0 else None
+        response['steps'] = steps
+        return response
+
+    return {
+        '/search': search_endpoint,
+        '/summarize': summarize_endpoint,
+        '/agentic': agentic_endpoint,
+    }
+
+
+def make_server(
+        load: Callable[[], dict[str, Callable[[dict], dict]]],
+        host: str = '127.0.0.1',
+        port: int = 8000,
+        workers: int = 4,
+        max_queue: int = 16,
+        request_timeout_sec: float = 120.0
+    ) -> ThreadingHTTPServer:
+    """Make the HTTP server.
+
+    `load` builds the endpoints (e.g. with `make_endpoints`); it runs on a
+    background thread, and the service reports ready once it has finished."""
+    pool = WorkerPool(workers, max_queue)
+    IN_FLIGHT.set_function(lambda: pool.in_flight)
+    endpoints: dict[str, Callable[[dict], dict]] = {}
+    ready = threading.Event()
+
+    def load_endpoints():
+        start_time = time.perf_counter()
+        try:
+            endpoints.update(load())
+        except Exception:
+            log.exception('Loading the service failed')
+            return
+        ready.set()
+        log.info(f'Service ready after {time.perf_counter() - start_time:.1f} s')
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def path_label(self) -> str:
+            return self.path if self.path in endpoints or self.path in ('/health', '/ready') else 'other'
+
+        def send_json(self, status: int, body: dict, headers: dict | None = None) -> None:
+            self.status = status
+            HTTP_REQUESTS.inc(path=self.path_label(), status=status)
+            data = json.dumps(body, default=to_json).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            for name,value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path=='/metrics':
+                data = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', metrics.CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            elif self.path=='/health':
+                self.send_json(200, {'status': 'ok'})
+            elif self.path=='/ready':
+                if ready.is_set():
+                    self.send_json(200, {'status': 'ready', 'in_flight': pool.in_flight})
+                else:
+                    self.send_json(503, {'status': 'loading'}, {'Retry-After': str(RETRY_AFTER_SEC)})
+            else:
+                self.send_json(404, {'error': f'Unknown path {self.path}'})
+
+        def do_POST(self):
+            # Every outcome is timed, including rejections and errors
+            start_time = time.perf_counter()
+            self.status = None
+            try:
+                self.handle_post(start_time)
+            finally:
+                HTTP_REQUEST_SECONDS.observe(
+                    time.perf_counter() - start_time,
+                    path=self.path_label(),
+                    status='error' if self.status is None else self.status
+                )
+
+        def handle_post(self, start_time: float) -> None:
+            if not ready.is_set():
+                self.send_json(503, {'error': 'Service is loading'}, {'Retry-After': str(RETRY_AFTER_SEC)})
+                return
+            endpoint = endpoints.get(self.path)
+            if endpoint is None:
+                self.send_json(404, {'error': f'Unknown path {self.path}'})
+                return
+
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                if length<0:
+                    raise ValueError('`Content-Length` must not be negative')
+                if length>MAX_BODY_BYTES:
+                    self.send_json(413, {'error': f'Request body over {MAX_BODY_BYTES} bytes'})
+                    return
+                request = json.loads(self.rfile.read(length) or b'{}')
+                if not isinstance(request.get('query'), str) or len(request['query'].strip())==0:
+                    raise ValueError('`query` must be a non-empty string')
+                budget_sec = request.get('budget_sec')
+                if budget_sec is not None and (
+                        isinstance(budget_sec, bool) or not isinstance(budget_sec, (int, float)) or budget_sec<=0
+                    ):
+                    raise ValueError('`budget_sec` must be a positive number of seconds')
+            except (ValueError, AttributeError) as e:
+                self.send_json(400, {'error': str(e)})
+                return
+
+            request_id = self.headers.get('X-Request-Id') or new_id()
+            id_header = {'X-Request-Id': request_id}
+            try:
+                future = pool.submit(run_traced, endpoint, request, request_id)
+            except Overloaded as e:
+                log.warning(f'Rejected {self.path} request: {e}')
+                self.send_json(
+                    503,
+                    {'error': 'Service is overloaded', 'request_id': request_id},
+                    {'Retry-After': str(RETRY_AFTER_SEC), **id_header}
+                )
+                return
+            try:
+                response = future.result(timeout=request_timeout_sec)
+            except TimeoutError:
+                self.send_json(
+                    504,
+                    {'error': f'Request took over {request_timeout_sec} s', 'request_id': request_id},
+                    id_header
+                )
+                return
+            except Exception as e:
+                log.exception(f'Error handling {self.path} request {request_id}')
+                self.send_json(500, {'error': f'{type(e).__name__}: {e}', 'request_id': request_id}, id_header)
+                return
+
+            response['request_id'] = request_id
+            response['elapsed_sec'] = time.perf_counter() - start_time
+            self.send_json(200, response, id_header)
+
+        def log_message(self, format, *args):
+            log.debug(f'{self.address_string()} {format % args}')
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=load_endpoints, name='service-load', daemon=True).start()
+
+    return server
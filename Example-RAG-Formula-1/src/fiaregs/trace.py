@@ -0,0 +1,284 @@
+"""Per-request traces of stage timings and counts, and tracing spans.
+
+A caller opens a trace around a request with `trace_request()`.  The drivers
+and search functions record stage timings (`stage`), counts (`count`) and lists
+of values such as retrieved chunk ids (`record`) into the current trace, which
+is held in a context variable; outside of a trace the recording functions do
+nothing.  Work submitted through `fiaregs.executor` runs in a copy of the
+submitting context, so stages on worker threads record into the same trace.
+
+Stages (and blocks wrapped in `span`) are also exported as spans: timed, nested
+operations with attributes and the id of the request they belong to.  Spans
+are only created once an exporter has been added (`add_exporter`), e.g. a
+`JsonlExporter` that appends them to a file or a `MemoryExporter` that keeps
+them in a list; without exporters, `span` costs a single check.
+
+Request and stage latencies are also observed in histograms (see
+`fiaregs.metrics`), whether or not there is a trace.
+"""
+
+from typing import Any, Callable, Iterator, Protocol
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+import contextvars
+import json
+import logging
+import threading
+import time
+import uuid
+
+from fiaregs import metrics
+
+log = logging.getLogger('trace')
+
+REQUEST_SECONDS = metrics.histogram('fiaregs_request_seconds', 'Latency of traced requests')
+STAGE_SECONDS = metrics.histogram('fiaregs_stage_seconds', 'Latency of pipeline stages', ['stage'])
+
+
+def new_id() -> str:
+    """A random id for a request or span."""
+    return uuid.uuid4().hex[:16]
+
+
+@dataclass
+class RequestTrace:
+    """Accumulated stage timings (seconds), counts and recorded values for one request."""
+    request_id: str = field(default_factory=new_id)
+    timings: dict[str, float] = field(default_factory=dict)
+    counts: dict[str, int] = field(default_factory=dict)
+    values: dict[str, list] = field(default_factory=dict)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def add_time(self, name: str, elapsed_sec: float) -> None:
+        with self._lock:
+            self.timings[name] = self.timings.get(name, 0.0) + elapsed_sec
+
+    def add_count(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def add_values(self, name: str, values: list) -> None:
+        with self._lock:
+            self.values.setdefault(name, []).extend(values)
+
+    def to_dict(self) -> dict[str, dict[str, Any]]:
+        """Get the trace as plain dicts, e.g. for JSON."""
+        with self._lock:
+            return {
+                'request_id': self.request_id,
+                'timings': dict(self.timings),
+                'counts': dict(self.counts),
+                'values': {name: list(values) for name,values in self.values.items()}
+            }
+
+
+@dataclass
+class Span:
+    """A timed operation, nested in the span that was current when it started."""
+    name: str
+    span_id: str
+    parent_id: str | None
+    request_id: str | None
+    start_time: float
+    duration_sec: float = 0.0
+    attributes: dict[str, Any] = field(default_factory=dict)
+    error: str | None = None
+
+    def set(self, **attributes) -> None:
+        """Add attributes, e.g. results only known at the end of the span."""
+        self.attributes.update(attributes)
+
+    def to_dict(self) -> dict[str, Any]:
+        return asdict(self)
+
+
+class NoSpan:
+    """Stands in for a span when no exporters are set."""
+
+    def set(self, **attributes) -> None:
+        pass
+
+
+NO_SPAN = NoSpan()
+
+
+class Exporter(Protocol):
+    def export(self, span: Span) -> None:
+        ...
+
+
+class MemoryExporter:
+    """Keeps finished spans in a list, e.g. for tests."""
+
+    def __init__(self):
+        self.spans: list[Span] = []
+        self._lock = threading.Lock()
+
+    def export(self, span: Span) -> None:
+        with self._lock:
+            self.spans.append(span)
+
+    def clear(self) -> None:
+        with self._lock:
+            self.spans.clear()
+
+
+class JsonlExporter:
+    """Appends finished spans to a JSONL file, one span per line."""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._file = open(self.path, 'a')
+        self._lock = threading.Lock()
+
+    def export(self, span: Span) -> None:
+        line = json.dumps(span.to_dict(), default=str)
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+
+
+# Replaced rather than modified, so spans can read it without a lock
+_exporters: tuple[Exporter, ...] = ()
+_exporters_lock = threading.Lock()
+
+
+def add_exporter(exporter: Exporter) -> Exporter:
+    """Export finished spans to `exporter` (and enable spans)."""
+    global _exporters
+    with _exporters_lock:
+        _exporters = _exporters + (exporter,)
+    return exporter
+
+
+def remove_exporter(exporter: Exporter) -> None:
+    """Stop exporting spans to `exporter`."""
+    global _exporters
+    with _exporters_lock:
+        _exporters = tuple(other for other in _exporters if other is not exporter)
+
+
+_current_trace: contextvars.ContextVar[RequestTrace | None] = contextvars.ContextVar(
+    'request_trace', default=None
+)
+_current_span: contextvars.ContextVar[Span | None] = contextvars.ContextVar(
+    'span', default=None
+)
+
+
+def current_trace() -> RequestTrace | None:
+    """Get the trace of the current request, if there is one."""
+    return _current_trace.get()
+
+
+def current_request_id() -> str | None:
+    """Get the id of the current request, if there is one."""
+    trace = _current_trace.get()
+    return None if trace is None else trace.request_id
+
+
+@contextmanager
+def span(name: str, **attributes) -> Iterator[Span | NoSpan]:
+    """Export this block as span `name` with `attributes`, if any exporters are set.
+
+    The span is nested in the current span and belongs to the current request.
+    If the block raises, the error is recorded on the span."""
+    exporters = _exporters
+    if len(exporters)==0:
+        yield NO_SPAN
+        return
+
+    parent = _current_span.get()
+    current = Span(
+        name,
+        new_id(),
+        None if parent is None else parent.span_id,
+        current_request_id(),
+        time.time(),
+        attributes=attributes
+    )
+    token = _current_span.set(current)
+    start_time = time.perf_counter()
+    try:
+        yield current
+    except BaseException as e:
+        current.error = f'{type(e).__name__}: {e}'
+        raise
+    finally:
+        current.duration_sec = time.perf_counter() - start_time
+        _current_span.reset(token)
+        for exporter in exporters:
+            try:
+                exporter.export(current)
+            except Exception:
+                log.exception(f'Exporting span {name} failed')
+
+
+@contextmanager
+def trace_request(request_id: str | None = None) -> Iterator[RequestTrace]:
+    """Trace everything in this block, timing the whole block as 'total'.
+
+    The block is exported as a 'request' span; `request_id` (by default a new
+    random id) is attached to every span within it."""
+    trace = RequestTrace() if request_id is None else RequestTrace(request_id)
+    token = _current_trace.set(trace)
+    start_time = time.perf_counter()
+    try:
+        with span('request'):
+            yield trace
+    finally:
+        elapsed_sec = time.perf_counter() - start_time
+        trace.add_time('total', elapsed_sec)
+        REQUEST_SECONDS.observe(elapsed_sec)
+        _current_trace.reset(token)
+
+
+@contextmanager
+def stage(name: str, **attributes) -> Iterator[Span | NoSpan]:
+    """Add the time spent in this block to stage `name` of the current trace.
+
+    The block is also exported as a span (see `span`) and observed in the stage
+    latency histogram."""
+    trace = _current_trace.get()
+    with span(name, **attributes) as current:
+        start_time = time.perf_counter()
+        try:
+            yield current
+        finally:
+            elapsed_sec = time.perf_counter() - start_time
+            STAGE_SECONDS.observe(elapsed_sec, stage=name)
+            if trace is not None:
+                trace.add_time(name, elapsed_sec)
+
+
+def count(name: str, n: int = 1) -> None:
+    """Add to count `name` of the current trace."""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_count(name, n)
+
+
+def record(name: str, values: list) -> None:
+    """Add values to list `name` of the current trace."""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_values(name, values)
+
+
+def traced(name: str, func: Callable, count_name: str | None = None, **attributes) -> Callable:
+    """Wrap a function to time it as stage `name` and count its calls as `count_name`.
+
+    Each call is exported as a span with `attributes`."""
+
+    def wrapper(*args, **kwargs):
+        if count_name is not None:
+            count(count_name)
+        with stage(name, **attributes):
+            return func(*args, **kwargs)
+
+    return wrapper
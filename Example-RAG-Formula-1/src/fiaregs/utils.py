@@ -1,13 +1,19 @@
+from __future__ import annotations
+
+from typing import Sequence, TYPE_CHECKING
 import os
 import re
 from pathlib import Path
 import yaml
 import logging
 
-import torch
-
 import fiaregs.search.utils.doctree as doctree
 import fiaregs.search.embeddings as emb
+from fiaregs.search.utils.data_utils import ChunkIds
+from fiaregs.search.utils.arena import TextArena
+
+if TYPE_CHECKING:
+    import torch
 
 log = logging.getLogger('search')
 
@@ -45,7 +51,7 @@ def load_defs(regulations: dict, doc_dir: Path) -> tuple[list[str], list[tuple]]
     return definitions_flat, definition_ids
 
 
-def encode(run_dir: Path, filename: str, flat_texts: list[str], model) -> torch.Tensor:
+def encode(run_dir: Path, filename: str, flat_texts: Sequence[str], model) -> torch.Tensor:
     """Load or generate embeddings."""
 
     # Generate/retrieve embeddings
@@ -56,7 +62,7 @@ def encode(run_dir: Path, filename: str, flat_texts: list[str], model) -> torch.
         log.info('Done.')
     else:
         log.info('Generating embeddings (this will take a few minutes)')
-        embeddings = emb.encode(flat_texts, model)
+        embeddings = emb.encode(list(flat_texts), model)
         emb.save_embeddings(embeddings, filename)
         log.info('Done.')
 
@@ -68,27 +74,15 @@ def get_embeddings(
         run_dir: Path,
         model,
         pre_expand: bool
-    ) -> tuple[torch.Tensor, list[str], list[tuple]]:
-    """Flatten the texts for embedding, expanding per config"""
-    flat_texts = []
-    flat_ids = []
+    ) -> tuple[torch.Tensor, TextArena, ChunkIds]:
+    """Flatten the texts for embedding, expanding per config.
+
+    The texts are returned as a `TextArena`, which holds each paragraph once
+    however many expanded texts it is part of."""
     if pre_expand:
         log.info('Expanding context window')
-        for reg,doc_tree in doc_trees.items():
-            ids, chunks = [], []
-            for ind,item in doctree.flatten_doctree(doc_tree):
-                tree_ind = ind[:-1]
-                expanded_items = doctree.expand(item, doc_tree, tree_ind)
-                chunks += expanded_items
-                ids += [ind]*len(expanded_items)
-            flat_texts += chunks
-            flat_ids += [(reg,)+i for i in ids]
-    else:
-        for reg,doc_tree in doc_trees.items():
-            ids,chunks = zip(*doctree.flatten_doctree(doc_tree))
-            flat_texts += chunks
-            flat_ids += [(reg,)+id for id in ids]
+    flat_texts, flat_ids = TextArena.from_doctrees(doc_trees, pre_expand)
 
     embeddings = encode(run_dir, 'embeddings.pkl', flat_texts, model)
 
-    return embeddings, flat_texts, flat_ids
+    return embeddings, flat_texts, ChunkIds.from_tuples(flat_ids)